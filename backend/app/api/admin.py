@@ -1,7 +1,11 @@
 """管理员 API"""
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
+from typing import Dict
+from app.api.deps import verify_admin
 from app.services.scheduler import scheduler
-from app.services.db_factory import db
+from app.services.token_filter import invite_token_filter
+from app.services.db_factory import async_db
+from app.services.async_db import run_blocking, run_idc
 from app.config import settings
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -32,14 +36,14 @@ async def get_auth_config():
 @router.post("/cleanup")
 async def cleanup_expired():
     """手动触发过期账号清理"""
-    results = scheduler.check_expired_accounts()
+    results = await run_idc(scheduler.check_expired_accounts)
     return results
 
 
 @router.get("/expiring")
 async def get_expiring_accounts(days: int = 7):
     """获取即将过期的账号"""
-    accounts = scheduler.get_expiring_soon(days)
+    accounts = await run_blocking(scheduler.get_expiring_soon, days)
     return {
         "count": len(accounts),
         "days_threshold": days,
@@ -48,16 +52,31 @@ async def get_expiring_accounts(days: int = 7):
 
 
 @router.get("/stats")
-async def get_stats():
-    """获取账号统计"""
-    all_users = db.get_users()
-    active = db.get_users(status="ACTIVE")
-    expired = db.get_users(status="EXPIRED")
-    deleted = db.get_users(status="DELETED")
+async def get_stats(_: bool = Depends(verify_admin)):
+    """获取账号统计（单次聚合，按状态 / 等级 / 租户细分）"""
+    groups = await async_db.count_users_grouped(by=["status", "tier", "identity_store_id"])
+    
+    by_status: Dict[str, int] = {}
+    by_tier: Dict[str, int] = {}
+    by_tenant: Dict[str, int] = {}
+    for g in groups:
+        n = int(g["count"])
+        for bucket, field in ((by_status, "status"), (by_tier, "tier"), (by_tenant, "identity_store_id")):
+            key = g.get(field) or "UNKNOWN"
+            bucket[key] = bucket.get(key, 0) + n
     
     return {
-        "total": len(all_users),
-        "active": len(active),
-        "expired": len(expired),
-        "deleted": len(deleted)
+        "total": sum(by_status.values()),
+        "active": by_status.get("ACTIVE", 0),
+        "expired": by_status.get("EXPIRED", 0),
+        "deleted": by_status.get("DELETED", 0),
+        "by_status": by_status,
+        "by_tier": by_tier,
+        "by_tenant": by_tenant
     }
+
+
+@router.get("/token-filter")
+async def get_token_filter_stats(_: bool = Depends(verify_admin)):
+    """公开邀请接口的无效令牌拦截计数（格式 / 负缓存 / 布隆过滤器）"""
+    return invite_token_filter.stats
@@ -0,0 +1,31 @@
+"""路由共用的依赖"""
+from fastapi import HTTPException, Header
+from typing import Optional
+
+from app.services.auth import cognito_auth, verified_tokens
+
+
+async def verify_admin(
+    authorization: Optional[str] = Header(None)
+):
+    """
+    验证管理员身份
+    必须使用 Cognito JWT Token (Authorization: Bearer <token>)
+    
+    验证通过的 token 进入进程内缓存，同一 token 的后续请求不再做 RS256 验签；
+    需要拉取 JWKS 时在线程池中进行，不阻塞事件循环
+    """
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(401, "需要登录认证")
+    
+    token = authorization[7:]
+    payload = verified_tokens.get(token)
+    if payload is None:
+        payload = await cognito_auth.verify_token_async(token)
+        if payload:
+            verified_tokens.put(token, payload)
+    
+    if payload:
+        return {"type": "cognito", "email": payload.get("email")}
+    
+    raise HTTPException(401, "无效的认证令牌，请重新登录")
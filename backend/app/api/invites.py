@@ -1,43 +1,31 @@
 """邀请令牌 API"""
-from fastapi import APIRouter, HTTPException, Header, Query, Depends
+from fastapi import APIRouter, HTTPException, Header, Query, Depends, Response
+from fastapi.responses import StreamingResponse
 from typing import Optional, List
 from datetime import datetime, timedelta
 from pydantic import BaseModel, Field
-import secrets
 import uuid
 
-from app.models.invite import InviteStatus
+from app.models.invite import InviteStatus, InviteJobStatus, ClaimResult, ProvisionStatus
 from app.models.user import UserStatus
-from app.services.db_factory import db
-from app.services.idc import IDCService
-from app.services.auth import cognito_auth
+from app.services.db_factory import async_db
+from app.services.async_db import run_idc
+from app.services.expiry_timer import expiry_timer
+from app.services.export import EXPORT_MEDIA_TYPES, stream_export
+from app.services.idc import get_idc_service
+from app.services.idempotency import IdempotencyError, claim_idempotency, claim_key, fingerprint_of
+from app.services.invite_jobs import invite_job_runner, make_invites
+from app.services.provisioning_queue import provisioning_worker
+from app.services.token_filter import invite_token_filter
+from app.api.deps import verify_admin
+from app.services.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.services.timeutil import epoch_of, from_epoch, now_epoch, to_epoch
 from app.config import settings
 
 
 router = APIRouter()
 
 
-# ==================== 认证 ====================
-
-def verify_admin(
-    authorization: Optional[str] = Header(None)
-):
-    """
-    验证管理员身份
-    必须使用 Cognito JWT Token (Authorization: Bearer <token>)
-    """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(401, "需要登录认证")
-    
-    token = authorization[7:]
-    payload = cognito_auth.verify_token(token)
-    
-    if payload:
-        return {"type": "cognito", "email": payload.get("email")}
-    
-    raise HTTPException(401, "无效的认证令牌，请重新登录")
-
-
 # ==================== 请求/响应模型 ====================
 
 class CreateInvitesRequest(BaseModel):
@@ -50,6 +38,23 @@ class CreateInvitesRequest(BaseModel):
     sso_url: Optional[str] = None
 
 
+class CreateInviteJobRequest(CreateInvitesRequest):
+    count: int = Field(..., ge=1, le=settings.INVITE_JOB_MAX_COUNT, description="创建数量")
+
+
+class InviteJobResponse(BaseModel):
+    job_id: str
+    status: str
+    total: int
+    created: int
+    progress: float
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    download_url: str
+
+
 class InviteResponse(BaseModel):
     token: str
     status: str
@@ -62,6 +67,11 @@ class InviteResponse(BaseModel):
     note: Optional[str]
 
 
+class InviteListResponse(BaseModel):
+    items: List[InviteResponse]
+    next_cursor: Optional[str] = None
+
+
 class ClaimRequest(BaseModel):
     email: str
     display_name: Optional[str] = None
@@ -75,6 +85,20 @@ class ClaimResponse(BaseModel):
     tier: Optional[str] = None
     expires_at: Optional[datetime] = None
     sso_url: Optional[str] = None
+    status: Optional[str] = None  # 异步开通模式下为开通任务状态
+    status_url: Optional[str] = None
+
+
+class ClaimStatusResponse(BaseModel):
+    token: str
+    status: str
+    attempts: int = 0
+    error: Optional[str] = None
+    username: Optional[str] = None
+    email: Optional[str] = None
+    tier: Optional[str] = None
+    expires_at: Optional[datetime] = None
+    sso_url: Optional[str] = None
 
 
 class InviteInfoResponse(BaseModel):
@@ -88,6 +112,27 @@ class InviteInfoResponse(BaseModel):
 
 # ==================== 管理员 API ====================
 
+def _invite_params(req: CreateInvitesRequest, x_identity_store_id: Optional[str], now: datetime) -> dict:
+    """解析创建参数（租户、SSO 地址、到期时间），单次创建和批量任务共用"""
+    store_id = req.identity_store_id or x_identity_store_id or settings.IDENTITY_STORE_ID
+    sso_url = req.sso_url or f"https://{store_id}.awsapps.com/start"
+    
+    if req.expires_date:
+        expires_at = datetime.strptime(req.expires_date, "%Y-%m-%d").replace(hour=23, minute=50, second=0)
+    else:
+        expires_at = now + timedelta(days=req.entitlement_days)
+        expires_at = expires_at.replace(hour=23, minute=50, second=0)
+    
+    return {
+        "tier": req.tier,
+        "entitlement_days": req.entitlement_days,
+        "expires_at": expires_at.isoformat(),
+        "note": req.note,
+        "identity_store_id": store_id,
+        "sso_url": sso_url
+    }
+
+
 @router.post("/create", response_model=List[InviteResponse])
 async def create_invites(
     req: CreateInvitesRequest,
@@ -95,86 +140,207 @@ async def create_invites(
     _: bool = Depends(verify_admin)
 ):
     """批量创建邀请令牌"""
-    store_id = req.identity_store_id or x_identity_store_id or settings.IDENTITY_STORE_ID
-    sso_url = req.sso_url or f"https://{store_id}.awsapps.com/start"
-    
     now = datetime.now()
+    params = _invite_params(req, x_identity_store_id, now)
+    expires_at = datetime.fromisoformat(params["expires_at"])
+    invites = make_invites(params, req.count, now)
     
-    if req.expires_date:
-        expires_at = datetime.strptime(req.expires_date, "%Y-%m-%d").replace(hour=23, minute=50, second=0)
-    else:
-        expires_at = now + timedelta(days=req.entitlement_days)
-        expires_at = expires_at.replace(hour=23, minute=50, second=0)
+    if not await async_db.insert_invites_many(invites):
+        raise HTTPException(500, "创建邀请失败，请稍后重试")
+    invite_token_filter.add_many(inv["token"] for inv in invites)
     
-    results = []
-    
-    for _ in range(req.count):
-        token = secrets.token_urlsafe(12)
-        
-        db.insert_invite({
-            "token": token,
-            "status": "PENDING",
-            "tier": req.tier,
-            "entitlement_days": req.entitlement_days,
-            "created_at": now.isoformat(),
-            "expires_at": expires_at.isoformat(),
-            "note": req.note,
-            "identity_store_id": store_id,
-            "sso_url": sso_url
-        })
-        
-        results.append(InviteResponse(
-            token=token,
+    results = [
+        InviteResponse(
+            token=inv["token"],
             status="PENDING",
             tier=req.tier,
             entitlement_days=req.entitlement_days,
             created_at=now,
             expires_at=expires_at,
             claimed_email=None,
-            claim_url=f"{settings.FRONTEND_URL}/claim/{token}",
+            claim_url=f"{settings.FRONTEND_URL}/claim/{inv['token']}",
             note=req.note
-        ))
+        )
+        for inv in invites
+    ]
     
     return results
 
 
-@router.get("/list", response_model=List[InviteResponse])
+@router.get("/list", response_model=InviteListResponse)
 async def list_invites(
     status: Optional[str] = None,
     store_id: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor"),
     x_identity_store_id: Optional[str] = Header(None),
     _: bool = Depends(verify_admin)
 ):
-    """列出所有邀请令牌"""
+    """分页列出邀请令牌"""
     identity_store_id = store_id or x_identity_store_id
-    invites = db.get_invites(identity_store_id=identity_store_id, status=status)
+    try:
+        invites, next_cursor = await async_db.get_invites_page(
+            identity_store_id=identity_store_id, status=status, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     
-    return [
-        InviteResponse(
-            token=inv["token"],
-            status=inv["status"],
-            tier=inv["tier"],
-            entitlement_days=inv["entitlement_days"],
-            created_at=datetime.fromisoformat(inv["created_at"]) if inv["created_at"] else datetime.now(),
-            expires_at=datetime.fromisoformat(inv["expires_at"]) if inv.get("expires_at") else None,
-            claimed_email=inv.get("claimed_email"),
-            claim_url=f"{settings.FRONTEND_URL}/claim/{inv['token']}",
-            note=inv.get("note")
+    return InviteListResponse(
+        items=[
+            InviteResponse(
+                token=inv["token"],
+                status=inv["status"],
+                tier=inv["tier"],
+                entitlement_days=inv["entitlement_days"],
+                created_at=from_epoch(epoch_of(inv, "created_at")) or datetime.now(),
+                expires_at=from_epoch(epoch_of(inv, "expires_at")),
+                claimed_email=inv.get("claimed_email"),
+                claim_url=f"{settings.FRONTEND_URL}/claim/{inv['token']}",
+                note=inv.get("note")
+            )
+            for inv in invites
+        ],
+        next_cursor=next_cursor
+    )
+
+
+def _job_response(job: dict) -> InviteJobResponse:
+    return InviteJobResponse(
+        job_id=job["job_id"],
+        status=job["status"],
+        total=job["total"],
+        created=job["created"],
+        progress=round(job["created"] / job["total"], 4) if job["total"] else 1.0,
+        error=job.get("error"),
+        created_at=job["created_at"],
+        updated_at=job.get("updated_at"),
+        completed_at=job.get("completed_at"),
+        download_url=f"/api/invites/jobs/{job['job_id']}/download"
+    )
+
+
+@router.post("/jobs", response_model=InviteJobResponse, status_code=202)
+async def create_invite_job(
+    req: CreateInviteJobRequest,
+    x_identity_store_id: Optional[str] = Header(None),
+    _: bool = Depends(verify_admin)
+):
+    """
+    创建批量生成任务（后台分批写入，通过 GET /jobs/{job_id} 查询进度）
+    
+    任务由常驻进程中的执行器运行；执行器未运行（如 Lambda 关闭了后台任务）时拒绝创建，
+    否则任务会一直停在 PENDING。
+    """
+    if not invite_job_runner.running:
+        raise HTTPException(503, "当前部署未运行批量任务执行器，请分批调用 /create 生成")
+    now = datetime.now()
+    job = {
+        "job_id": f"job_{uuid.uuid4().hex[:12]}",
+        "status": InviteJobStatus.PENDING.value,
+        "total": req.count,
+        "created": 0,
+        "params": _invite_params(req, x_identity_store_id, now),
+        "created_at": now.isoformat()
+    }
+    if not await async_db.insert_invite_job(job):
+        raise HTTPException(500, "创建任务失败，请稍后重试")
+    
+    invite_job_runner.submit(job["job_id"])
+    return _job_response(job)
+
+
+@router.get("/jobs/{job_id}", response_model=InviteJobResponse)
+async def get_invite_job(job_id: str, _: bool = Depends(verify_admin)):
+    """查询批量任务进度"""
+    job = await async_db.get_invite_job(job_id)
+    if not job:
+        raise HTTPException(404, "任务不存在")
+    return _job_response(job)
+
+
+INVITE_EXPORT_COLUMNS = [
+    "token", "status", "tier", "entitlement_days", "created_at", "expires_at",
+    "claimed_email", "claim_url", "note"
+]
+
+
+def _invite_export_record(inv: dict) -> dict:
+    created_at = from_epoch(epoch_of(inv, "created_at"))
+    expires_at = from_epoch(epoch_of(inv, "expires_at"))
+    return {
+        "token": inv["token"],
+        "status": inv.get("status"),
+        "tier": inv.get("tier"),
+        "entitlement_days": int(inv["entitlement_days"]) if inv.get("entitlement_days") is not None else None,
+        "created_at": created_at.isoformat() if created_at else None,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+        "claimed_email": inv.get("claimed_email"),
+        "claim_url": f"{settings.FRONTEND_URL}/claim/{inv['token']}",
+        "note": inv.get("note")
+    }
+
+
+@router.get("/export")
+async def export_invites(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    status: Optional[str] = None,
+    store_id: Optional[str] = Query(None),
+    x_identity_store_id: Optional[str] = Header(None),
+    _: bool = Depends(verify_admin)
+):
+    """流式导出全部邀请（CSV / NDJSON），不在内存中构建整个列表"""
+    identity_store_id = store_id or x_identity_store_id
+    attributes = [c for c in INVITE_EXPORT_COLUMNS if c != "claim_url"] + ["created_ts", "expires_ts"]
+    
+    def open_rows():
+        return async_db.backend.iter_invites(
+            identity_store_id=identity_store_id,
+            status=status,
+            attributes=attributes,
+            segments=settings.DYNAMODB_SCAN_SEGMENTS
         )
-        for inv in invites
-    ]
+    
+    filename = f"invites_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        stream_export(open_rows, INVITE_EXPORT_COLUMNS, _invite_export_record, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@router.get("/jobs/{job_id}/download")
+async def download_invite_job(
+    job_id: str,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    _: bool = Depends(verify_admin)
+):
+    """流式下载批量任务生成的邀请（任务未完成时为已生成的部分）"""
+    job = await async_db.get_invite_job(job_id)
+    if not job:
+        raise HTTPException(404, "任务不存在")
+    
+    attributes = [c for c in INVITE_EXPORT_COLUMNS if c != "claim_url"] + ["created_ts", "expires_ts"]
+    
+    def open_rows():
+        return async_db.backend.iter_invites_by_job(job_id, attributes=attributes)
+    
+    return StreamingResponse(
+        stream_export(open_rows, INVITE_EXPORT_COLUMNS, _invite_export_record, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="invites_{job_id}.{format}"'}
+    )
 
 
 @router.delete("/{token}")
 async def revoke_invite(token: str, _: bool = Depends(verify_admin)):
     """撤销邀请令牌"""
-    invite = db.get_invite(token)
+    invite = await async_db.get_invite(token)
     if not invite:
         raise HTTPException(404, "令牌不存在")
     if invite["status"] == "CLAIMED":
         raise HTTPException(400, "已被认领，无法撤销")
     
-    db.update_invite(token, {"status": "REVOKED"})
+    await async_db.update_invite(token, {"status": "REVOKED"})
     return {"success": True}
 
 
@@ -182,10 +348,14 @@ async def revoke_invite(token: str, _: bool = Depends(verify_admin)):
 
 @router.get("/info/{token}", response_model=InviteInfoResponse)
 async def get_invite_info(token: str):
-    """获取邀请信息"""
-    invite = db.get_invite(token)
+    """获取邀请信息（格式不对 / 近期查过不存在的令牌不查库）"""
+    if invite_token_filter.check(token):
+        return InviteInfoResponse(valid=False, error="无效的邀请链接")
+    
+    invite = await async_db.get_invite(token)
     
     if not invite:
+        invite_token_filter.remember_missing(token)
         return InviteInfoResponse(valid=False, error="无效的邀请链接")
     
     if invite["status"] == "CLAIMED":
@@ -194,10 +364,9 @@ async def get_invite_info(token: str):
     if invite["status"] == "REVOKED":
         return InviteInfoResponse(valid=False, error="该邀请已被撤销")
     
-    if invite.get("expires_at"):
-        exp = datetime.fromisoformat(invite["expires_at"])
-        if exp < datetime.utcnow():
-            return InviteInfoResponse(valid=False, error="该邀请已过期")
+    expires_ts = epoch_of(invite, "expires_at")
+    if expires_ts is not None and expires_ts < now_epoch():
+        return InviteInfoResponse(valid=False, error="该邀请已过期")
     
     return InviteInfoResponse(
         valid=True,
@@ -209,78 +378,137 @@ async def get_invite_info(token: str):
 
 
 @router.post("/claim/{token}", response_model=ClaimResponse)
-async def claim_invite(token: str, req: ClaimRequest):
-    """认领邀请（学生填写邮箱）"""
-    invite = db.get_invite(token)
+async def claim_invite(
+    token: str,
+    req: ClaimRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """
+    认领邀请（学生填写邮箱）
+    
+    异步开通模式下只占用邀请并入队，返回 202 和 status_url，由后台 worker 开通 IDC 账号。
+    成功的认领按 Idempotency-Key（未提供时按令牌 + 邮箱）保存，重复提交直接重放第一次的响应。
+    无效令牌在幂等检查和查库之前拒绝。
+    """
+    if invite_token_filter.check(token):
+        return ClaimResponse(success=False, error="无效的邀请链接")
+    
+    async def handle():
+        result = await _claim_invite(token, req, key if idempotency_key else None)
+        status_code = 202 if result.status == ProvisionStatus.PENDING.value else 200
+        return status_code, result.model_dump(mode="json"), result.success
+    
+    key = claim_key(token, req.email, idempotency_key)
+    aliases = (claim_key(token, req.email),) if idempotency_key else ()
+    try:
+        status_code, body, replayed = await claim_idempotency.run(
+            key, fingerprint_of(req.email.strip().lower()), handle, aliases
+        )
+    except IdempotencyError as e:
+        raise HTTPException(e.status_code, str(e))
+    
+    response.status_code = status_code
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return body
+
+
+async def _claim_invite(token: str, req: ClaimRequest, idempotency_key: Optional[str] = None) -> ClaimResponse:
+    invite = await async_db.get_invite(token)
     
     if not invite:
+        invite_token_filter.remember_missing(token)
         return ClaimResponse(success=False, error="无效的邀请链接")
     
     if invite["status"] != "PENDING":
         return ClaimResponse(success=False, error="该邀请不可用")
     
-    if invite.get("expires_at"):
-        exp = datetime.fromisoformat(invite["expires_at"])
-        if exp < datetime.utcnow():
-            return ClaimResponse(success=False, error="该邀请已过期")
+    expires_ts = epoch_of(invite, "expires_at")
+    if expires_ts is not None and expires_ts < now_epoch():
+        return ClaimResponse(success=False, error="该邀请已过期")
     
     store_id = invite.get("identity_store_id") or settings.IDENTITY_STORE_ID
     sso_url = invite.get("sso_url") or f"https://{store_id}.awsapps.com/start"
     
-    if db.get_user_by_email(req.email, store_id):
-        return ClaimResponse(success=False, error="该邮箱已注册")
-    
     email_prefix = req.email.split('@')[0]
     username = f"kiro_{email_prefix[:20]}"
     
-    if db.get_user_by_username(username, store_id):
-        username = f"kiro_{email_prefix[:12]}_{uuid.uuid4().hex[:4]}"
-    
-    idc_service = IDCService(identity_store_id=store_id)
-    
-    idc_user_id = idc_service.create_user(
-        username=username,
-        email=req.email,
-        display_name=req.display_name or email_prefix
-    )
-    
-    if not idc_user_id:
-        return ClaimResponse(success=False, error="创建 AWS 账号失败，请稍后重试")
-    
     tier = invite["tier"]
-    group_id = settings.get_group_id(tier)
-    if group_id:
-        idc_service.add_user_to_group(idc_user_id, group_id)
-    
-    now = datetime.utcnow()
+    # 与邀请的时间字段一致使用本地时间
+    now = datetime.now()
     # 使用邀请的过期时间
-    if invite.get("expires_at"):
-        expires_at = datetime.fromisoformat(invite["expires_at"])
+    if expires_ts is not None:
+        expires_at = from_epoch(expires_ts)
     else:
         expires_at = now + timedelta(days=int(invite["entitlement_days"]))
-    user_id = f"user_{uuid.uuid4().hex[:12]}"
     
-    db.insert_user({
-        "user_id": user_id,
+    user = {
+        "user_id": f"user_{uuid.uuid4().hex[:12]}",
         "username": username,
         "email": req.email,
         "display_name": req.display_name or email_prefix,
         "status": "ACTIVE",
         "tier": tier,
-        "idc_user_id": idc_user_id,
+        "idc_user_id": None,
         "created_at": now.isoformat(),
         "expires_at": expires_at.isoformat(),
         "invite_token": token,
         "identity_store_id": store_id,
         "sso_url": sso_url
-    })
+    }
+    
+    # 先原子地占用邀请、邮箱和用户名，再开通 IDC 账号，避免并发认领重复开通
+    # 用户名冲突由事务的唯一约束发现（不预先查询），换带随机后缀的用户名重试一次
+    # 本进程没有运行开通 worker（如 Lambda 关闭了后台任务）时同步开通，否则任务无人处理
+    enqueue = settings.CLAIM_ASYNC_PROVISIONING and provisioning_worker.running
+    result = await async_db.claim_invite_atomic(token, user, enqueue=enqueue, idempotency_key=idempotency_key)
+    if result == ClaimResult.USERNAME_TAKEN:
+        user["username"] = username = f"kiro_{email_prefix[:12]}_{uuid.uuid4().hex[:4]}"
+        result = await async_db.claim_invite_atomic(token, user, enqueue=enqueue, idempotency_key=idempotency_key)
+    
+    if result == ClaimResult.INVITE_UNAVAILABLE:
+        return ClaimResponse(success=False, error="该邀请不可用")
+    if result == ClaimResult.EMAIL_TAKEN:
+        return ClaimResponse(success=False, error="该邮箱已注册")
+    if result == ClaimResult.USERNAME_TAKEN:
+        raise HTTPException(409, "用户名冲突，请稍后重试")
+    if result != ClaimResult.CLAIMED:
+        return ClaimResponse(success=False, error="认领失败，请稍后重试")
+    
+    if enqueue:
+        provisioning_worker.notify()
+        return ClaimResponse(
+            success=True,
+            username=username,
+            email=req.email,
+            tier=tier,
+            expires_at=expires_at,
+            sso_url=sso_url,
+            status=ProvisionStatus.PENDING.value,
+            status_url=f"/api/invites/claim-status/{token}"
+        )
     
-    db.update_invite(token, {
-        "status": "CLAIMED",
-        "claimed_at": now.isoformat(),
-        "claimed_email": req.email,
-        "claimed_user_id": user_id
-    })
+    idc_service = get_idc_service(store_id)
+    
+    idc_user_id = await run_idc(
+        idc_service.create_user,
+        username=username,
+        email=req.email,
+        display_name=user["display_name"]
+    )
+    
+    if not idc_user_id:
+        # 补偿：释放邀请，允许稍后重试
+        await async_db.release_invite_claim(token, user)
+        return ClaimResponse(success=False, error="创建 AWS 账号失败，请稍后重试")
+    
+    group_id = settings.get_group_id(tier)
+    if group_id:
+        await run_idc(idc_service.add_user_to_group, idc_user_id, group_id)
+    
+    await async_db.update_user(user["user_id"], {"idc_user_id": idc_user_id})
+    expiry_timer.schedule(user["user_id"], to_epoch(expires_at))
     
     return ClaimResponse(
         success=True,
@@ -290,3 +518,42 @@ async def claim_invite(token: str, req: ClaimRequest):
         expires_at=expires_at,
         sso_url=sso_url
     )
+
+
+@router.get("/claim-status/{token}", response_model=ClaimStatusResponse)
+async def get_claim_status(token: str):
+    """查询认领的开通状态（异步开通模式下轮询；同步认领的邀请直接返回已完成）"""
+    if invite_token_filter.check(token):
+        raise HTTPException(404, "没有该邀请的认领记录")
+    
+    task = await async_db.get_provision_task(token)
+    if task is None:
+        invite = await async_db.get_invite(token)
+        if not invite:
+            invite_token_filter.remember_missing(token)
+        if not invite or invite["status"] != "CLAIMED":
+            raise HTTPException(404, "没有该邀请的认领记录")
+        task = {"status": ProvisionStatus.COMPLETED.value, "user_id": invite.get("claimed_user_id")}
+    
+    status = task["status"]
+    if status == ProvisionStatus.FAILED.value:
+        return ClaimStatusResponse(
+            token=token,
+            status=status,
+            attempts=task.get("attempts", 0),
+            error="创建 AWS 账号失败，请重新认领"
+        )
+    
+    user = (await async_db.get_user(task["user_id"]) if task.get("user_id") else None) or {}
+    store_id = user.get("identity_store_id") or settings.IDENTITY_STORE_ID
+    return ClaimStatusResponse(
+        token=token,
+        status=status,
+        attempts=task.get("attempts", 0),
+        error=task.get("error") if status != ProvisionStatus.COMPLETED.value else None,
+        username=user.get("username"),
+        email=user.get("email"),
+        tier=user.get("tier"),
+        expires_at=from_epoch(epoch_of(user, "expires_at")),
+        sso_url=user.get("sso_url") or f"https://{store_id}.awsapps.com/start"
+    )
@@ -1,39 +1,26 @@
 """用户管理 API"""
-from fastapi import APIRouter, HTTPException, Header, Query, Depends
+from fastapi import APIRouter, HTTPException, Header, Query, Depends, Request
+from fastapi.responses import StreamingResponse
 from typing import List, Optional
-from datetime import datetime
+from datetime import datetime, timedelta
+import json
 from pydantic import BaseModel
 
-from app.services.db_factory import db
-from app.services.idc import IDCService
-from app.services.auth import cognito_auth
+from app.services.db_factory import async_db
+from app.services.async_db import run_idc
+from app.services.expiry_timer import expiry_timer
+from app.services.export import EXPORT_MEDIA_TYPES, stream_export
+from app.services.idc import get_idc_service
+from app.services.provisioning import parse_roster, provision_roster
+from app.api.deps import verify_admin
+from app.services.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.services.timeutil import epoch_of, from_epoch
 from app.config import settings
 
 
 router = APIRouter()
 
 
-# ==================== 认证 ====================
-
-def verify_admin(
-    authorization: Optional[str] = Header(None)
-):
-    """
-    验证管理员身份
-    必须使用 Cognito JWT Token (Authorization: Bearer <token>)
-    """
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(401, "需要登录认证")
-    
-    token = authorization[7:]
-    payload = cognito_auth.verify_token(token)
-    
-    if payload:
-        return {"type": "cognito", "email": payload.get("email")}
-    
-    raise HTTPException(401, "无效的认证令牌，请重新登录")
-
-
 class UserResponse(BaseModel):
     user_id: str
     username: str
@@ -45,29 +32,127 @@ class UserResponse(BaseModel):
     expires_at: Optional[datetime]
 
 
-@router.get("/list", response_model=List[UserResponse])
+class UserListResponse(BaseModel):
+    items: List[UserResponse]
+    next_cursor: Optional[str] = None
+
+
+@router.get("/list", response_model=UserListResponse)
 async def list_users(
+    status: Optional[str] = None,
     store_id: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor"),
     x_identity_store_id: Optional[str] = Header(None),
     _: bool = Depends(verify_admin)
 ):
-    """列出所有用户"""
+    """分页列出用户"""
     identity_store_id = store_id or x_identity_store_id
-    users = db.get_users(identity_store_id=identity_store_id)
+    try:
+        users, next_cursor = await async_db.get_users_page(
+            identity_store_id=identity_store_id, status=status, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     
-    return [
-        UserResponse(
-            user_id=u["user_id"],
-            username=u["username"],
-            email=u["email"],
-            display_name=u.get("display_name"),
-            status=u["status"],
-            tier=u["tier"],
-            created_at=datetime.fromisoformat(u["created_at"]) if u["created_at"] else datetime.now(),
-            expires_at=datetime.fromisoformat(u["expires_at"]) if u.get("expires_at") else None
+    return UserListResponse(
+        items=[
+            UserResponse(
+                user_id=u["user_id"],
+                username=u["username"],
+                email=u["email"],
+                display_name=u.get("display_name"),
+                status=u["status"],
+                tier=u["tier"],
+                created_at=from_epoch(epoch_of(u, "created_at")) or datetime.now(),
+                expires_at=from_epoch(epoch_of(u, "expires_at"))
+            )
+            for u in users
+        ],
+        next_cursor=next_cursor
+    )
+
+
+USER_EXPORT_COLUMNS = [
+    "user_id", "username", "email", "display_name", "status", "tier", "created_at", "expires_at"
+]
+
+
+def _user_export_record(u: dict) -> dict:
+    created_at = from_epoch(epoch_of(u, "created_at"))
+    expires_at = from_epoch(epoch_of(u, "expires_at"))
+    record = {c: u.get(c) for c in USER_EXPORT_COLUMNS}
+    record["created_at"] = created_at.isoformat() if created_at else None
+    record["expires_at"] = expires_at.isoformat() if expires_at else None
+    return record
+
+
+@router.get("/export")
+async def export_users(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    status: Optional[str] = None,
+    store_id: Optional[str] = Query(None),
+    x_identity_store_id: Optional[str] = Header(None),
+    _: bool = Depends(verify_admin)
+):
+    """流式导出全部用户（CSV / NDJSON），不在内存中构建整个列表"""
+    identity_store_id = store_id or x_identity_store_id
+    
+    def open_rows():
+        return async_db.backend.iter_users(
+            identity_store_id=identity_store_id,
+            status=status,
+            attributes=USER_EXPORT_COLUMNS + ["created_ts", "expires_ts"],
+            segments=settings.DYNAMODB_SCAN_SEGMENTS
         )
-        for u in users
-    ]
+    
+    filename = f"users_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    return StreamingResponse(
+        stream_export(open_rows, USER_EXPORT_COLUMNS, _user_export_record, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@router.post("/provision")
+async def provision_users(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$", description="默认按 Content-Type 判断"),
+    tier: str = Query("Pro", description="名单未指定 tier 时使用"),
+    entitlement_days: int = Query(90, ge=1, description="账号有效天数"),
+    expires_date: Optional[str] = Query(None, description="到期日期 YYYY-MM-DD"),
+    store_id: Optional[str] = Query(None),
+    x_identity_store_id: Optional[str] = Header(None),
+    _: bool = Depends(verify_admin)
+):
+    """
+    按名单批量开通账号（请求体为 CSV 或 NDJSON，字段 email, display_name, tier）
+    
+    以 NDJSON 流式返回每行的结果，最后一行为汇总
+    """
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "ndjson" if "json" in content_type else "csv"
+    try:
+        rows = parse_roster(await request.body(), format)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    
+    identity_store_id = store_id or x_identity_store_id or settings.IDENTITY_STORE_ID
+    sso_url = f"https://{identity_store_id}.awsapps.com/start"
+    if expires_date:
+        try:
+            expires_at = datetime.strptime(expires_date, "%Y-%m-%d").replace(hour=23, minute=50, second=0)
+        except ValueError:
+            raise HTTPException(400, "到期日期格式应为 YYYY-MM-DD")
+    else:
+        expires_at = (datetime.now() + timedelta(days=entitlement_days)).replace(hour=23, minute=50, second=0, microsecond=0)
+    
+    async def stream():
+        async for result in provision_roster(rows, identity_store_id, sso_url, tier, expires_at):
+            yield (json.dumps(result, ensure_ascii=False) + "\n").encode()
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
 
 
 @router.delete("/{user_id}")
@@ -78,7 +163,7 @@ async def delete_user(
     _: bool = Depends(verify_admin)
 ):
     """删除用户"""
-    user = db.get_user(user_id)
+    user = await async_db.get_user(user_id)
     if not user:
         raise HTTPException(404, "用户不存在")
     
@@ -87,11 +172,12 @@ async def delete_user(
     
     # 从 IDC 删除
     if user.get("idc_user_id"):
-        idc_service = IDCService(identity_store_id=identity_store_id)
-        idc_service.delete_user(user["idc_user_id"])
+        idc_service = get_idc_service(identity_store_id)
+        await run_idc(idc_service.delete_user, user["idc_user_id"])
     
     # 从数据库删除
-    db.delete_user(user_id)
+    await async_db.delete_user(user_id)
+    expiry_timer.cancel(user_id)
     
     return {"success": True}
 
@@ -99,30 +185,32 @@ async def delete_user(
 @router.post("/{user_id}/disable")
 async def disable_user(user_id: str, _: bool = Depends(verify_admin)):
     """禁用用户"""
-    user = db.get_user(user_id)
+    user = await async_db.get_user(user_id)
     if not user:
         raise HTTPException(404, "用户不存在")
     
     identity_store_id = user.get("identity_store_id") or settings.IDENTITY_STORE_ID
     if user.get("idc_user_id"):
-        idc_service = IDCService(identity_store_id=identity_store_id)
-        idc_service.disable_user(user["idc_user_id"])
+        idc_service = get_idc_service(identity_store_id)
+        await run_idc(idc_service.disable_user, user["idc_user_id"])
     
-    db.update_user(user_id, {"status": "DISABLED"})
+    await async_db.update_user(user_id, {"status": "DISABLED"})
+    expiry_timer.cancel(user_id)
     return {"success": True}
 
 
 @router.post("/{user_id}/enable")
 async def enable_user(user_id: str, _: bool = Depends(verify_admin)):
     """启用用户"""
-    user = db.get_user(user_id)
+    user = await async_db.get_user(user_id)
     if not user:
         raise HTTPException(404, "用户不存在")
     
     identity_store_id = user.get("identity_store_id") or settings.IDENTITY_STORE_ID
     if user.get("idc_user_id"):
-        idc_service = IDCService(identity_store_id=identity_store_id)
-        idc_service.enable_user(user["idc_user_id"])
+        idc_service = get_idc_service(identity_store_id)
+        await run_idc(idc_service.enable_user, user["idc_user_id"])
     
-    db.update_user(user_id, {"status": "ACTIVE"})
+    await async_db.update_user(user_id, {"status": "ACTIVE"})
+    expiry_timer.schedule(user_id, epoch_of(user, "expires_at"))
     return {"success": True}
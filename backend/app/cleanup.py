@@ -1,16 +1,59 @@
 """Lambda 定时清理 handler"""
 import json
+from typing import Optional
+from app.config import settings
+from app.services.aws_clients import get_client
+from app.services.db_factory import db
 from app.services.scheduler import scheduler
 
 
+def _time_budget(context) -> Optional[float]:
+    """本次调用可用于清理的秒数：剩余时间减去安全余量"""
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return max(1.0, remaining - settings.CLEANUP_SAFETY_MARGIN_SECONDS)
+
+
+def _continue_async(context, continuation: int):
+    """异步调用自身，从断点继续清理"""
+    get_client("lambda").invoke(
+        FunctionName=context.function_name,
+        InvocationType="Event",
+        Payload=json.dumps({"continuation": continuation}).encode()
+    )
+
+
 def handler(event, context):
-    """EventBridge 触发的定时清理"""
-    print("开始执行定时清理...")
+    """
+    EventBridge 触发的定时清理；超时前保存断点，必要时自调用继续
+    
+    手动调用并传入 {"action": "migrate"} 时执行旧数据回填（升级部署后运行一次）
+    """
+    if (event or {}).get("action") == "migrate":
+        print("开始执行数据回填...")
+        try:
+            results = db.run_data_migrations()
+            return {"statusCode": 200, "body": json.dumps(results, ensure_ascii=False)}
+        except Exception as e:
+            print(f"数据回填失败: {e}")
+            return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+    
+    continuation = (event or {}).get("continuation", 0)
+    print(f"开始执行定时清理... (continuation={continuation})")
     
     try:
-        results = scheduler.check_expired_accounts()
+        results = scheduler.check_expired_accounts(time_budget=_time_budget(context))
         print(f"清理完成: {json.dumps(results, ensure_ascii=False)}")
         
+        if results["more_work"]:
+            if settings.CLEANUP_SELF_INVOKE and continuation < settings.CLEANUP_MAX_CONTINUATIONS:
+                _continue_async(context, continuation + 1)
+                results["continued"] = True
+                print(f"时间不足，已保存断点并触发后续清理 (run_id={results['run_id']})")
+            else:
+                print(f"时间不足，已保存断点，等待下次定时触发继续 (run_id={results['run_id']})")
+        
         return {
             "statusCode": 200,
             "body": json.dumps(results, ensure_ascii=False)
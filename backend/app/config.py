@@ -10,10 +10,75 @@ class Settings(BaseSettings):
     AWS_DEFAULT_REGION: str = "us-east-1"
     IDENTITY_STORE_ID: str = ""
     IDENTITY_CENTER_INSTANCE_ARN: str = ""
+    AWS_MAX_POOL_CONNECTIONS: int = 32  # 每个 client 的 HTTP 连接池大小
+    AWS_CONNECT_TIMEOUT: float = 2.0
+    AWS_READ_TIMEOUT: float = 5.0
+    AWS_MAX_ATTEMPTS: int = 5  # adaptive 重试模式的最大尝试次数
+    
+    # IDC 调用限流（Identity Store API 配额）
+    IDC_RATE_LIMIT_PER_SECOND: float = 10.0
+    IDC_RATE_LIMIT_BURST: int = 10
+    IDC_THROTTLE_RETRIES: int = 4
+    IDC_SWEEP_CONCURRENCY: int = 8  # 过期清理并发处理数，1 为串行
+    PROVISION_CONCURRENCY: int = 8  # 名单批量开通的并发数（仍受上面的令牌桶限流）
+    IDC_EXECUTOR_WORKERS: int = 16  # IDC 调用线程池大小，与数据访问线程池分开
+    PROVISION_MAX_ROWS: int = 5000  # 单次名单最多行数
+    
+    # 过期清理分片（超时前保存断点，下次从断点继续）
+    CLEANUP_SAFETY_MARGIN_SECONDS: float = 30.0  # Lambda 剩余时间中预留给收尾的秒数
+    CLEANUP_SLICE_SECONDS: float = 300.0  # 本地定时任务每片的时间预算
+    CLEANUP_SELF_INVOKE: bool = False  # Lambda 未处理完时异步调用自身继续
+    CLEANUP_MAX_CONTINUATIONS: int = 20  # 自调用次数上限，防止失控
+    SWEEP_LEASE_TTL_SECONDS: float = 600.0  # 清理租约时长（有时间预算时再加上预算）
+    
+    # 常驻进程中的后台任务（定时清理、到期定时器、批量任务执行器、异步开通 worker、JWKS 刷新）
+    # Lambda 中由清理函数负责定时任务，template.yaml 中关闭
+    BACKGROUND_TASKS_ENABLED: bool = True
+    
+    # 到期定时器（常驻进程内在到期时刻处理账号，每天的清理改为对账）
+    EXPIRY_TIMER_ENABLED: bool = True
+    EXPIRY_TIMER_HORIZON_HOURS: float = 48.0  # 内存中只保留该时间内到期的用户
+    EXPIRY_TIMER_RETRY_SECONDS: float = 60.0
+    EXPIRY_TIMER_MAX_RETRIES: int = 5
+    
+    # 邀请批量生成任务（后台分批写入）
+    INVITE_JOB_MAX_COUNT: int = 100000
+    INVITE_JOB_BATCH_SIZE: int = 500  # 每批写入的邀请数（SQLite 一个事务）
+    INVITE_JOB_LEASE_TTL_SECONDS: float = 120.0  # 任务租约时长，每批续期；实例退出后其他实例可接管
+    INVITE_JOB_RESCAN_SECONDS: float = 60.0  # 空闲时重新扫描未完成任务的间隔
+    
+    # 异步开通（认领时只占用邀请并入队，由后台 worker 调用 IDC；没有运行 worker 的进程仍同步开通）
+    CLAIM_ASYNC_PROVISIONING: bool = False
+    PROVISION_QUEUE_CONCURRENCY: int = 4
+    PROVISION_QUEUE_LEASE_SECONDS: float = 120.0  # 单个任务的执行租约，过期后可被重新取出
+    PROVISION_QUEUE_POLL_SECONDS: float = 2.0
+    PROVISION_QUEUE_MAX_ATTEMPTS: int = 5
+    PROVISION_QUEUE_RETRY_SECONDS: float = 10.0  # 重试间隔基数（指数增长）
+    
+    # 认领幂等（Idempotency-Key / 令牌 + 邮箱），成功响应在 TTL 内直接重放
+    CLAIM_IDEMPOTENCY_TTL_SECONDS: float = 86400.0
+    CLAIM_IDEMPOTENCY_INFLIGHT_TTL_SECONDS: float = 120.0  # 处理中标记的有效期，进程崩溃后到期释放
+    CLAIM_IDEMPOTENCY_CACHE_SIZE: int = 2048  # 进程内 LRU 条数
+    CLAIM_IDEMPOTENCY_CACHE_TTL_SECONDS: float = 300.0  # LRU 条目有效期（其他实例回滚认领后最多这么久仍会重放）
+    
+    # 公开邀请接口的令牌预过滤（格式校验 + 负缓存 + 可选布隆过滤器）
+    INVITE_NEGATIVE_CACHE_TTL_SECONDS: float = 60.0  # 查过不存在的令牌在该时间内直接拒绝
+    INVITE_NEGATIVE_CACHE_SIZE: int = 10000
+    # 布隆过滤器只认本进程启动时库中已有和本进程新建的令牌；多实例部署（其他实例也会创建邀请）不要开启
+    INVITE_TOKEN_BLOOM_ENABLED: bool = False
+    INVITE_TOKEN_BLOOM_CAPACITY: int = 1000000
+    INVITE_TOKEN_BLOOM_ERROR_RATE: float = 0.001
     
     # DynamoDB
     DYNAMODB_TABLE_PREFIX: str = "kiro_invite"
     USE_DYNAMODB: bool = False  # True for Lambda, False for local SQLite
+    DYNAMODB_SCAN_SEGMENTS: int = 4  # 全表扫描的并行分段数
+    
+    # SQLite
+    SQLITE_POOL_SIZE: int = 8  # 连接池最大连接数
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000  # 写锁等待时间
+    SQLITE_POOL_TIMEOUT_SECONDS: float = 30.0  # 连接池满时借出连接的最长等待，超时抛错而不是无限阻塞
+    DB_EXECUTOR_WORKERS: int = 16  # 异步数据访问线程池大小
     
     # IDC Groups
     IDC_GROUP_PRO: str = ""
@@ -29,6 +94,12 @@ class Settings(BaseSettings):
     COGNITO_USER_POOL_ID: str = ""
     COGNITO_CLIENT_ID: str = ""
     COGNITO_REGION: str = "us-east-1"
+    COGNITO_JWKS_URL: str = ""  # 默认由 User Pool 推导，可指向本地测试服务
+    JWKS_CACHE_TTL_SECONDS: float = 3600.0  # 过期后后台刷新，期间继续使用旧 key
+    JWKS_UNKNOWN_KID_MIN_INTERVAL_SECONDS: float = 30.0  # 未知 kid 触发刷新的最小间隔
+    JWKS_NEGATIVE_TTL_SECONDS: float = 10.0  # 拉取失败后的重试间隔
+    AUTH_TOKEN_CACHE_SIZE: int = 1024  # 已验证 token 缓存条数
+    AUTH_TOKEN_CACHE_MAX_TTL_SECONDS: float = 300.0  # 单条缓存最长有效期（不超过 token 的 exp）
     
     @property
     def cors_origins_list(self) -> List[str]:
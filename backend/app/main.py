@@ -7,32 +7,66 @@ import asyncio
 
 from app.api import invites, users, admin
 from app.config import settings
+from app.services.db_factory import async_db
+from app.services.async_db import run_idc
+from app.services.aws_clients import close_clients
+from app.services.auth import cognito_auth
+from app.services.expiry_timer import expiry_timer
+from app.services.invite_jobs import invite_job_runner
+from app.services.provisioning_queue import provisioning_worker
+from app.services.token_filter import invite_token_filter
 
 # 定时任务
-async def scheduled_cleanup():
-    """每天 23:50 检查过期账号，23:55 确认删除"""
+async def run_cleanup_sweep(label: str):
+    """按时间片执行过期清理，每片结束时保存断点，直到处理完"""
     from app.services.scheduler import scheduler
+    
+    while True:
+        results = await run_idc(
+            scheduler.check_expired_accounts,
+            time_budget=settings.CLEANUP_SLICE_SECONDS
+        )
+        print(f"[{label}] 完成: 检查 {results['checked']} 个, 过期 {results['expired']} 个, 处理 {results['processed']} 个")
+        print(f"[{label}] 详情: {results['details']}")
+        if not results["more_work"]:
+            return
+        print(f"[{label}] 时间片用完，从断点继续 (run_id={results['run_id']})")
+
+
+async def scheduled_cleanup():
+    """
+    每天定时清理过期账号
+    
+    启用到期定时器时，账号在到期时刻就已处理，这里只在 23:55 做一次对账
+    （过期索引上只会查到漏掉或处理失败的用户）；否则 23:50 清理、23:55 确认
+    """
     from datetime import datetime, time, timedelta
     
+    run_at = time(23, 55) if settings.EXPIRY_TIMER_ENABLED else time(23, 50)
+    
     while True:
         now = datetime.now()
         
-        # 计算下一个 23:50
-        target_time = datetime.combine(now.date(), time(23, 50))
+        # 计算下一个执行时间
+        target_time = datetime.combine(now.date(), run_at)
         if now >= target_time:
-            # 如果今天已过 23:50，则等到明天
+            # 如果今天已过执行时间，则等到明天
             target_time = target_time + timedelta(days=1)
         
-        # 等待到 23:50
         wait_seconds = (target_time - now).total_seconds()
         print(f"[定时清理] 下次执行时间: {target_time.strftime('%Y-%m-%d %H:%M')}, 等待 {wait_seconds/3600:.1f} 小时")
         await asyncio.sleep(wait_seconds)
         
+        if settings.EXPIRY_TIMER_ENABLED:
+            try:
+                await run_cleanup_sweep("定时对账 23:55")
+            except Exception as e:
+                print(f"[定时对账 23:55] 失败: {e}")
+            continue
+        
         # 23:50 执行删除
         try:
-            results = scheduler.check_expired_accounts()
-            print(f"[定时清理 23:50] 完成: 检查 {results['checked']} 个, 过期 {results['expired']} 个, 处理 {results['processed']} 个")
-            print(f"[定时清理 23:50] 详情: {results['details']}")
+            await run_cleanup_sweep("定时清理 23:50")
         except Exception as e:
             print(f"[定时清理 23:50] 失败: {e}")
         
@@ -41,19 +75,34 @@ async def scheduled_cleanup():
         
         # 23:55 确认删除结果
         try:
-            results = scheduler.check_expired_accounts()
-            print(f"[定时清理 23:55] 确认: 检查 {results['checked']} 个, 剩余过期 {results['expired']} 个")
+            await run_cleanup_sweep("定时清理 23:55")
         except Exception as e:
             print(f"[定时清理 23:55] 确认失败: {e}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # 启动时
-    task = asyncio.create_task(scheduled_cleanup())
+    # 启动时（后台循环只在常驻进程中运行）
+    tasks = []
+    if settings.BACKGROUND_TASKS_ENABLED:
+        tasks.append(asyncio.create_task(scheduled_cleanup()))
+        tasks.append(asyncio.create_task(invite_job_runner.run()))
+        if settings.EXPIRY_TIMER_ENABLED:
+            tasks.append(asyncio.create_task(expiry_timer.run()))
+        if settings.CLAIM_ASYNC_PROVISIONING:
+            tasks.append(asyncio.create_task(provisioning_worker.run()))
+        if cognito_auth.enabled:
+            tasks.append(asyncio.create_task(cognito_auth.keys.run_refresher()))
+    elif settings.CLAIM_ASYNC_PROVISIONING:
+        print("⚠️ 已开启异步开通但未运行后台任务，本进程的认领改为同步开通")
+    if invite_token_filter.bloom_enabled:
+        tasks.append(asyncio.create_task(invite_token_filter.rebuild()))
     yield
     # 关闭时
-    task.cancel()
+    for task in tasks:
+        task.cancel()
+    async_db.close()
+    close_clients()
 
 
 app = FastAPI(
@@ -84,4 +133,6 @@ async def health():
 
 
 # Lambda handler
-handler = Mangum(app)
+# Mangum 默认在每次调用前后执行 lifespan，会在请求之间关闭线程池、连接和 client 缓存；
+# Lambda 中不需要后台任务，直接关闭 lifespan（资源按需创建，随容器复用）
+handler = Mangum(app, lifespan="off")
@@ -0,0 +1,12 @@
+"""旧数据回填（升级已有部署后执行一次）
+    
+    cd backend
+    USE_DYNAMODB=true python -m app.migrate
+"""
+import json
+
+from app.services.db_factory import db
+
+
+if __name__ == "__main__":
+    print(json.dumps(db.run_data_migrations(), ensure_ascii=False))
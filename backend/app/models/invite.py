@@ -17,9 +17,34 @@ class Invite(BaseModel):
     status: InviteStatus = InviteStatus.PENDING
     tier: str = "Pro"
     entitlement_days: int = 90
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=datetime.now)
     expires_at: Optional[datetime] = None
     claimed_at: Optional[datetime] = None
     claimed_email: Optional[str] = None
     claimed_user_id: Optional[str] = None
     note: Optional[str] = None
+
+
+class InviteJobStatus(str, Enum):
+    """批量生成任务状态"""
+    PENDING = "PENDING"      # 等待执行
+    RUNNING = "RUNNING"      # 生成中
+    COMPLETED = "COMPLETED"  # 已完成
+    FAILED = "FAILED"        # 失败
+
+
+class ProvisionStatus(str, Enum):
+    """异步开通任务状态"""
+    PENDING = "PENDING"      # 排队中（含等待重试）
+    RUNNING = "RUNNING"      # 开通中
+    COMPLETED = "COMPLETED"  # 已开通
+    FAILED = "FAILED"        # 多次重试仍失败，邀请已释放
+
+
+class ClaimResult(str, Enum):
+    """原子认领结果"""
+    CLAIMED = "CLAIMED"                        # 认领成功
+    INVITE_UNAVAILABLE = "INVITE_UNAVAILABLE"  # 邀请不存在或已不是 PENDING
+    EMAIL_TAKEN = "EMAIL_TAKEN"                # 该租户下邮箱已注册
+    USERNAME_TAKEN = "USERNAME_TAKEN"          # 用户名冲突
+    FAILED = "FAILED"                          # 其他存储错误
@@ -19,6 +19,6 @@ class User(BaseModel):
     status: UserStatus = UserStatus.ACTIVE
     tier: str = "Pro"
     idc_user_id: Optional[str] = None
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=datetime.now)
     expires_at: Optional[datetime] = None
     invite_token: Optional[str] = None
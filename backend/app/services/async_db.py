@@ -0,0 +1,83 @@
+"""异步数据访问层 - 在有界线程池中执行同步的 SQLite / DynamoDB 调用"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, TypeVar
+
+from app.config import settings
+
+
+T = TypeVar("T")
+
+# 数据访问共用一个有界线程池，避免阻塞事件循环，也限制并发打到存储层的请求数；
+# IDC 调用（受令牌桶限流、可能退避等待）使用单独的线程池，不占用数据访问的线程
+# 按需创建：关闭后再次使用时重新创建（同一进程可能多次经历 lifespan，如测试客户端）
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executor_lock = threading.Lock()
+
+
+def _get_executor(name: str = "db") -> ThreadPoolExecutor:
+    executor = _executors.get(name)
+    if executor is None:
+        with _executor_lock:
+            executor = _executors.get(name)
+            if executor is None:
+                workers = settings.IDC_EXECUTOR_WORKERS if name == "idc" else settings.DB_EXECUTOR_WORKERS
+                executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+                _executors[name] = executor
+    return executor
+
+
+async def run_blocking(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """在数据访问线程池中执行阻塞函数并等待结果"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_idc(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """在 IDC 线程池中执行会调用 Identity Center 的阻塞函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor("idc"), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executor():
+    """关闭所有线程池（应用退出时调用）；之后的调用会使用新的线程池"""
+    with _executor_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncDB:
+    """
+    同步数据库后端的异步外观，方法与底层后端一一对应：
+        
+        invite = await async_db.get_invite(token)
+    """
+    
+    def __init__(self, backend: Any):
+        self._backend = backend
+    
+    @property
+    def backend(self) -> Any:
+        return self._backend
+    
+    def __getattr__(self, name: str):
+        attr = getattr(self._backend, name)
+        if not callable(attr):
+            return attr
+        
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await run_blocking(attr, *args, **kwargs)
+        
+        # 缓存包装后的方法，下次直接命中实例属性
+        setattr(self, name, method)
+        return method
+    
+    def close(self):
+        """关闭线程池和底层连接"""
+        shutdown_executor()
+        self._backend.close()
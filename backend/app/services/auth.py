@@ -1,14 +1,195 @@
 """Cognito JWT 认证服务"""
+import asyncio
+import hashlib
 import json
+import threading
 import time
 import urllib.request
-from typing import Optional, Dict
-from jose import jwt, JWTError
-from functools import lru_cache
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple
+from jose import jwk, jwt, JWTError
 
 from app.config import settings
 
 
+class JWKSCache:
+    """
+    kid → 已构造公钥的缓存（热路径上不再解析 JWK）
+    
+    - ttl 内直接命中；过期后先返回旧 key，由后台刷新任务（未启动时由后台线程）刷新
+    - 遇到未知 kid 立即刷新一次（限频，避免伪造 kid 反复打 JWKS 端点）
+    - 拉取失败保留旧 key，只做短暂的负缓存，之后重试
+    - 同一时刻只有一个拉取在进行（single-flight），并发的调用方等待它的结果
+    """
+    
+    def __init__(self, url: str, ttl: float, unknown_kid_interval: float, negative_ttl: float):
+        self.url = url
+        self.ttl = ttl
+        self.unknown_kid_interval = unknown_kid_interval
+        self.negative_ttl = negative_ttl
+        self._keys: Dict[str, object] = {}
+        self._fetched_at: Optional[float] = None
+        self._generation = 0
+        self._failed_until = 0.0
+        self._last_unknown_kid_refresh = 0.0
+        self._refreshing = False
+        self._refresher_running = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+    
+    def cached_key(self, kid: Optional[str]):
+        """只查缓存，不发网络请求；缓存已过期时安排后台刷新"""
+        if (
+            self._fetched_at is not None
+            and time.monotonic() - self._fetched_at > self.ttl
+            and not self._refresher_running
+        ):
+            self._refresh_in_background()
+        return self._keys.get(kid)
+    
+    def get_key(self, kid: Optional[str]):
+        """返回 kid 对应的公钥，找不到返回 None；可能同步拉取 JWKS（异步代码用 get_key_async）"""
+        if self._fetched_at is None:
+            # 首次使用：同步拉取
+            self.refresh()
+        
+        key = self.cached_key(kid)
+        if key is None and kid:
+            if self._allow_unknown_kid_refresh():
+                # 可能是密钥轮换，限频地强制刷新一次
+                self.refresh()
+            else:
+                # 已有拉取在进行时等它完成
+                with self._fetch_lock:
+                    pass
+            key = self._keys.get(kid)
+        return key
+    
+    async def get_key_async(self, kid: Optional[str]):
+        """get_key 的异步版本：命中缓存直接返回，需要拉取时放到线程池，不阻塞事件循环"""
+        key = self.cached_key(kid)
+        if key is not None:
+            return key
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_key, kid)
+    
+    def _allow_unknown_kid_refresh(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_unknown_kid_refresh < self.unknown_kid_interval:
+                return False
+            self._last_unknown_kid_refresh = now
+            return True
+    
+    def refresh(self) -> bool:
+        """拉取 JWKS 并重建 kid → key 映射；负缓存期内直接返回 False"""
+        generation = self._generation
+        with self._fetch_lock:
+            if self._generation != generation:
+                # 等锁期间其他调用方已经拉取完成
+                return True
+            if time.monotonic() < self._failed_until:
+                return False
+            try:
+                document = self._fetch()
+                keys = {}
+                for jwk_dict in document.get("keys", []):
+                    try:
+                        keys[jwk_dict["kid"]] = jwk.construct(jwk_dict, algorithm=jwk_dict.get("alg", "RS256"))
+                    except Exception as e:
+                        print(f"忽略无法解析的 JWK {jwk_dict.get('kid')}: {e}")
+                if not keys:
+                    raise ValueError("JWKS 中没有可用的 key")
+            except Exception as e:
+                print(f"获取 JWKS 失败: {e}")
+                self._failed_until = time.monotonic() + self.negative_ttl
+                return False
+            
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            self._generation += 1
+            return True
+    
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+        
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+    
+    async def run_refresher(self):
+        """后台定期刷新（在 lifespan 中启动）：启动时预热，之后在过期前刷新"""
+        loop = asyncio.get_running_loop()
+        self._refresher_running = True
+        try:
+            while True:
+                ok = await loop.run_in_executor(None, self.refresh)
+                await asyncio.sleep(self.ttl * 0.8 if ok else self.negative_ttl)
+        finally:
+            self._refresher_running = False
+    
+    def _fetch(self) -> Dict:
+        with urllib.request.urlopen(self.url, timeout=5) as response:
+            return json.loads(response.read().decode())
+
+
+class VerifiedTokenCache:
+    """
+    已验证 token 的 LRU 缓存：token 哈希 → claims
+    
+    条目在 token 的 exp 与 max_ttl 中较早者失效；只缓存验证成功的结果，不缓存失败。
+    """
+    
+    def __init__(self, max_size: int, max_ttl: float):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _key(token: str) -> str:
+        # 不在内存中保存原始 token
+        return hashlib.sha256(token.encode()).hexdigest()
+    
+    def get(self, token: str) -> Optional[Dict]:
+        key = self._key(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+    
+    def put(self, token: str, payload: Dict):
+        valid_until = min(float(payload.get("exp", 0)), time.time() + self.max_ttl)
+        if valid_until <= time.time():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (valid_until, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    @property
+    def stats(self) -> Dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
 class CognitoAuth:
     """Cognito JWT Token 验证"""
     
@@ -16,24 +197,17 @@ class CognitoAuth:
         self.region = settings.COGNITO_REGION or settings.AWS_REGION
         self.user_pool_id = settings.COGNITO_USER_POOL_ID
         self.client_id = settings.COGNITO_CLIENT_ID
-        self._jwks = None
-        self._jwks_url = f"https://cognito-idp.{self.region}.amazonaws.com/{self.user_pool_id}/.well-known/jwks.json"
+        self.issuer = f"https://cognito-idp.{self.region}.amazonaws.com/{self.user_pool_id}"
+        self.keys = JWKSCache(
+            settings.COGNITO_JWKS_URL or f"{self.issuer}/.well-known/jwks.json",
+            ttl=settings.JWKS_CACHE_TTL_SECONDS,
+            unknown_kid_interval=settings.JWKS_UNKNOWN_KID_MIN_INTERVAL_SECONDS,
+            negative_ttl=settings.JWKS_NEGATIVE_TTL_SECONDS
+        )
     
     @property
-    def jwks(self) -> Dict:
-        """获取 JWKS（带缓存）"""
-        if self._jwks is None:
-            self._jwks = self._fetch_jwks()
-        return self._jwks
-    
-    def _fetch_jwks(self) -> Dict:
-        """从 Cognito 获取 JWKS"""
-        try:
-            with urllib.request.urlopen(self._jwks_url, timeout=5) as response:
-                return json.loads(response.read().decode())
-        except Exception as e:
-            print(f"获取 JWKS 失败: {e}")
-            return {"keys": []}
+    def enabled(self) -> bool:
+        return bool(self.user_pool_id and self.client_id)
     
     def verify_token(self, token: str) -> Optional[Dict]:
         """
@@ -42,33 +216,44 @@ class CognitoAuth:
         Returns:
             验证成功返回 token payload，失败返回 None
         """
-        if not self.user_pool_id or not self.client_id:
+        if not self.enabled:
+            return None
+        kid = self._kid(token)
+        if kid is None:
+            return None
+        return self._decode(token, self.keys.get_key(kid))
+    
+    async def verify_token_async(self, token: str) -> Optional[Dict]:
+        """verify_token 的异步版本：取 key 不阻塞事件循环，验签在当前线程完成"""
+        if not self.enabled:
+            return None
+        kid = self._kid(token)
+        if kid is None:
+            return None
+        return self._decode(token, await self.keys.get_key_async(kid))
+    
+    @staticmethod
+    def _kid(token: str) -> Optional[str]:
+        """token header 中的 kid"""
+        try:
+            return jwt.get_unverified_header(token).get("kid")
+        except JWTError as e:
+            print(f"JWT 验证失败: {e}")
+            return None
+    
+    def _decode(self, token: str, key) -> Optional[Dict]:
+        if key is None:
+            print("找不到匹配的 JWK key")
             return None
         
         try:
-            # 获取 token header 中的 kid
-            unverified_header = jwt.get_unverified_header(token)
-            kid = unverified_header.get("kid")
-            
-            # 从 JWKS 中找到对应的 key
-            key = None
-            for k in self.jwks.get("keys", []):
-                if k.get("kid") == kid:
-                    key = k
-                    break
-            
-            if not key:
-                print("找不到匹配的 JWK key")
-                return None
-            
             # 验证 token
-            issuer = f"https://cognito-idp.{self.region}.amazonaws.com/{self.user_pool_id}"
             payload = jwt.decode(
                 token,
                 key,
                 algorithms=["RS256"],
                 audience=self.client_id,
-                issuer=issuer,
+                issuer=self.issuer,
                 options={"verify_at_hash": False}
             )
             
@@ -85,7 +270,7 @@ class CognitoAuth:
                 return None
             
             return payload
-            
+        
         except JWTError as e:
             print(f"JWT 验证失败: {e}")
             return None
@@ -103,3 +288,7 @@ class CognitoAuth:
 
 # 单例
 cognito_auth = CognitoAuth()
+verified_tokens = VerifiedTokenCache(
+    max_size=settings.AUTH_TOKEN_CACHE_SIZE,
+    max_ttl=settings.AUTH_TOKEN_CACHE_MAX_TTL_SECONDS
+)
@@ -0,0 +1,79 @@
+"""进程级 boto3 client / resource 注册表
+
+client 创建要加载服务模型并建立 TLS 连接，开销很大；在 Lambda 中尤其明显。
+这里按 (服务, 区域) 缓存，所有调用方共享同一个 Session 和调优过的 botocore Config。
+"""
+import threading
+from typing import Dict, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+
+from app.config import settings
+
+
+_lock = threading.Lock()
+_session: Optional[boto3.session.Session] = None
+_clients: Dict[Tuple[str, str], object] = {}
+_resources: Dict[Tuple[str, str], object] = {}
+
+# 共享的 botocore 配置：连接池、keep-alive、自适应重试、较紧的超时
+client_config = Config(
+    max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=settings.AWS_CONNECT_TIMEOUT,
+    read_timeout=settings.AWS_READ_TIMEOUT,
+    retries={'mode': 'adaptive', 'max_attempts': settings.AWS_MAX_ATTEMPTS}
+)
+
+# 按服务覆盖的配置：identitystore 的限流重试由 IDCService 在令牌桶之后自行退避，
+# botocore 不再重试，避免两层重试叠加
+_service_configs: Dict[str, Config] = {
+    'identitystore': client_config.merge(Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+}
+
+
+def _get_session() -> boto3.session.Session:
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session
+
+
+def get_client(service: str, region: Optional[str] = None):
+    """获取共享的 boto3 client（线程安全）"""
+    key = (service, region or settings.AWS_REGION)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(
+                    service, region_name=key[1], config=_service_configs.get(service, client_config)
+                )
+                _clients[key] = client
+    return client
+
+
+def get_resource(service: str, region: Optional[str] = None):
+    """获取共享的 boto3 resource"""
+    key = (service, region or settings.AWS_REGION)
+    resource = _resources.get(key)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(key)
+            if resource is None:
+                resource = _get_session().resource(service, region_name=key[1], config=client_config)
+                _resources[key] = resource
+    return resource
+
+
+def close_clients():
+    """关闭所有缓存的 client 连接（应用退出时调用）"""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        for resource in _resources.values():
+            resource.meta.client.close()
+        _clients.clear()
+        _resources.clear()
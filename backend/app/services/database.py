@@ -1,10 +1,255 @@
 """SQLite 数据库服务"""
 import sqlite3
 import json
-from typing import Dict, List, Optional, Any
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Any, Set, Tuple
 from datetime import datetime
 from pathlib import Path
 
+from app.config import settings
+from app.models.invite import ClaimResult
+from app.services.pagination import DEFAULT_PAGE_SIZE, encode_cursor, decode_cursor
+from app.services.timeutil import from_epoch, now_epoch, to_epoch, with_epochs
+
+
+def _backfill_epochs(conn: sqlite3.Connection):
+    """为已有行回填 created_ts / expires_ts"""
+    for table, key in (('invites', 'token'), ('users', 'user_id')):
+        rows = conn.execute(f'SELECT {key}, created_at, expires_at FROM {table}').fetchall()
+        conn.executemany(
+            f'UPDATE {table} SET created_ts = ?, expires_ts = ? WHERE {key} = ?',
+            [(to_epoch(row['created_at']), to_epoch(row['expires_at']), row[key]) for row in rows]
+        )
+
+
+# 版本化迁移：(版本号, 说明, 步骤列表)，步骤是 SQL 语句或接收连接的函数
+# 只能追加，不能修改已发布的迁移；当前版本记录在 PRAGMA user_version
+# 列表排序键：created_ts 无法从 created_at 换算时为 NULL，按 0 排在最后
+SORT_TS = 'COALESCE(created_ts, 0)'
+
+MIGRATIONS = [
+    (1, "用户按租户查邮箱/用户名的索引", [
+        'CREATE INDEX IF NOT EXISTS idx_users_store_email ON users (identity_store_id, email)',
+        'CREATE INDEX IF NOT EXISTS idx_users_store_username ON users (identity_store_id, username)',
+    ]),
+    (2, "过期扫描与邀请列表的索引", [
+        'CREATE INDEX IF NOT EXISTS idx_users_status_expires ON users (status, expires_at)',
+        'CREATE INDEX IF NOT EXISTS idx_invites_store_status_created ON invites (identity_store_id, status, created_at)',
+    ]),
+    (3, "列表分页 (created_at, 主键) 键集索引", [
+        'CREATE INDEX IF NOT EXISTS idx_invites_store_created ON invites (identity_store_id, created_at, token)',
+        'CREATE INDEX IF NOT EXISTS idx_users_store_created ON users (identity_store_id, created_at, user_id)',
+    ]),
+    (4, "后台任务断点表", [
+        '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            name TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TEXT
+        )
+        ''',
+    ]),
+    (5, "分布式租约表、断点的 fencing token", [
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            fencing_token INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        'ALTER TABLE checkpoints ADD COLUMN fencing_token INTEGER',
+    ]),
+    (6, "epoch 秒时间列，范围过滤和排序改用整数列", [
+        'ALTER TABLE invites ADD COLUMN created_ts INTEGER',
+        'ALTER TABLE invites ADD COLUMN expires_ts INTEGER',
+        'ALTER TABLE users ADD COLUMN created_ts INTEGER',
+        'ALTER TABLE users ADD COLUMN expires_ts INTEGER',
+        _backfill_epochs,
+        'DROP INDEX IF EXISTS idx_users_status_expires',
+        'DROP INDEX IF EXISTS idx_invites_store_status_created',
+        'DROP INDEX IF EXISTS idx_invites_store_created',
+        'DROP INDEX IF EXISTS idx_users_store_created',
+        'CREATE INDEX IF NOT EXISTS idx_users_status_expires_ts ON users (status, expires_ts, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_invites_store_status_created_ts ON invites (identity_store_id, status, created_ts)',
+        'CREATE INDEX IF NOT EXISTS idx_invites_store_created_ts ON invites (identity_store_id, created_ts, token)',
+        'CREATE INDEX IF NOT EXISTS idx_users_store_created_ts ON users (identity_store_id, created_ts, user_id)',
+    ]),
+    (7, "邀请批量生成任务表、邀请的 job_id 列", [
+        '''
+        CREATE TABLE IF NOT EXISTS invite_jobs (
+            job_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            params TEXT NOT NULL,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            completed_at TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_invite_jobs_status ON invite_jobs (status)',
+        'ALTER TABLE invites ADD COLUMN job_id TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_invites_job ON invites (job_id) WHERE job_id IS NOT NULL',
+    ]),
+    (8, "异步开通队列（按邀请令牌幂等）", [
+        '''
+        CREATE TABLE IF NOT EXISTS provision_tasks (
+            token TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            due_at REAL,
+            locked_by TEXT,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_provision_tasks_due ON provision_tasks (due_at) WHERE due_at IS NOT NULL',
+    ]),
+    (9, "幂等键表（认领请求的响应重放）", [
+        '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            status TEXT NOT NULL,
+            status_code INTEGER,
+            response TEXT,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)',
+    ]),
+    (10, "开通任务记录认领请求的幂等键（回滚时一并失效）", [
+        'ALTER TABLE provision_tasks ADD COLUMN idempotency_key TEXT',
+    ]),
+    (11, "批量任务记录待写入批次的令牌（续跑时按主键核对）", [
+        'ALTER TABLE invite_jobs ADD COLUMN pending_tokens TEXT',
+    ]),
+    (12, "列表排序键改为 COALESCE(created_ts, 0)（created_ts 为空的行也能分页）", [
+        'DROP INDEX IF EXISTS idx_invites_store_status_created_ts',
+        'DROP INDEX IF EXISTS idx_invites_store_created_ts',
+        'DROP INDEX IF EXISTS idx_users_store_created_ts',
+        f'CREATE INDEX IF NOT EXISTS idx_invites_store_status_sort ON invites (identity_store_id, status, {SORT_TS}, token)',
+        f'CREATE INDEX IF NOT EXISTS idx_invites_store_sort ON invites (identity_store_id, {SORT_TS}, token)',
+        f'CREATE INDEX IF NOT EXISTS idx_users_store_sort ON users (identity_store_id, {SORT_TS}, user_id)',
+    ]),
+    (13, "按租户不区分大小写查邮箱的索引（批量开通去重）", [
+        'CREATE INDEX IF NOT EXISTS idx_users_store_email_lower ON users (identity_store_id, lower(email), email)',
+    ]),
+]
+
+# 表字段白名单（用于投影 / 分组时拼接 SQL）
+INVITE_COLUMNS = {
+    'token', 'status', 'tier', 'entitlement_days', 'created_at', 'expires_at', 'claimed_at',
+    'claimed_email', 'claimed_user_id', 'note', 'identity_store_id', 'sso_url', 'created_ts', 'expires_ts',
+    'job_id'
+}
+USER_COLUMNS = {
+    'user_id', 'username', 'email', 'display_name', 'status', 'tier', 'idc_user_id', 'created_at',
+    'expires_at', 'invite_token', 'identity_store_id', 'sso_url', 'deleted_at', 'expired_at',
+    'created_ts', 'expires_ts'
+}
+
+# 流式读取每批行数
+ITER_BATCH_SIZE = 500
+
+# IN 查询每批参数个数（低于 SQLite 的变量数上限）
+IN_QUERY_BATCH_SIZE = 500
+
+# 允许用于聚合统计的用户字段
+USER_GROUP_COLUMNS = {'status', 'tier', 'identity_store_id'}
+
+
+class ConnectionPool:
+    """
+    有界、线程安全的 SQLite 连接池
+    
+    连接在请求之间复用，每个连接创建时只设置一次 PRAGMA：
+    - WAL 日志模式：读不阻塞写，写不阻塞读
+    - busy_timeout：写锁竞争时等待而不是立即报 database is locked
+    """
+    
+    def __init__(self, db_path: str, max_size: int = 8, busy_timeout_ms: int = 5000, acquire_timeout: float = 30.0):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.acquire_timeout = acquire_timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._all: List[sqlite3.Connection] = []
+        # close() 时递增；借出时的代数已过期的连接在归还时关闭，连接池本身仍可继续使用
+        self._generation = 0
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -8000')
+        with self._lock:
+            self._all.append(conn)
+        return conn
+    
+    def _discard(self, conn: sqlite3.Connection):
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """借出一个连接，用完自动归还（池满时最多等待 acquire_timeout 秒）"""
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"等待数据库连接超时（{self.acquire_timeout:.0f}s）")
+        try:
+            generation = self._generation
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                # 未提交的事务不能带回池里
+                if conn.in_transaction:
+                    conn.rollback()
+                if generation != self._generation:
+                    self._discard(conn)
+                else:
+                    self._idle.put(conn)
+        finally:
+            self._slots.release()
+    
+    def close(self):
+        """关闭所有空闲连接，借出中的连接在归还时关闭（之后借出时重新建立连接）"""
+        self._generation += 1
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
 
 class Database:
     """SQLite 数据库管理"""
@@ -12,100 +257,298 @@ class Database:
     def __init__(self, db_path: str = "data/kiro_invite.db"):
         self.db_path = db_path
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._pool = ConnectionPool(
+            db_path,
+            max_size=settings.SQLITE_POOL_SIZE,
+            busy_timeout_ms=settings.SQLITE_BUSY_TIMEOUT_MS,
+            acquire_timeout=settings.SQLITE_POOL_TIMEOUT_SECONDS
+        )
         self._init_tables()
+        self._run_migrations()
     
-    def _get_conn(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def _get_conn(self):
+        """从连接池借出连接（上下文管理器）"""
+        return self._pool.connection()
+    
+    def close(self):
+        """关闭连接池（应用退出时调用）"""
+        self._pool.close()
     
     def _init_tables(self):
         """初始化数据库表"""
-        conn = self._get_conn()
-        cursor = conn.cursor()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            
+            # 邀请表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS invites (
+                    token TEXT PRIMARY KEY,
+                    status TEXT DEFAULT 'PENDING',
+                    tier TEXT DEFAULT 'Pro',
+                    entitlement_days INTEGER DEFAULT 90,
+                    created_at TEXT,
+                    expires_at TEXT,
+                    claimed_at TEXT,
+                    claimed_email TEXT,
+                    claimed_user_id TEXT,
+                    note TEXT,
+                    identity_store_id TEXT,
+                    sso_url TEXT
+                )
+            ''')
+            
+            # 用户表
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    username TEXT UNIQUE,
+                    email TEXT,
+                    display_name TEXT,
+                    status TEXT DEFAULT 'ACTIVE',
+                    tier TEXT,
+                    idc_user_id TEXT,
+                    created_at TEXT,
+                    expires_at TEXT,
+                    invite_token TEXT,
+                    identity_store_id TEXT,
+                    sso_url TEXT,
+                    deleted_at TEXT,
+                    expired_at TEXT
+                )
+            ''')
+            
+            conn.commit()
+    
+    def schema_version(self) -> int:
+        """当前 schema 版本"""
+        with self._get_conn() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def _run_migrations(self):
+        """按版本顺序执行未应用的迁移，每个迁移一个事务"""
+        with self._get_conn() as conn:
+            for version, description, statements in MIGRATIONS:
+                # BEGIN IMMEDIATE 拿写锁，避免多个进程同时迁移
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    current = conn.execute('PRAGMA user_version').fetchone()[0]
+                    if current >= version:
+                        conn.rollback()
+                        continue
+                    for step in statements:
+                        if callable(step):
+                            step(conn)
+                        else:
+                            conn.execute(step)
+                    conn.execute(f'PRAGMA user_version = {int(version)}')
+                    conn.commit()
+                    print(f"数据库迁移 v{version}: {description}")
+                except Exception:
+                    conn.rollback()
+                    raise
+    
+    def run_data_migrations(self) -> Dict:
+        """SQLite 的数据回填包含在版本迁移中，连接时已自动执行"""
+        self._run_migrations()
+        with self._get_conn() as conn:
+            return {"user_version": conn.execute('PRAGMA user_version').fetchone()[0]}
+    
+    def _keyset_page(
+        self,
+        table: str,
+        key: str,
+        identity_store_id: Optional[str],
+        status: Optional[str],
+        limit: int,
+        position: Optional[Dict]
+    ) -> Tuple[List[Dict], Optional[Dict]]:
+        """按 (COALESCE(created_ts, 0), 主键) 倒序的键集分页，返回 (本页数据, 下一页位置)"""
+        query = f'SELECT * FROM {table} WHERE 1=1'
+        params: List[Any] = []
         
-        # 邀请表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS invites (
-                token TEXT PRIMARY KEY,
-                status TEXT DEFAULT 'PENDING',
-                tier TEXT DEFAULT 'Pro',
-                entitlement_days INTEGER DEFAULT 90,
-                created_at TEXT,
-                expires_at TEXT,
-                claimed_at TEXT,
-                claimed_email TEXT,
-                claimed_user_id TEXT,
-                note TEXT,
-                identity_store_id TEXT,
-                sso_url TEXT
-            )
-        ''')
+        if identity_store_id:
+            query += ' AND identity_store_id = ?'
+            params.append(identity_store_id)
+        if status:
+            query += ' AND status = ?'
+            params.append(status)
+        if position:
+            # 游标来自客户端，只接受 {created_ts: 整数, 主键: 字符串}，否则绑定参数时会报错
+            ts = position.get('created_ts')
+            if (
+                set(position) != {'created_ts', key}
+                or not isinstance(ts, int) or isinstance(ts, bool)
+                or not isinstance(position[key], str)
+            ):
+                raise ValueError("无效的分页游标")
+            query += f' AND ({SORT_TS}, {key}) < (?, ?)'
+            params.extend([ts, position[key]])
         
-        # 用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                username TEXT UNIQUE,
-                email TEXT,
-                display_name TEXT,
-                status TEXT DEFAULT 'ACTIVE',
-                tier TEXT,
-                idc_user_id TEXT,
-                created_at TEXT,
-                expires_at TEXT,
-                invite_token TEXT,
-                identity_store_id TEXT,
-                sso_url TEXT,
-                deleted_at TEXT,
-                expired_at TEXT
-            )
-        ''')
+        # 多取一条判断是否还有下一页
+        query += f' ORDER BY {SORT_TS} DESC, {key} DESC LIMIT ?'
+        params.append(limit + 1)
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = [dict(row) for row in cursor.fetchall()]
+        
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, {'created_ts': last['created_ts'] or 0, key: last[key]}
+    
+    def _stream(
+        self,
+        table: str,
+        select: str,
+        where: str,
+        params: List[Any],
+        order_by: Tuple[str, ...] = ('rowid',)
+    ) -> Iterator[Dict]:
+        """
+        按 order_by 键集分批读取（最后一列须唯一），不在内存中构建整个结果集
+        
+        每批单独借出连接、取完即归还：导出的慢客户端或逐条调用 IDC 的清理任务不会长期占用连接池
+        """
+        keys = ', '.join(order_by)
+        hidden = ', '.join(f'{k} AS _k{i}' for i, k in enumerate(order_by))
+        base = f'SELECT {hidden}, {select} FROM {table} WHERE {where}'
+        position: Optional[List[Any]] = None
+        while True:
+            query, args = base, list(params)
+            if position is not None:
+                query += f' AND ({keys}) > ({", ".join("?" * len(order_by))})'
+                args.extend(position)
+            query += f' ORDER BY {keys} LIMIT ?'
+            args.append(ITER_BATCH_SIZE)
+            with self._get_conn() as conn:
+                rows = conn.execute(query, args).fetchall()
+            for row in rows:
+                record = dict(row)
+                position = [record.pop(f'_k{i}') for i in range(len(order_by))]
+                yield record
+            if len(rows) < ITER_BATCH_SIZE:
+                return
+    
+    def _iter_rows(
+        self,
+        table: str,
+        columns: set,
+        identity_store_id: Optional[str],
+        status: Optional[str],
+        attributes: Optional[List[str]]
+    ) -> Iterator[Dict]:
+        """按租户 / 状态流式读取整表"""
+        if attributes and not set(attributes) <= columns:
+            raise ValueError(f"未知字段: {set(attributes) - columns}")
+        select = ', '.join(attributes) if attributes else '*'
+        where = '1=1'
+        params = []
+        
+        if identity_store_id:
+            where += ' AND identity_store_id = ?'
+            params.append(identity_store_id)
+        if status:
+            where += ' AND status = ?'
+            params.append(status)
         
-        conn.commit()
-        conn.close()
+        return self._stream(table, select, where, params)
     
     # ==================== 邀请操作 ====================
     
+    _INVITE_INSERT_SQL = '''
+        INSERT INTO invites (token, status, tier, entitlement_days, created_at,
+            expires_at, note, identity_store_id, sso_url, created_ts, expires_ts, job_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    @staticmethod
+    def _invite_row(invite: Dict) -> tuple:
+        created_at = invite.get('created_at', datetime.now().isoformat())
+        return (
+            invite['token'],
+            invite.get('status', 'PENDING'),
+            invite.get('tier', 'Pro'),
+            invite.get('entitlement_days', 90),
+            created_at,
+            invite.get('expires_at'),
+            invite.get('note'),
+            invite.get('identity_store_id'),
+            invite.get('sso_url'),
+            to_epoch(created_at),
+            to_epoch(invite.get('expires_at')),
+            invite.get('job_id')
+        )
+    
     def insert_invite(self, invite: Dict) -> bool:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO invites (token, status, tier, entitlement_days, created_at, 
-                    expires_at, note, identity_store_id, sso_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                invite['token'],
-                invite.get('status', 'PENDING'),
-                invite.get('tier', 'Pro'),
-                invite.get('entitlement_days', 90),
-                invite.get('created_at', datetime.now().isoformat()),
-                invite.get('expires_at'),
-                invite.get('note'),
-                invite.get('identity_store_id'),
-                invite.get('sso_url')
-            ))
-            conn.commit()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self._INVITE_INSERT_SQL, self._invite_row(invite))
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"插入邀请失败: {e}")
+                return False
+    
+    def insert_invites_many(self, invites: List[Dict]) -> bool:
+        """批量插入邀请（单个事务，全部成功或全部失败）"""
+        if not invites:
             return True
-        except Exception as e:
-            print(f"插入邀请失败: {e}")
-            return False
-        finally:
-            conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(self._INVITE_INSERT_SQL, [self._invite_row(i) for i in invites])
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"批量插入邀请失败: {e}")
+                return False
     
     def get_invite(self, token: str) -> Optional[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM invites WHERE token = ?', (token,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM invites WHERE token = ?', (token,))
+            row = cursor.fetchone()
         return dict(row) if row else None
     
+    def iter_invites(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        attributes: Optional[List[str]] = None,
+        segments: int = 1
+    ) -> Iterator[Dict]:
+        """流式遍历邀请（不排序；segments 仅 DynamoDB 使用）"""
+        return self._iter_rows('invites', INVITE_COLUMNS, identity_store_id, status, attributes)
+    
+    def iter_invites_by_job(self, job_id: str, attributes: Optional[List[str]] = None) -> Iterator[Dict]:
+        """流式遍历某个批量任务生成的邀请"""
+        if attributes and not set(attributes) <= INVITE_COLUMNS:
+            raise ValueError(f"未知字段: {set(attributes) - INVITE_COLUMNS}")
+        select = ', '.join(attributes) if attributes else '*'
+        return self._stream('invites', select, 'job_id = ?', [job_id])
+    
+    def count_invites_by_job(self, job_id: str) -> int:
+        with self._get_conn() as conn:
+            return conn.execute('SELECT COUNT(*) FROM invites WHERE job_id = ?', (job_id,)).fetchone()[0]
+    
+    def count_existing_invites(self, tokens: List[str]) -> int:
+        """统计给定令牌中已写入的邀请数（按主键查询）"""
+        tokens = list(dict.fromkeys(tokens))
+        count = 0
+        with self._get_conn() as conn:
+            for start in range(0, len(tokens), IN_QUERY_BATCH_SIZE):
+                chunk = tokens[start:start + IN_QUERY_BATCH_SIZE]
+                count += conn.execute(
+                    f'SELECT COUNT(*) FROM invites WHERE token IN ({", ".join("?" * len(chunk))})', chunk
+                ).fetchone()[0]
+        return count
+    
     def get_invites(self, identity_store_id: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        
         query = 'SELECT * FROM invites WHERE 1=1'
         params = []
         
@@ -116,97 +559,154 @@ class Database:
             query += ' AND status = ?'
             params.append(status)
         
-        query += ' ORDER BY created_at DESC'
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        query += f' ORDER BY {SORT_TS} DESC'
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
     
+    def get_invites_page(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """分页获取邀请，返回 (本页数据, next_cursor)"""
+        items, position = self._keyset_page(
+            'invites', 'token', identity_store_id, status, limit, decode_cursor(cursor)
+        )
+        return items, encode_cursor(position)
+    
     def update_invite(self, token: str, updates: Dict) -> bool:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        
+        updates = with_epochs(updates)
         set_clause = ', '.join([f'{k} = ?' for k in updates.keys()])
         values = list(updates.values()) + [token]
         
-        cursor.execute(f'UPDATE invites SET {set_clause} WHERE token = ?', values)
-        conn.commit()
-        affected = cursor.rowcount
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'UPDATE invites SET {set_clause} WHERE token = ?', values)
+            conn.commit()
+            affected = cursor.rowcount
         return affected > 0
     
     # ==================== 用户操作 ====================
     
+    _USER_INSERT_SQL = '''
+        INSERT INTO users (user_id, username, email, display_name, status, tier,
+            idc_user_id, created_at, expires_at, invite_token, identity_store_id, sso_url,
+            created_ts, expires_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    
+    @staticmethod
+    def _user_row(user: Dict) -> tuple:
+        created_at = user.get('created_at', datetime.now().isoformat())
+        return (
+            user['user_id'],
+            user['username'],
+            user['email'],
+            user.get('display_name'),
+            user.get('status', 'ACTIVE'),
+            user.get('tier'),
+            user.get('idc_user_id'),
+            created_at,
+            user.get('expires_at'),
+            user.get('invite_token'),
+            user.get('identity_store_id'),
+            user.get('sso_url'),
+            to_epoch(created_at),
+            to_epoch(user.get('expires_at'))
+        )
+    
     def insert_user(self, user: Dict) -> bool:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                INSERT INTO users (user_id, username, email, display_name, status, tier,
-                    idc_user_id, created_at, expires_at, invite_token, identity_store_id, sso_url)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user['user_id'],
-                user['username'],
-                user['email'],
-                user.get('display_name'),
-                user.get('status', 'ACTIVE'),
-                user.get('tier'),
-                user.get('idc_user_id'),
-                user.get('created_at', datetime.now().isoformat()),
-                user.get('expires_at'),
-                user.get('invite_token'),
-                user.get('identity_store_id'),
-                user.get('sso_url')
-            ))
-            conn.commit()
-            return True
-        except Exception as e:
-            print(f"插入用户失败: {e}")
-            return False
-        finally:
-            conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self._USER_INSERT_SQL, self._user_row(user))
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"插入用户失败: {e}")
+                return False
     
     def get_user(self, user_id: str) -> Optional[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
         return dict(row) if row else None
     
     def get_user_by_email(self, email: str, identity_store_id: Optional[str] = None) -> Optional[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        
-        if identity_store_id:
-            cursor.execute('SELECT * FROM users WHERE email = ? AND identity_store_id = ?', 
-                          (email, identity_store_id))
-        else:
-            cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            
+            if identity_store_id:
+                cursor.execute('SELECT * FROM users WHERE email = ? AND identity_store_id = ?',
+                              (email, identity_store_id))
+            else:
+                cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
+            
+            row = cursor.fetchone()
         return dict(row) if row else None
     
     def get_user_by_username(self, username: str, identity_store_id: Optional[str] = None) -> Optional[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        
-        if identity_store_id:
-            cursor.execute('SELECT * FROM users WHERE username = ? AND identity_store_id = ?',
-                          (username, identity_store_id))
-        else:
-            cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            
+            if identity_store_id:
+                cursor.execute('SELECT * FROM users WHERE username = ? AND identity_store_id = ?',
+                              (username, identity_store_id))
+            else:
+                cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+            
+            row = cursor.fetchone()
         return dict(row) if row else None
     
-    def get_users(self, identity_store_id: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
-        conn = self._get_conn()
-        cursor = conn.cursor()
+    def find_existing_emails(self, identity_store_id: Optional[str], emails: List[str]) -> Set[str]:
+        """
+        返回同租户下已注册的邮箱（不区分大小写，返回小写形式）
+        走 (identity_store_id, lower(email)) 索引，分批 IN 查询
+        """
+        emails = list(dict.fromkeys(e.lower() for e in emails))
+        found: Set[str] = set()
+        with self._get_conn() as conn:
+            for start in range(0, len(emails), IN_QUERY_BATCH_SIZE):
+                chunk = emails[start:start + IN_QUERY_BATCH_SIZE]
+                rows = conn.execute(
+                    f'SELECT lower(email) AS email FROM users '
+                    f'WHERE identity_store_id IS ? AND lower(email) IN ({", ".join("?" * len(chunk))})',
+                    [identity_store_id, *chunk]
+                ).fetchall()
+                found.update(row['email'] for row in rows)
+        return found
+    
+    def iter_users(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        attributes: Optional[List[str]] = None,
+        segments: int = 1
+    ) -> Iterator[Dict]:
+        """流式遍历用户（不排序；segments 仅 DynamoDB 使用）"""
+        return self._iter_rows('users', USER_COLUMNS, identity_store_id, status, attributes)
+    
+    def iter_users_expiring_before(self, before: int, after: Optional[int] = None) -> Iterator[Dict]:
+        """
+        按过期时间升序遍历 ACTIVE 用户：after <= expires_ts < before（epoch 秒）
+        走 (status, expires_ts, user_id) 索引的范围扫描
+        """
+        where = "status = 'ACTIVE' AND expires_ts < ?"
+        params = [before]
+        if after is not None:
+            where += ' AND expires_ts >= ?'
+            params.append(after)
         
+        return self._stream('users', '*', where, params, order_by=('expires_ts', 'user_id'))
+    
+    def get_users(self, identity_store_id: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
         query = 'SELECT * FROM users WHERE 1=1'
         params = []
         
@@ -217,32 +717,423 @@ class Database:
             query += ' AND status = ?'
             params.append(status)
         
-        query += ' ORDER BY created_at DESC'
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        query += f' ORDER BY {SORT_TS} DESC'
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
         return [dict(row) for row in rows]
     
-    def update_user(self, user_id: str, updates: Dict) -> bool:
-        conn = self._get_conn()
-        cursor = conn.cursor()
+    def get_users_page(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """分页获取用户，返回 (本页数据, next_cursor)"""
+        items, position = self._keyset_page(
+            'users', 'user_id', identity_store_id, status, limit, decode_cursor(cursor)
+        )
+        return items, encode_cursor(position)
+    
+    def count_users_grouped(self, by: List[str]) -> List[Dict]:
+        """
+        单次 GROUP BY 统计用户数
+        返回 [{<分组字段>: 值, ..., "count": n}, ...]
+        """
+        columns = [c for c in by if c in USER_GROUP_COLUMNS]
+        if len(columns) != len(by):
+            raise ValueError(f"不支持的分组字段: {set(by) - USER_GROUP_COLUMNS}")
         
+        select = ', '.join(columns + ['COUNT(*) AS count'])
+        query = f'SELECT {select} FROM users'
+        if columns:
+            query += f" GROUP BY {', '.join(columns)}"
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query)
+            rows = cursor.fetchall()
+        return [dict(row) for row in rows]
+    
+    def update_user(self, user_id: str, updates: Dict) -> bool:
+        updates = with_epochs(updates)
         set_clause = ', '.join([f'{k} = ?' for k in updates.keys()])
         values = list(updates.values()) + [user_id]
         
-        cursor.execute(f'UPDATE users SET {set_clause} WHERE user_id = ?', values)
-        conn.commit()
-        affected = cursor.rowcount
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'UPDATE users SET {set_clause} WHERE user_id = ?', values)
+            conn.commit()
+            affected = cursor.rowcount
         return affected > 0
     
+    # ==================== 邀请批量任务 ====================
+    
+    @staticmethod
+    def _invite_job(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        job['params'] = json.loads(job['params'])
+        if job.get('pending_tokens') is not None:
+            job['pending_tokens'] = json.loads(job['pending_tokens'])
+        return job
+    
+    def insert_invite_job(self, job: Dict) -> bool:
+        with self._get_conn() as conn:
+            try:
+                conn.execute(
+                    '''
+                        INSERT INTO invite_jobs (job_id, status, total, created, params, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ''',
+                    (
+                        job['job_id'], job['status'], job['total'], job.get('created', 0),
+                        json.dumps(job['params'], ensure_ascii=False), job['created_at'], job['created_at']
+                    )
+                )
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"创建批量任务失败: {e}")
+                return False
+    
+    def get_invite_job(self, job_id: str) -> Optional[Dict]:
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT * FROM invite_jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return self._invite_job(row) if row else None
+    
+    def get_unfinished_invite_jobs(self) -> List[Dict]:
+        """未完成（PENDING / RUNNING）的批量任务，按创建时间顺序"""
+        with self._get_conn() as conn:
+            rows = conn.execute(
+                "SELECT * FROM invite_jobs WHERE status IN ('PENDING', 'RUNNING') ORDER BY created_at"
+            ).fetchall()
+        return [self._invite_job(row) for row in rows]
+    
+    def update_invite_job(self, job_id: str, updates: Dict) -> bool:
+        updates = dict(updates, updated_at=datetime.now().isoformat())
+        if updates.get('pending_tokens') is not None:
+            updates['pending_tokens'] = json.dumps(updates['pending_tokens'])
+        set_clause = ', '.join([f'{k} = ?' for k in updates.keys()])
+        with self._get_conn() as conn:
+            cursor = conn.execute(
+                f'UPDATE invite_jobs SET {set_clause} WHERE job_id = ?',
+                list(updates.values()) + [job_id]
+            )
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    # ==================== 断点 ====================
+    
+    def get_checkpoint(self, name: str) -> Optional[Dict]:
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT data FROM checkpoints WHERE name = ?', (name,)).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def save_checkpoint(self, name: str, data: Dict, fencing_token: Optional[int] = None) -> bool:
+        """
+        保存断点；带 fencing_token 时，已被更新的租约持有者写过的断点不会被覆盖
+        返回是否写入
+        """
+        with self._get_conn() as conn:
+            cursor = conn.execute(
+                '''
+                    INSERT INTO checkpoints (name, data, updated_at, fencing_token) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        data = excluded.data, updated_at = excluded.updated_at, fencing_token = excluded.fencing_token
+                    WHERE excluded.fencing_token IS NULL OR checkpoints.fencing_token IS NULL
+                        OR checkpoints.fencing_token <= excluded.fencing_token
+                ''',
+                (name, json.dumps(data, ensure_ascii=False), from_epoch(now_epoch()).isoformat(), fencing_token)
+            )
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    def delete_checkpoint(self, name: str) -> bool:
+        with self._get_conn() as conn:
+            cursor = conn.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    # ==================== 租约 ====================
+    
+    def acquire_lease(self, name: str, holder: str, ttl_seconds: float) -> Optional[int]:
+        """
+        获取（或续期）租约：不存在、已过期或本就由 holder 持有时成功
+        返回单调递增的 fencing token，被其他实例持有时返回 None
+        """
+        now = time.time()
+        with self._get_conn() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute(
+                    'SELECT holder, fencing_token, expires_at FROM leases WHERE name = ?', (name,)
+                ).fetchone()
+                if row and row['holder'] != holder and row['expires_at'] > now:
+                    conn.rollback()
+                    return None
+                
+                token = (row['fencing_token'] if row else 0) + 1
+                conn.execute(
+                    '''
+                        INSERT INTO leases (name, holder, fencing_token, expires_at) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(name) DO UPDATE SET
+                            holder = excluded.holder, fencing_token = excluded.fencing_token, expires_at = excluded.expires_at
+                    ''',
+                    (name, holder, token, now + ttl_seconds)
+                )
+                conn.commit()
+                return token
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def release_lease(self, name: str, holder: str, fencing_token: int) -> bool:
+        """释放租约（保留行以延续 fencing token 序列）；已被他人接管时不做任何事"""
+        with self._get_conn() as conn:
+            cursor = conn.execute(
+                'UPDATE leases SET holder = NULL, expires_at = 0 WHERE name = ? AND holder = ? AND fencing_token = ?',
+                (name, holder, fencing_token)
+            )
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    # ==================== 异步开通队列 ====================
+    
+    def get_provision_task(self, token: str) -> Optional[Dict]:
+        with self._get_conn() as conn:
+            row = conn.execute('SELECT * FROM provision_tasks WHERE token = ?', (token,)).fetchone()
+        return dict(row) if row else None
+    
+    def lease_provision_tasks(self, holder: str, limit: int, lease_seconds: float) -> List[Dict]:
+        """
+        取出最多 limit 个到期任务并标记为 RUNNING（due_at 改为租约到期时间，attempts 加一）
+        到期包括等待重试的 PENDING 任务和租约已过期（执行者崩溃）的 RUNNING 任务
+        """
+        now = time.time()
+        with self._get_conn() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                rows = conn.execute(
+                    'SELECT * FROM provision_tasks WHERE due_at IS NOT NULL AND due_at <= ? ORDER BY due_at LIMIT ?',
+                    (now, limit)
+                ).fetchall()
+                tasks = []
+                for row in rows:
+                    task = dict(row, status='RUNNING', attempts=row['attempts'] + 1, due_at=now + lease_seconds, locked_by=holder)
+                    conn.execute(
+                        '''
+                            UPDATE provision_tasks SET status = ?, attempts = ?, due_at = ?, locked_by = ?, updated_at = ?
+                            WHERE token = ?
+                        ''',
+                        (task['status'], task['attempts'], task['due_at'], holder, datetime.now().isoformat(), task['token'])
+                    )
+                    tasks.append(task)
+                conn.commit()
+                return tasks
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def release_provision_task(
+        self,
+        token: str,
+        holder: str,
+        status: str,
+        due_at: Optional[float] = None,
+        error: Optional[str] = None
+    ) -> bool:
+        """
+        结束一次执行：PENDING 时在 due_at 重新入队，其余状态出队
+        只有仍持有该任务的 holder 才能更新（租约过期被他人接管后不覆盖）
+        """
+        with self._get_conn() as conn:
+            cursor = conn.execute(
+                '''
+                    UPDATE provision_tasks SET status = ?, due_at = ?, error = ?, locked_by = NULL, updated_at = ?
+                    WHERE token = ? AND locked_by = ?
+                ''',
+                (status, due_at if status == 'PENDING' else None, error, datetime.now().isoformat(), token, holder)
+            )
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    # ==================== 幂等键 ====================
+    
+    @staticmethod
+    def _idempotency_record(row: sqlite3.Row) -> Dict:
+        record = dict(row)
+        record['response'] = json.loads(record['response']) if record['response'] else None
+        return record
+    
+    def get_idempotency_key(self, key: str) -> Optional[Dict]:
+        """读取未过期的幂等记录（不占用）"""
+        with self._get_conn() as conn:
+            row = conn.execute(
+                'SELECT * FROM idempotency_keys WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+        return self._idempotency_record(row) if row else None
+    
+    def reserve_idempotency_key(self, key: str, fingerprint: str, ttl_seconds: float) -> Optional[Dict]:
+        """
+        占用幂等键（写入 INFLIGHT 记录）；成功返回 None
+        键已存在且未过期时不写入，返回已有记录（INFLIGHT 或 DONE）
+        """
+        now = time.time()
+        with self._get_conn() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT * FROM idempotency_keys WHERE key = ?', (key,)).fetchone()
+                if row and row['expires_at'] > now:
+                    conn.rollback()
+                    return self._idempotency_record(row)
+                conn.execute(
+                    '''
+                        INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, status_code, response, expires_at)
+                        VALUES (?, ?, 'INFLIGHT', NULL, NULL, ?)
+                    ''',
+                    (key, fingerprint, now + ttl_seconds)
+                )
+                conn.commit()
+                return None
+            except Exception:
+                conn.rollback()
+                raise
+    
+    def complete_idempotency_key(self, key: str, fingerprint: str, status_code: int, response: Dict,
+                                 ttl_seconds: float) -> bool:
+        """保存响应（覆盖处理中标记），之后相同键的请求直接重放"""
+        with self._get_conn() as conn:
+            conn.execute(
+                '''
+                    INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, status_code, response, expires_at)
+                    VALUES (?, ?, 'DONE', ?, ?, ?)
+                ''',
+                (key, fingerprint, status_code, json.dumps(response, ensure_ascii=False), time.time() + ttl_seconds)
+            )
+            conn.commit()
+        return True
+    
+    def delete_idempotency_key(self, key: str) -> bool:
+        with self._get_conn() as conn:
+            cursor = conn.execute('DELETE FROM idempotency_keys WHERE key = ?', (key,))
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    def purge_expired_idempotency_keys(self) -> int:
+        with self._get_conn() as conn:
+            cursor = conn.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (time.time(),))
+            conn.commit()
+        return cursor.rowcount
+    
+    # ==================== 认领事务 ====================
+    
+    def claim_invite_atomic(
+        self, token: str, user: Dict, enqueue: bool = False, idempotency_key: Optional[str] = None
+    ) -> ClaimResult:
+        """
+        单个事务完成认领：条件更新邀请（仍为 PENDING）、检查同租户邮箱唯一、写入用户
+        enqueue 时同一事务写入开通任务（异步开通模式），idempotency_key 为认领请求的幂等键
+        任一步失败整体回滚，返回冲突类型
+        """
+        with self._get_conn() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                cursor = conn.execute(
+                    '''
+                        UPDATE invites SET status = 'CLAIMED', claimed_at = ?, claimed_email = ?, claimed_user_id = ?
+                        WHERE token = ? AND status = 'PENDING'
+                    ''',
+                    (user.get('created_at'), user['email'], user['user_id'], token)
+                )
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return ClaimResult.INVITE_UNAVAILABLE
+                
+                taken = conn.execute(
+                    'SELECT 1 FROM users WHERE identity_store_id IS ? AND email = ? LIMIT 1',
+                    (user.get('identity_store_id'), user['email'])
+                ).fetchone()
+                if taken:
+                    conn.rollback()
+                    return ClaimResult.EMAIL_TAKEN
+                
+                conn.execute(self._USER_INSERT_SQL, self._user_row(user))
+                if enqueue:
+                    # 邀请的条件更新保证同一令牌只有一个进行中的任务，之前失败的任务直接覆盖
+                    now = datetime.now().isoformat()
+                    conn.execute(
+                        '''
+                            INSERT OR REPLACE INTO provision_tasks
+                                (token, user_id, status, attempts, due_at, idempotency_key, created_at, updated_at)
+                            VALUES (?, ?, 'PENDING', 0, ?, ?, ?, ?)
+                        ''',
+                        (token, user['user_id'], time.time(), idempotency_key, now, now)
+                    )
+                conn.commit()
+                return ClaimResult.CLAIMED
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return ClaimResult.USERNAME_TAKEN
+            except Exception as e:
+                conn.rollback()
+                print(f"认领事务失败: {e}")
+                return ClaimResult.FAILED
+    
+    def insert_user_unique(self, user: Dict) -> ClaimResult:
+        """
+        写入用户（不关联邀请，用于批量开通）：同租户邮箱已注册时不写入
+        返回 CLAIMED 表示写入成功，否则为冲突类型
+        """
+        with self._get_conn() as conn:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                taken = conn.execute(
+                    'SELECT 1 FROM users WHERE identity_store_id IS ? AND email = ? LIMIT 1',
+                    (user.get('identity_store_id'), user['email'])
+                ).fetchone()
+                if taken:
+                    conn.rollback()
+                    return ClaimResult.EMAIL_TAKEN
+                
+                conn.execute(self._USER_INSERT_SQL, self._user_row(user))
+                conn.commit()
+                return ClaimResult.CLAIMED
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return ClaimResult.USERNAME_TAKEN
+            except Exception as e:
+                conn.rollback()
+                print(f"写入用户失败: {e}")
+                return ClaimResult.FAILED
+    
+    def release_invite_claim(self, token: str, user: Dict) -> bool:
+        """撤销认领（IDC 开通失败时的补偿）：邀请恢复 PENDING，删除用户"""
+        with self._get_conn() as conn:
+            try:
+                conn.execute(
+                    '''
+                        UPDATE invites SET status = 'PENDING', claimed_at = NULL, claimed_email = NULL,
+                            claimed_user_id = NULL
+                        WHERE token = ? AND claimed_user_id = ?
+                    ''',
+                    (token, user['user_id'])
+                )
+                conn.execute('DELETE FROM users WHERE user_id = ?', (user['user_id'],))
+                conn.commit()
+                return True
+            except Exception as e:
+                conn.rollback()
+                print(f"撤销认领失败: {e}")
+                return False
+    
     def delete_user(self, user_id: str) -> bool:
-        conn = self._get_conn()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        conn.commit()
-        affected = cursor.rowcount
-        conn.close()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            conn.commit()
+            affected = cursor.rowcount
         return affected > 0
 
 
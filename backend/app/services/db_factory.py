@@ -6,4 +6,9 @@ if settings.USE_DYNAMODB:
 else:
     from app.services.database import db
 
-__all__ = ['db']
+from app.services.async_db import AsyncDB
+
+# 路由中使用 async_db，避免同步 I/O 阻塞事件循环
+async_db = AsyncDB(db)
+
+__all__ = ['db', 'async_db']
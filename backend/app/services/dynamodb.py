@@ -1,37 +1,161 @@
 """DynamoDB 数据库服务"""
-import boto3
-from typing import Dict, List, Optional
+import json
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Attr, Key
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 from datetime import datetime
 from app.config import settings
+from app.models.invite import ClaimResult
+from app.services.aws_clients import get_client, get_resource
+from app.services.pagination import DEFAULT_PAGE_SIZE, encode_cursor, decode_cursor
+from app.services.timeutil import EPOCH_FIELDS, from_epoch, now_epoch, with_epochs
+
+
+BATCH_WRITE_LIMIT = 25  # BatchWriteItem 单次最多 25 条
+BATCH_GET_LIMIT = 100  # BatchGetItem 单次最多 100 个键
+
+# 旧数据回填的版本号（完成后记录在元数据表 migration#<版本>）
+DATA_MIGRATION = 'data_backfill_v1'
+BATCH_WRITE_MAX_RETRIES = 8
+
+# epoch 秒时间属性（由 ISO 字段换算，见 timeutil）
+EPOCH_ATTRS = set(EPOCH_FIELDS.values())
+
+# 邀请表 GSI：按批量任务查询生成的邀请（只有任务生成的邀请带 job_id，是稀疏索引）
+INVITE_JOB_INDEX = 'job-index'
+INVITE_INDEXES = [
+    {
+        'IndexName': INVITE_JOB_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'job_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'token', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+]
+INVITE_ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'token', 'AttributeType': 'S'},
+    {'AttributeName': 'job_id', 'AttributeType': 'S'}
+]
+
+# 异步开通队列：进行中（PENDING / RUNNING）的任务带 queue_partition 属性，
+# 按 due_at（毫秒，等待重试的到期时间或执行租约的到期时间）查询到期任务
+PROVISION_DUE_INDEX = 'due-index'
+QUEUE_PARTITION_ATTR = 'queue_partition'
+QUEUE_PARTITION_QUEUED = 'QUEUED'
+PROVISION_QUEUE_INDEXES = [
+    {
+        'IndexName': PROVISION_DUE_INDEX,
+        'KeySchema': [
+            {'AttributeName': QUEUE_PARTITION_ATTR, 'KeyType': 'HASH'},
+            {'AttributeName': 'due_at', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+]
+PROVISION_QUEUE_ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'token', 'AttributeType': 'S'},
+    {'AttributeName': QUEUE_PARTITION_ATTR, 'AttributeType': 'S'},
+    {'AttributeName': 'due_at', 'AttributeType': 'N'}
+]
+
+# 允许用于聚合统计的用户字段
+USER_GROUP_COLUMNS = {'status', 'tier', 'identity_store_id'}
+
+# 用户表 GSI：按租户查邮箱 / 用户名（与 template.yaml 保持一致）
+USER_EMAIL_INDEX = 'store-email-index'
+USER_USERNAME_INDEX = 'store-username-index'
+USER_INDEXES = [
+    {
+        'IndexName': USER_EMAIL_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'identity_store_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'email', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    },
+    {
+        'IndexName': USER_USERNAME_INDEX,
+        'KeySchema': [
+            {'AttributeName': 'identity_store_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'username', 'KeyType': 'RANGE'}
+        ],
+        'Projection': {'ProjectionType': 'ALL'}
+    }
+]
+# 稀疏过期索引：只有 ACTIVE 用户带 expiry_partition 属性，清理任务只查询到期的这部分
+# 排序键为 epoch 秒 expires_ts（取代按 ISO 字符串排序的旧索引 expiry-index）
+USER_EXPIRY_INDEX = 'expiry-ts-index'
+EXPIRY_PARTITION_ATTR = 'expiry_partition'
+EXPIRY_PARTITION_ACTIVE = 'ACTIVE'
+USER_INDEXES.append({
+    'IndexName': USER_EXPIRY_INDEX,
+    'KeySchema': [
+        {'AttributeName': EXPIRY_PARTITION_ATTR, 'KeyType': 'HASH'},
+        {'AttributeName': 'expires_ts', 'KeyType': 'RANGE'}
+    ],
+    'Projection': {'ProjectionType': 'ALL'}
+})
+USER_ATTRIBUTE_DEFINITIONS = [
+    {'AttributeName': 'user_id', 'AttributeType': 'S'},
+    {'AttributeName': 'identity_store_id', 'AttributeType': 'S'},
+    {'AttributeName': 'email', 'AttributeType': 'S'},
+    {'AttributeName': 'username', 'AttributeType': 'S'},
+    {'AttributeName': EXPIRY_PARTITION_ATTR, 'AttributeType': 'S'},
+    {'AttributeName': 'expires_ts', 'AttributeType': 'N'}
+]
 
 
 class DynamoDB:
     """DynamoDB 数据库管理"""
     
     def __init__(self):
-        self._client = None
-        self._resource = None
         self.table_prefix = settings.DYNAMODB_TABLE_PREFIX or "kiro_invite"
+        self._tables: Dict[str, object] = {}
+        self._migration_checked = False
     
     @property
     def client(self):
-        if self._client is None:
-            self._client = boto3.client('dynamodb', region_name=settings.AWS_REGION)
-        return self._client
+        return get_client('dynamodb')
     
     @property
     def resource(self):
-        if self._resource is None:
-            self._resource = boto3.resource('dynamodb', region_name=settings.AWS_REGION)
-        return self._resource
+        return get_resource('dynamodb')
+    
+    def close(self):
+        """释放缓存的 Table 对象（底层连接由 aws_clients 统一关闭）"""
+        self._tables.clear()
+    
+    def _table(self, suffix: str):
+        """Table 对象按表名缓存，避免每次属性访问都重新构建"""
+        table = self._tables.get(suffix)
+        if table is None:
+            table = self._tables[suffix] = self.resource.Table(f"{self.table_prefix}_{suffix}")
+        return table
     
     @property
     def invites_table(self):
-        return self.resource.Table(f"{self.table_prefix}_invites")
+        return self._table('invites')
+    
+    @property
+    def uniques_table(self):
+        return self._table('uniques')
+    
+    @property
+    def meta_table(self):
+        return self._table('meta')
     
     @property
     def users_table(self):
-        return self.resource.Table(f"{self.table_prefix}_users")
+        return self._table('users')
+    
+    @property
+    def provision_queue_table(self):
+        return self._table('provision_queue')
     
     def init_tables(self):
         """创建 DynamoDB 表（首次部署时运行）"""
@@ -43,10 +167,13 @@ class DynamoDB:
             self.client.create_table(
                 TableName=invites_table,
                 KeySchema=[{'AttributeName': 'token', 'KeyType': 'HASH'}],
-                AttributeDefinitions=[{'AttributeName': 'token', 'AttributeType': 'S'}],
+                AttributeDefinitions=INVITE_ATTRIBUTE_DEFINITIONS,
+                GlobalSecondaryIndexes=INVITE_INDEXES,
                 BillingMode='PAY_PER_REQUEST'
             )
             print(f"创建表: {invites_table}")
+        else:
+            self._ensure_indexes(invites_table, INVITE_INDEXES, INVITE_ATTRIBUTE_DEFINITIONS)
         
         # 用户表
         users_table = f"{self.table_prefix}_users"
@@ -54,21 +181,407 @@ class DynamoDB:
             self.client.create_table(
                 TableName=users_table,
                 KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
-                AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'}],
+                AttributeDefinitions=USER_ATTRIBUTE_DEFINITIONS,
+                GlobalSecondaryIndexes=USER_INDEXES,
                 BillingMode='PAY_PER_REQUEST'
             )
             print(f"创建表: {users_table}")
+        else:
+            self._ensure_indexes(users_table, USER_INDEXES, USER_ATTRIBUTE_DEFINITIONS)
+        
+        # 唯一约束表（邮箱占位，供事务写入做唯一性检查）
+        uniques_table = f"{self.table_prefix}_uniques"
+        if uniques_table not in existing:
+            self.client.create_table(
+                TableName=uniques_table,
+                KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            print(f"创建表: {uniques_table}")
+        
+        # 元数据表（后台任务断点等小型键值记录）
+        meta_table = f"{self.table_prefix}_meta"
+        if meta_table not in existing:
+            self.client.create_table(
+                TableName=meta_table,
+                KeySchema=[{'AttributeName': 'pk', 'KeyType': 'HASH'}],
+                AttributeDefinitions=[{'AttributeName': 'pk', 'AttributeType': 'S'}],
+                BillingMode='PAY_PER_REQUEST'
+            )
+            print(f"创建表: {meta_table}")
+        
+        # 异步开通队列表
+        queue_table = f"{self.table_prefix}_provision_queue"
+        if queue_table not in existing:
+            self.client.create_table(
+                TableName=queue_table,
+                KeySchema=[{'AttributeName': 'token', 'KeyType': 'HASH'}],
+                AttributeDefinitions=PROVISION_QUEUE_ATTRIBUTE_DEFINITIONS,
+                GlobalSecondaryIndexes=PROVISION_QUEUE_INDEXES,
+                BillingMode='PAY_PER_REQUEST'
+            )
+            print(f"创建表: {queue_table}")
+        
+        for table_name in (uniques_table, meta_table):
+            self.client.get_waiter('table_exists').wait(TableName=table_name)
+        self.run_data_migrations()
+    
+    def data_migrated(self) -> bool:
+        """旧数据回填是否已执行（见 run_data_migrations）"""
+        response = self.meta_table.get_item(Key={'pk': f"migration#{DATA_MIGRATION}"}, ConsistentRead=True)
+        return 'Item' in response
+    
+    def run_data_migrations(self) -> Dict:
+        """
+        回填旧数据，使其符合当前的索引和唯一约束（可重复执行，已回填的条目会被跳过）
+        
+        表由 template.yaml 创建，init_tables 不会在线上运行；升级已有部署后需要执行一次：
+        清理 Lambda 传入 {"action": "migrate"}，或在本地运行 python -m app.migrate
+        """
+        results = {
+            "invite_epochs": self._backfill_epochs(f"{self.table_prefix}_invites", 'token'),
+            # 先补 expires_ts，过期索引分区依赖它
+            "user_epochs": self._backfill_epochs(f"{self.table_prefix}_users", 'user_id'),
+            "expiry_partition": self._backfill_expiry_partition(),
+            "user_guards": self._backfill_user_guards(),
+        }
+        self.meta_table.put_item(Item={
+            'pk': f"migration#{DATA_MIGRATION}",
+            'completed_at': datetime.now().isoformat(),
+            'results': json.dumps(results)
+        })
+        print(f"数据回填完成: {results}")
+        return results
+    
+    @staticmethod
+    def _index_safe(item: Dict, attribute_definitions: List[Dict]) -> Dict:
+        """去掉为空的索引键属性（GSI 键不能是 NULL 或空字符串，缺失时该条目不进入索引）"""
+        keys = {a['AttributeName'] for a in attribute_definitions}
+        return {k: v for k, v in item.items() if not (k in keys and v in (None, ''))}
+    
+    def _backfill_expiry_partition(self) -> int:
+        """为旧数据中的 ACTIVE 用户补写 expiry_partition，使其进入稀疏过期索引"""
+        count = 0
+        condition = Attr('status').eq('ACTIVE') & Attr(EXPIRY_PARTITION_ATTR).not_exists() & Attr('expires_ts').exists()
+        for user in self.iter_users(attributes=['user_id'], filter_expression=condition):
+            self.users_table.update_item(
+                Key={'user_id': user['user_id']},
+                UpdateExpression='SET #p = :p',
+                ExpressionAttributeNames={'#p': EXPIRY_PARTITION_ATTR},
+                ExpressionAttributeValues={':p': EXPIRY_PARTITION_ACTIVE}
+            )
+            count += 1
+        if count:
+            print(f"回填过期索引: {count} 个用户")
+        return count
+    
+    def _backfill_epochs(self, table_name: str, key: str) -> int:
+        """为旧数据补写 created_ts / expires_ts"""
+        count = 0
+        condition = (
+            (Attr('created_at').exists() & Attr('created_ts').not_exists())
+            | (Attr('expires_at').exists() & Attr('expires_ts').not_exists())
+        )
+        table = self.resource.Table(table_name)
+        for item in self.scan(table_name, filter_expression=condition, attributes=[key, 'created_at', 'expires_at']):
+            epochs = self._epochs_only(item)
+            if not epochs:
+                continue
+            table.update_item(
+                Key={key: item[key]},
+                UpdateExpression='SET ' + ', '.join(f'{k} = :{k}' for k in epochs),
+                ExpressionAttributeValues={f':{k}': v for k, v in epochs.items()}
+            )
+            count += 1
+        if count:
+            print(f"回填 epoch 时间: {table_name} {count} 条")
+        return count
+    
+    @staticmethod
+    def _with_epochs(item: Dict) -> Dict:
+        """补上 epoch 字段；无法换算的不写（索引键不能为 NULL）"""
+        item = with_epochs(item)
+        return {k: v for k, v in item.items() if not (k in EPOCH_ATTRS and v is None)}
+    
+    @classmethod
+    def _epochs_only(cls, item: Dict) -> Dict:
+        return {k: v for k, v in cls._with_epochs(item).items() if k in EPOCH_ATTRS}
+    
+    def _backfill_user_guards(self) -> int:
+        """为已有用户补写邮箱 / 用户名占位项"""
+        count = 0
+        with self.uniques_table.batch_writer(overwrite_by_pkeys=['pk']) as batch:
+            for user in self.iter_users(attributes=['user_id', 'email', 'username', 'identity_store_id']):
+                if user.get('email'):
+                    batch.put_item(Item=self._email_guard(user))
+                if user.get('username'):
+                    batch.put_item(Item=self._username_guard(user))
+                count += 1
+        if count:
+            print(f"回填唯一占位: {count} 个用户")
+        return count
+    
+    @staticmethod
+    def _email_guard_key(identity_store_id: Optional[str], email: str) -> Dict:
+        return {'pk': f"email#{identity_store_id or ''}#{email}"}
+    
+    def _email_guard(self, user: Dict) -> Dict:
+        return {**self._email_guard_key(user.get('identity_store_id'), user['email']), 'user_id': user['user_id']}
+    
+    @staticmethod
+    def _username_guard_key(identity_store_id: Optional[str], username: str) -> Dict:
+        return {'pk': f"username#{identity_store_id or ''}#{username}"}
+    
+    def _username_guard(self, user: Dict) -> Dict:
+        return {**self._username_guard_key(user.get('identity_store_id'), user['username']), 'user_id': user['user_id']}
+    
+    def _user_puts(self, user: Dict) -> List[Dict]:
+        """写入用户的事务项：用户、邮箱占位、用户名占位（同租户邮箱 / 用户名唯一）"""
+        return [
+            {'Put': {
+                'TableName': f"{self.table_prefix}_users",
+                'Item': user,
+                'ConditionExpression': 'attribute_not_exists(user_id)'
+            }},
+            {'Put': {
+                'TableName': f"{self.table_prefix}_uniques",
+                'Item': self._email_guard(user),
+                'ConditionExpression': 'attribute_not_exists(pk)'
+            }},
+            {'Put': {
+                'TableName': f"{self.table_prefix}_uniques",
+                'Item': self._username_guard(user),
+                'ConditionExpression': 'attribute_not_exists(pk)'
+            }}
+        ]
+    
+    def _user_deletes(self, user: Dict) -> List[Dict]:
+        """删除用户的事务项（与 _user_puts 对应）"""
+        store_id = user.get('identity_store_id')
+        deletes = [{'Delete': {'TableName': f"{self.table_prefix}_users", 'Key': {'user_id': user['user_id']}}}]
+        if user.get('email'):
+            deletes.append({'Delete': {
+                'TableName': f"{self.table_prefix}_uniques",
+                'Key': self._email_guard_key(store_id, user['email']),
+                'ConditionExpression': 'attribute_not_exists(pk) OR user_id = :uid',
+                'ExpressionAttributeValues': {':uid': user['user_id']}
+            }})
+        if user.get('username'):
+            deletes.append({'Delete': {
+                'TableName': f"{self.table_prefix}_uniques",
+                'Key': self._username_guard_key(store_id, user['username']),
+                'ConditionExpression': 'attribute_not_exists(pk) OR user_id = :uid',
+                'ExpressionAttributeValues': {':uid': user['user_id']}
+            }})
+        return deletes
+    
+    @staticmethod
+    def _guard_conflict(reasons: List[Optional[str]], offset: int) -> ClaimResult:
+        """根据 _user_puts 各项（从 offset 开始）的取消原因判断冲突类型"""
+        def failed(i: int) -> bool:
+            return len(reasons) > offset + i and reasons[offset + i] == 'ConditionalCheckFailed'
+        if failed(1):
+            return ClaimResult.EMAIL_TAKEN
+        if failed(2):
+            return ClaimResult.USERNAME_TAKEN
+        print(f"写入用户事务取消: {reasons}")
+        return ClaimResult.FAILED
+    
+    def _ensure_indexes(self, table_name: str, indexes: List[Dict], attribute_definitions: List[Dict]):
+        """为已存在的表补建缺失的 GSI（UpdateTable 每次只能创建一个）"""
+        description = self.client.describe_table(TableName=table_name)['Table']
+        existing = {i['IndexName'] for i in description.get('GlobalSecondaryIndexes', [])}
+        waiter = self.client.get_waiter('table_exists')
+        
+        for index in indexes:
+            if index['IndexName'] in existing:
+                continue
+            waiter.wait(TableName=table_name)
+            self.client.update_table(
+                TableName=table_name,
+                AttributeDefinitions=attribute_definitions,
+                GlobalSecondaryIndexUpdates=[{'Create': index}]
+            )
+            print(f"创建索引: {table_name}.{index['IndexName']}")
+    
+    def _scan_page(
+        self,
+        table,
+        key: str,
+        identity_store_id: Optional[str],
+        status: Optional[str],
+        limit: int,
+        start_key: Optional[Dict]
+    ) -> Tuple[List[Dict], Optional[Dict]]:
+        """
+        按 ExclusiveStartKey/LastEvaluatedKey 分页扫描，返回 (本页数据, 下一页起点)
+        
+        Scan 的 Limit 限制的是评估条数而不是返回条数，带过滤条件时需要连续扫描凑满一页。
+        凑满时以本页最后一条的主键作为下一页起点（单主键表的扫描顺序是稳定的）。
+        """
+        # 游标来自客户端，只接受本表主键的形状，否则 Scan 会报参数错误
+        if start_key is not None and not (
+            set(start_key) == {key} and isinstance(start_key[key], str) and start_key[key]
+        ):
+            raise ValueError("无效的分页游标")
+        
+        kwargs = {'Limit': limit}
+        condition = self._tenant_status_filter(identity_store_id, status)
+        if condition is not None:
+            kwargs['FilterExpression'] = condition
+        if start_key:
+            kwargs['ExclusiveStartKey'] = start_key
+        
+        items: List[Dict] = []
+        while True:
+            response = table.scan(**kwargs)
+            items.extend(response.get('Items', []))
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key and len(items) <= limit:
+                return items, None
+            if len(items) >= limit:
+                items = items[:limit]
+                return items, {key: items[-1][key]}
+            kwargs['ExclusiveStartKey'] = last_key
+    
+    # ==================== 扫描引擎 ====================
+    
+    @staticmethod
+    def _tenant_status_filter(identity_store_id: Optional[str], status: Optional[str]):
+        """租户 / 状态过滤条件，下推到 FilterExpression"""
+        condition = None
+        if identity_store_id:
+            condition = Attr('identity_store_id').eq(identity_store_id)
+        if status:
+            status_cond = Attr('status').eq(status)
+            condition = status_cond if condition is None else condition & status_cond
+        return condition
+    
+    def scan(
+        self,
+        table_name: str,
+        filter_expression=None,
+        attributes: Optional[List[str]] = None,
+        segments: int = 1
+    ) -> Iterator[Dict]:
+        """
+        流式全表扫描，逐条产出
+        
+        - 跟随 LastEvaluatedKey 直到扫描完毕
+        - filter_expression / attributes 下推为 FilterExpression / ProjectionExpression
+        - segments > 1 时用 Segment/TotalSegments 在线程池中并行扫描，结果顺序不保证
+        """
+        kwargs: Dict = {'TableName': table_name}
+        if filter_expression is not None:
+            kwargs['FilterExpression'] = filter_expression
+        if attributes:
+            kwargs['ProjectionExpression'] = ', '.join(f'#p{i}' for i in range(len(attributes)))
+            kwargs['ExpressionAttributeNames'] = {f'#p{i}': a for i, a in enumerate(attributes)}
+        
+        # resource 的底层 client 是线程安全的，并负责 Python 类型与 DynamoDB 类型的转换
+        client = self.resource.meta.client
+        if segments <= 1:
+            for page in self._scan_segment_pages(client, kwargs):
+                yield from page
+        else:
+            yield from self._parallel_scan(client, kwargs, segments)
+    
+    @staticmethod
+    def _scan_segment_pages(client, kwargs: Dict, segment: Optional[int] = None,
+                            total_segments: Optional[int] = None) -> Iterator[List[Dict]]:
+        kwargs = dict(kwargs)
+        if segment is not None:
+            kwargs['Segment'] = segment
+            kwargs['TotalSegments'] = total_segments
+        while True:
+            response = client.scan(**kwargs)
+            yield response.get('Items', [])
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            kwargs['ExclusiveStartKey'] = last_key
+    
+    def _parallel_scan(self, client, kwargs: Dict, segments: int) -> Iterator[Dict]:
+        """每个分段一个线程，按页通过有界队列交给调用方（消费慢时自动反压）"""
+        pages: "queue.Queue" = queue.Queue(maxsize=segments * 2)
+        stop = threading.Event()
+        
+        def put(entry) -> bool:
+            while not stop.is_set():
+                try:
+                    pages.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def worker(segment: int):
+            try:
+                for page in self._scan_segment_pages(client, kwargs, segment, segments):
+                    if not put(('page', page)):
+                        return
+            except Exception as e:
+                put(('error', e))
+            finally:
+                put(('done', None))
+        
+        with ThreadPoolExecutor(max_workers=segments, thread_name_prefix="scan") as executor:
+            for segment in range(segments):
+                executor.submit(worker, segment)
+            
+            try:
+                remaining = segments
+                while remaining:
+                    kind, value = pages.get()
+                    if kind == 'page':
+                        yield from value
+                    elif kind == 'error':
+                        raise value
+                    else:
+                        remaining -= 1
+            finally:
+                # 调用方提前停止或出错时通知其余分段退出
+                stop.set()
     
     # ==================== 邀请操作 ====================
     
     def insert_invite(self, invite: Dict) -> bool:
         try:
-            self.invites_table.put_item(Item=invite)
+            self.invites_table.put_item(Item=self._with_epochs(invite))
             return True
         except Exception as e:
             print(f"插入邀请失败: {e}")
             return False
     
+    def insert_invites_many(self, invites: List[Dict]) -> bool:
+        """批量插入邀请（BatchWriteItem，每批 25 条，重试未处理的条目）"""
+        table_name = f"{self.table_prefix}_invites"
+        try:
+            for start in range(0, len(invites), BATCH_WRITE_LIMIT):
+                requests = [
+                    {'PutRequest': {'Item': self._with_epochs(item)}}
+                    for item in invites[start:start + BATCH_WRITE_LIMIT]
+                ]
+                self._batch_write(table_name, requests)
+            return True
+        except Exception as e:
+            print(f"批量插入邀请失败: {e}")
+            return False
+    
+    def _batch_write(self, table_name: str, requests: List[Dict]):
+        """执行一批写请求，UnprocessedItems 按指数退避重试"""
+        client = self.resource.meta.client
+        pending = {table_name: requests}
+        for attempt in range(BATCH_WRITE_MAX_RETRIES + 1):
+            response = client.batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems') or {}
+            if not pending:
+                return
+            time.sleep(min(0.05 * (2 ** attempt), 2.0))
+        remaining = sum(len(v) for v in pending.values())
+        raise RuntimeError(f"BatchWriteItem 重试后仍有 {remaining} 条未写入")
+    
     def get_invite(self, token: str) -> Optional[Dict]:
         try:
             response = self.invites_table.get_item(Key={'token': token})
@@ -76,23 +589,81 @@ class DynamoDB:
         except Exception:
             return None
     
+    def iter_invites(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        attributes: Optional[List[str]] = None,
+        segments: int = 1
+    ) -> Iterator[Dict]:
+        """流式遍历邀请（不排序）"""
+        return self.scan(
+            f"{self.table_prefix}_invites",
+            filter_expression=self._tenant_status_filter(identity_store_id, status),
+            attributes=attributes,
+            segments=segments
+        )
+    
+    def iter_invites_by_job(self, job_id: str, attributes: Optional[List[str]] = None) -> Iterator[Dict]:
+        """按 job-index 流式遍历某个批量任务生成的邀请"""
+        kwargs: Dict = {'IndexName': INVITE_JOB_INDEX, 'KeyConditionExpression': Key('job_id').eq(job_id)}
+        if attributes:
+            kwargs['ProjectionExpression'] = ', '.join(f'#p{i}' for i in range(len(attributes)))
+            kwargs['ExpressionAttributeNames'] = {f'#p{i}': a for i, a in enumerate(attributes)}
+        
+        while True:
+            response = self.invites_table.query(**kwargs)
+            yield from response.get('Items', [])
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            kwargs['ExclusiveStartKey'] = last_key
+    
+    def count_invites_by_job(self, job_id: str) -> int:
+        """统计任务已写入的邀请数（GSI 最终一致，刚写入的可能稍后才计入）"""
+        kwargs = {
+            'IndexName': INVITE_JOB_INDEX,
+            'KeyConditionExpression': Key('job_id').eq(job_id),
+            'Select': 'COUNT'
+        }
+        count = 0
+        while True:
+            response = self.invites_table.query(**kwargs)
+            count += response.get('Count', 0)
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return count
+            kwargs['ExclusiveStartKey'] = last_key
+    
+    def count_existing_invites(self, tokens: List[str]) -> int:
+        """统计给定令牌中已写入的邀请数（BatchGetItem 强一致读取）"""
+        keys = [{'token': t} for t in dict.fromkeys(tokens)]
+        return sum(1 for _ in self._batch_get(f"{self.table_prefix}_invites", keys, 'token', consistent=True))
+    
     def get_invites(self, identity_store_id: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
         try:
-            response = self.invites_table.scan()
-            items = response.get('Items', [])
-            
-            if identity_store_id:
-                items = [i for i in items if i.get('identity_store_id') == identity_store_id]
-            if status:
-                items = [i for i in items if i.get('status') == status]
-            
-            return sorted(items, key=lambda x: x.get('created_at', ''), reverse=True)
+            items = self.iter_invites(identity_store_id, status, segments=settings.DYNAMODB_SCAN_SEGMENTS)
+            return sorted(items, key=lambda x: x.get('created_ts') or 0, reverse=True)
         except Exception as e:
             print(f"获取邀请列表失败: {e}")
             return []
     
+    def get_invites_page(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """分页获取邀请，返回 (本页数据, next_cursor)"""
+        items, last_key = self._scan_page(
+            self.invites_table, 'token', identity_store_id, status, limit, decode_cursor(cursor)
+        )
+        return items, encode_cursor(last_key)
+    
     def update_invite(self, token: str, updates: Dict) -> bool:
         try:
+            updates = self._with_epochs(updates)
             update_expr = 'SET ' + ', '.join([f'#{k} = :{k}' for k in updates.keys()])
             expr_names = {f'#{k}': k for k in updates.keys()}
             expr_values = {f':{k}': v for k, v in updates.items()}
@@ -110,9 +681,18 @@ class DynamoDB:
     
     # ==================== 用户操作 ====================
     
+    @staticmethod
+    def _with_expiry_partition(user: Dict) -> Dict:
+        """ACTIVE 用户写入过期分区属性，其余状态不带该属性（不进入稀疏索引）"""
+        user = {k: v for k, v in user.items() if k != EXPIRY_PARTITION_ATTR}
+        if user.get('status', 'ACTIVE') == 'ACTIVE' and user.get('expires_ts') is not None:
+            user[EXPIRY_PARTITION_ATTR] = EXPIRY_PARTITION_ACTIVE
+        return user
+    
     def insert_user(self, user: Dict) -> bool:
         try:
-            self.users_table.put_item(Item=user)
+            item = self._with_expiry_partition(self._with_epochs(user))
+            self.users_table.put_item(Item=self._index_safe(item, USER_ATTRIBUTE_DEFINITIONS))
             return True
         except Exception as e:
             print(f"插入用户失败: {e}")
@@ -125,53 +705,179 @@ class DynamoDB:
         except Exception:
             return None
     
-    def get_user_by_email(self, email: str, identity_store_id: Optional[str] = None) -> Optional[Dict]:
-        try:
-            response = self.users_table.scan(
-                FilterExpression='email = :email',
-                ExpressionAttributeValues={':email': email}
+    def _query_user_index(self, index_name: str, attribute: str, value: str,
+                          identity_store_id: Optional[str]) -> Optional[Dict]:
+        """按 (identity_store_id, attribute) 查询 GSI；未指定租户时退化为带分页的全表扫描"""
+        if identity_store_id:
+            response = self.users_table.query(
+                IndexName=index_name,
+                KeyConditionExpression=Key('identity_store_id').eq(identity_store_id) & Key(attribute).eq(value),
+                Limit=1
             )
             items = response.get('Items', [])
-            if identity_store_id:
-                items = [i for i in items if i.get('identity_store_id') == identity_store_id]
             return items[0] if items else None
+        
+        kwargs = {'FilterExpression': Attr(attribute).eq(value)}
+        while True:
+            response = self.users_table.scan(**kwargs)
+            items = response.get('Items', [])
+            if items:
+                return items[0]
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return None
+            kwargs['ExclusiveStartKey'] = last_key
+    
+    def get_user_by_email(self, email: str, identity_store_id: Optional[str] = None) -> Optional[Dict]:
+        try:
+            return self._query_user_index(USER_EMAIL_INDEX, 'email', email, identity_store_id)
         except Exception:
             return None
     
     def get_user_by_username(self, username: str, identity_store_id: Optional[str] = None) -> Optional[Dict]:
         try:
-            response = self.users_table.scan(
-                FilterExpression='username = :username',
-                ExpressionAttributeValues={':username': username}
-            )
-            items = response.get('Items', [])
-            if identity_store_id:
-                items = [i for i in items if i.get('identity_store_id') == identity_store_id]
-            return items[0] if items else None
+            return self._query_user_index(USER_USERNAME_INDEX, 'username', username, identity_store_id)
         except Exception:
             return None
     
+    def _batch_get(self, table_name: str, keys: List[Dict], projection: str,
+                   consistent: bool = False) -> Iterator[Dict]:
+        """BatchGetItem 按主键读取（每批 100 个，未处理的键退避重试）"""
+        client = self.resource.meta.client
+        for start in range(0, len(keys), BATCH_GET_LIMIT):
+            request = {
+                'Keys': keys[start:start + BATCH_GET_LIMIT],
+                'ProjectionExpression': '#p',
+                'ExpressionAttributeNames': {'#p': projection}
+            }
+            if consistent:
+                request['ConsistentRead'] = True
+            pending = {table_name: request}
+            for attempt in range(BATCH_WRITE_MAX_RETRIES + 1):
+                response = client.batch_get_item(RequestItems=pending)
+                yield from response.get('Responses', {}).get(table_name, [])
+                pending = response.get('UnprocessedKeys') or {}
+                if not pending:
+                    break
+                time.sleep(min(0.05 * (2 ** attempt), 2.0))
+            else:
+                raise RuntimeError("BatchGetItem 重试后仍有未读取的键")
+    
+    def find_existing_emails(self, identity_store_id: Optional[str], emails: List[str]) -> Set[str]:
+        """
+        返回同租户下已注册的邮箱（返回小写形式，BatchGetItem 按主键读取邮箱占位项）
+        
+        占位项按写入时的原样大小写存储，这里同时查原样和小写两种形式
+        """
+        variants = dict.fromkeys(v for e in emails for v in (e, e.lower()))
+        keys = [self._email_guard_key(identity_store_id, e) for e in variants]
+        # pk 格式: email#<identity_store_id>#<email>
+        return {
+            item['pk'].split('#', 2)[2].lower()
+            for item in self._batch_get(f"{self.table_prefix}_uniques", keys, 'pk')
+        }
+    
+    def iter_users(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        attributes: Optional[List[str]] = None,
+        segments: int = 1,
+        filter_expression=None
+    ) -> Iterator[Dict]:
+        """流式遍历用户（不排序）"""
+        condition = self._tenant_status_filter(identity_store_id, status)
+        if filter_expression is not None:
+            condition = filter_expression if condition is None else condition & filter_expression
+        return self.scan(
+            f"{self.table_prefix}_users",
+            filter_expression=condition,
+            attributes=attributes,
+            segments=segments
+        )
+    
+    def iter_users_expiring_before(self, before: int, after: Optional[int] = None) -> Iterator[Dict]:
+        """
+        按过期时间升序遍历 ACTIVE 用户：after <= expires_ts < before（epoch 秒）
+        查询稀疏过期索引，只读取到期范围内的用户
+        """
+        if not self._migration_checked:
+            self._migration_checked = True
+            if not self.data_migrated():
+                print("⚠️ 旧数据尚未回填（run_data_migrations），缺少 expires_ts 的用户不在过期索引中，不会被清理")
+        key_condition = Key(EXPIRY_PARTITION_ATTR).eq(EXPIRY_PARTITION_ACTIVE)
+        if after is not None:
+            key_condition &= Key('expires_ts').between(after, before - 1)
+        else:
+            key_condition &= Key('expires_ts').lt(before)
+        kwargs = {'IndexName': USER_EXPIRY_INDEX, 'KeyConditionExpression': key_condition}
+        
+        while True:
+            response = self.users_table.query(**kwargs)
+            yield from response.get('Items', [])
+            last_key = response.get('LastEvaluatedKey')
+            if not last_key:
+                return
+            kwargs['ExclusiveStartKey'] = last_key
+    
     def get_users(self, identity_store_id: Optional[str] = None, status: Optional[str] = None) -> List[Dict]:
         try:
-            response = self.users_table.scan()
-            items = response.get('Items', [])
-            
-            if identity_store_id:
-                items = [i for i in items if i.get('identity_store_id') == identity_store_id]
-            if status:
-                items = [i for i in items if i.get('status') == status]
-            
-            return sorted(items, key=lambda x: x.get('created_at', ''), reverse=True)
+            items = self.iter_users(identity_store_id, status, segments=settings.DYNAMODB_SCAN_SEGMENTS)
+            return sorted(items, key=lambda x: x.get('created_ts') or 0, reverse=True)
         except Exception as e:
             print(f"获取用户列表失败: {e}")
             return []
     
+    def get_users_page(
+        self,
+        identity_store_id: Optional[str] = None,
+        status: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """分页获取用户，返回 (本页数据, next_cursor)"""
+        items, last_key = self._scan_page(
+            self.users_table, 'user_id', identity_store_id, status, limit, decode_cursor(cursor)
+        )
+        return items, encode_cursor(last_key)
+    
+    def count_users_grouped(self, by: List[str]) -> List[Dict]:
+        """
+        一次投影分页扫描统计用户数（只读取分组字段）
+        返回 [{<分组字段>: 值, ..., "count": n}, ...]
+        """
+        if not set(by) <= USER_GROUP_COLUMNS:
+            raise ValueError(f"不支持的分组字段: {set(by) - USER_GROUP_COLUMNS}")
+        
+        # 不分组时也要投影一个字段，避免读取整条记录
+        counts: Counter = Counter(
+            tuple(item.get(c) for c in by)
+            for item in self.iter_users(
+                attributes=by or ['user_id'],
+                segments=settings.DYNAMODB_SCAN_SEGMENTS
+            )
+        )
+        
+        if not by:
+            return [{'count': counts[()]}]
+        return [dict(zip(by, group), count=n) for group, n in counts.items()]
+    
     def update_user(self, user_id: str, updates: Dict) -> bool:
         try:
+            updates = self._with_epochs(updates)
             update_expr = 'SET ' + ', '.join([f'#{k} = :{k}' for k in updates.keys()])
             expr_names = {f'#{k}': k for k in updates.keys()}
             expr_values = {f':{k}': v for k, v in updates.items()}
             
+            # 状态变化时同步维护稀疏过期索引
+            if 'status' in updates:
+                expr_names['#expiry_partition'] = EXPIRY_PARTITION_ATTR
+                if updates['status'] == 'ACTIVE':
+                    update_expr += ', #expiry_partition = :expiry_partition'
+                    expr_values[':expiry_partition'] = EXPIRY_PARTITION_ACTIVE
+                else:
+                    update_expr += ' REMOVE #expiry_partition'
+            
             self.users_table.update_item(
                 Key={'user_id': user_id},
                 UpdateExpression=update_expr,
@@ -183,9 +889,410 @@ class DynamoDB:
             print(f"更新用户失败: {e}")
             return False
     
+    # ==================== 邀请批量任务 ====================
+    
+    @staticmethod
+    def _invite_job(item: Dict) -> Dict:
+        job = {k: v for k, v in item.items() if k != 'pk'}
+        job['params'] = json.loads(job['params'])
+        job['total'] = int(job['total'])
+        job['created'] = int(job.get('created', 0))
+        return job
+    
+    def insert_invite_job(self, job: Dict) -> bool:
+        try:
+            self.meta_table.put_item(
+                Item={
+                    'pk': f"invite_job#{job['job_id']}",
+                    'job_id': job['job_id'],
+                    'status': job['status'],
+                    'total': job['total'],
+                    'created': job.get('created', 0),
+                    # 以 JSON 字符串存储，避免数值被转换成 Decimal
+                    'params': json.dumps(job['params'], ensure_ascii=False),
+                    'created_at': job['created_at'],
+                    'updated_at': job['created_at']
+                },
+                ConditionExpression='attribute_not_exists(pk)'
+            )
+            return True
+        except Exception as e:
+            print(f"创建批量任务失败: {e}")
+            return False
+    
+    def get_invite_job(self, job_id: str) -> Optional[Dict]:
+        response = self.meta_table.get_item(Key={'pk': f"invite_job#{job_id}"}, ConsistentRead=True)
+        item = response.get('Item')
+        return self._invite_job(item) if item else None
+    
+    def get_unfinished_invite_jobs(self) -> List[Dict]:
+        """未完成（PENDING / RUNNING）的批量任务，按创建时间顺序"""
+        condition = Attr('pk').begins_with('invite_job#') & Attr('status').is_in(['PENDING', 'RUNNING'])
+        items = sorted(
+            self.scan(f"{self.table_prefix}_meta", filter_expression=condition),
+            key=lambda item: item.get('created_at', '')
+        )
+        return [self._invite_job(item) for item in items]
+    
+    def update_invite_job(self, job_id: str, updates: Dict) -> bool:
+        updates = dict(updates, updated_at=datetime.now().isoformat())
+        try:
+            self.meta_table.update_item(
+                Key={'pk': f"invite_job#{job_id}"},
+                UpdateExpression='SET ' + ', '.join(f'#{k} = :{k}' for k in updates),
+                ConditionExpression='attribute_exists(pk)',
+                ExpressionAttributeNames={f'#{k}': k for k in updates},
+                ExpressionAttributeValues={f':{k}': v for k, v in updates.items()}
+            )
+            return True
+        except Exception as e:
+            print(f"更新批量任务失败: {e}")
+            return False
+    
+    # ==================== 断点 ====================
+    
+    def get_checkpoint(self, name: str) -> Optional[Dict]:
+        response = self.meta_table.get_item(Key={'pk': f"checkpoint#{name}"}, ConsistentRead=True)
+        item = response.get('Item')
+        return json.loads(item['data']) if item else None
+    
+    def save_checkpoint(self, name: str, data: Dict, fencing_token: Optional[int] = None) -> bool:
+        """
+        保存断点；带 fencing_token 时，已被更新的租约持有者写过的断点不会被覆盖
+        返回是否写入
+        """
+        # 以 JSON 字符串存储，避免数值被转换成 Decimal
+        item = {
+            'pk': f"checkpoint#{name}",
+            'data': json.dumps(data, ensure_ascii=False),
+            'updated_at': from_epoch(now_epoch()).isoformat()
+        }
+        if fencing_token is None:
+            self.meta_table.put_item(Item=item)
+            return True
+        
+        item['fencing_token'] = fencing_token
+        try:
+            self.meta_table.put_item(
+                Item=item,
+                ConditionExpression='attribute_not_exists(fencing_token) OR fencing_token <= :token',
+                ExpressionAttributeValues={':token': fencing_token}
+            )
+            return True
+        except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+    
+    def delete_checkpoint(self, name: str) -> bool:
+        self.meta_table.delete_item(Key={'pk': f"checkpoint#{name}"})
+        return True
+    
+    # ==================== 租约 ====================
+    
+    def acquire_lease(self, name: str, holder: str, ttl_seconds: float) -> Optional[int]:
+        """
+        条件写获取（或续期）租约：不存在、已过期或本就由 holder 持有时成功
+        返回单调递增的 fencing token，被其他实例持有时返回 None
+        """
+        now = time.time()
+        try:
+            response = self.meta_table.update_item(
+                Key={'pk': f"lease#{name}"},
+                UpdateExpression='SET holder = :holder, expires_at = :expires ADD fencing_token :one',
+                ConditionExpression='attribute_not_exists(pk) OR expires_at <= :now OR holder = :holder',
+                ExpressionAttributeValues={
+                    ':holder': holder,
+                    ':expires': int((now + ttl_seconds) * 1000),
+                    ':now': int(now * 1000),
+                    ':one': 1
+                },
+                ReturnValues='UPDATED_NEW'
+            )
+        except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+            return None
+        return int(response['Attributes']['fencing_token'])
+    
+    def release_lease(self, name: str, holder: str, fencing_token: int) -> bool:
+        """释放租约（保留项以延续 fencing token 序列）；已被他人接管时不做任何事"""
+        try:
+            self.meta_table.update_item(
+                Key={'pk': f"lease#{name}"},
+                UpdateExpression='SET expires_at = :zero REMOVE holder',
+                ConditionExpression='holder = :holder AND fencing_token = :token',
+                ExpressionAttributeValues={':holder': holder, ':token': fencing_token, ':zero': 0}
+            )
+            return True
+        except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+    
+    # ==================== 异步开通队列 ====================
+    
+    @staticmethod
+    def _provision_task(item: Dict) -> Dict:
+        """due_at 以毫秒整数存储，对外与 SQLite 一致使用秒"""
+        task = {k: v for k, v in item.items() if k != QUEUE_PARTITION_ATTR}
+        task['attempts'] = int(task.get('attempts', 0))
+        if task.get('due_at') is not None:
+            task['due_at'] = int(task['due_at']) / 1000
+        return task
+    
+    def get_provision_task(self, token: str) -> Optional[Dict]:
+        response = self.provision_queue_table.get_item(Key={'token': token}, ConsistentRead=True)
+        item = response.get('Item')
+        return self._provision_task(item) if item else None
+    
+    def lease_provision_tasks(self, holder: str, limit: int, lease_seconds: float) -> List[Dict]:
+        """
+        查询 due-index 中到期的任务，逐个条件更新为 RUNNING（due_at 未变才成功，多实例不会重复取到）
+        到期包括等待重试的 PENDING 任务和租约已过期（执行者崩溃）的 RUNNING 任务
+        """
+        now = int(time.time() * 1000)
+        response = self.provision_queue_table.query(
+            IndexName=PROVISION_DUE_INDEX,
+            KeyConditionExpression=Key(QUEUE_PARTITION_ATTR).eq(QUEUE_PARTITION_QUEUED) & Key('due_at').lte(now),
+            Limit=limit
+        )
+        tasks = []
+        for item in response.get('Items', []):
+            try:
+                updated = self.provision_queue_table.update_item(
+                    Key={'token': item['token']},
+                    UpdateExpression='SET #status = :running, due_at = :lease, locked_by = :holder, updated_at = :now ADD attempts :one',
+                    ConditionExpression='due_at = :due AND attribute_exists(#partition)',
+                    ExpressionAttributeNames={'#status': 'status', '#partition': QUEUE_PARTITION_ATTR},
+                    ExpressionAttributeValues={
+                        ':running': 'RUNNING',
+                        ':lease': now + int(lease_seconds * 1000),
+                        ':holder': holder,
+                        ':now': datetime.now().isoformat(),
+                        ':one': 1,
+                        ':due': item['due_at']
+                    },
+                    ReturnValues='ALL_NEW'
+                )
+            except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+                # 已被其他实例取走
+                continue
+            tasks.append(self._provision_task(updated['Attributes']))
+        return tasks
+    
+    def release_provision_task(
+        self,
+        token: str,
+        holder: str,
+        status: str,
+        due_at: Optional[float] = None,
+        error: Optional[str] = None
+    ) -> bool:
+        """
+        结束一次执行：PENDING 时在 due_at 重新入队，其余状态出队（去掉 queue_partition）
+        只有仍持有该任务的 holder 才能更新（租约过期被他人接管后不覆盖）
+        """
+        names = {'#status': 'status', '#error': 'error'}
+        values = {':status': status, ':holder': holder, ':now': datetime.now().isoformat(), ':error': error}
+        if status == 'PENDING':
+            update = 'SET #status = :status, due_at = :due, #error = :error, updated_at = :now REMOVE locked_by'
+            values[':due'] = int(due_at * 1000)
+        else:
+            update = 'SET #status = :status, #error = :error, updated_at = :now REMOVE locked_by, due_at, #partition'
+            names['#partition'] = QUEUE_PARTITION_ATTR
+        try:
+            self.provision_queue_table.update_item(
+                Key={'token': token},
+                UpdateExpression=update,
+                ConditionExpression='locked_by = :holder',
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+            return True
+        except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+    
+    # ==================== 幂等键 ====================
+    
+    @staticmethod
+    def _idempotency_record(item: Dict) -> Dict:
+        record = {k: v for k, v in item.items() if k not in ('pk', 'ttl')}
+        record['response'] = json.loads(record['response']) if record.get('response') else None
+        if record.get('status_code') is not None:
+            record['status_code'] = int(record['status_code'])
+        record['expires_at'] = int(record['expires_at']) / 1000
+        return record
+    
+    def get_idempotency_key(self, key: str) -> Optional[Dict]:
+        """读取未过期的幂等记录（不占用；TTL 删除有延迟，按 expires_at 判断）"""
+        response = self.meta_table.get_item(Key={'pk': f"idem#{key}"}, ConsistentRead=True)
+        item = response.get('Item')
+        if not item or int(item['expires_at']) <= int(time.time() * 1000):
+            return None
+        return self._idempotency_record(item)
+    
+    def reserve_idempotency_key(self, key: str, fingerprint: str, ttl_seconds: float) -> Optional[Dict]:
+        """
+        条件写占用幂等键（INFLIGHT）；成功返回 None
+        键已存在且未过期时不写入，返回已有记录（INFLIGHT 或 DONE）
+        """
+        now = time.time()
+        try:
+            self.meta_table.put_item(
+                Item={
+                    'pk': f"idem#{key}",
+                    'fingerprint': fingerprint,
+                    'status': 'INFLIGHT',
+                    'expires_at': int((now + ttl_seconds) * 1000),
+                    # DynamoDB TTL 属性（秒），过期项由 DynamoDB 自动删除
+                    'ttl': int(now + ttl_seconds)
+                },
+                ConditionExpression='attribute_not_exists(pk) OR expires_at <= :now',
+                ExpressionAttributeValues={':now': int(now * 1000)}
+            )
+            return None
+        except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+            response = self.meta_table.get_item(Key={'pk': f"idem#{key}"}, ConsistentRead=True)
+            item = response.get('Item')
+            # 条件检查与读取之间被删除时按占用中处理，调用方稍后重试
+            return self._idempotency_record(item) if item else {'status': 'INFLIGHT', 'fingerprint': fingerprint}
+    
+    def complete_idempotency_key(self, key: str, fingerprint: str, status_code: int, response: Dict,
+                                 ttl_seconds: float) -> bool:
+        """保存响应（覆盖处理中标记），之后相同键的请求直接重放"""
+        expires = time.time() + ttl_seconds
+        self.meta_table.put_item(Item={
+            'pk': f"idem#{key}",
+            'fingerprint': fingerprint,
+            'status': 'DONE',
+            'status_code': status_code,
+            'response': json.dumps(response, ensure_ascii=False),
+            'expires_at': int(expires * 1000),
+            'ttl': int(expires)
+        })
+        return True
+    
+    def delete_idempotency_key(self, key: str) -> bool:
+        self.meta_table.delete_item(Key={'pk': f"idem#{key}"})
+        return True
+    
+    def purge_expired_idempotency_keys(self) -> int:
+        """过期项由表的 TTL 自动删除"""
+        return 0
+    
+    # ==================== 认领事务 ====================
+    
+    def claim_invite_atomic(
+        self, token: str, user: Dict, enqueue: bool = False, idempotency_key: Optional[str] = None
+    ) -> ClaimResult:
+        """
+        一次 TransactWriteItems 完成认领：
+        1. 条件更新邀请（status = PENDING → CLAIMED）
+        2. 写入用户（user_id 不存在）
+        3. 写入邮箱、用户名占位项（同租户邮箱 / 用户名唯一）
+        4. enqueue 时写入开通任务（异步开通模式），idempotency_key 为认领请求的幂等键
+        任一条件不满足则整体回滚，并根据 CancellationReasons 返回冲突类型
+        """
+        user = self._index_safe(self._with_expiry_partition(self._with_epochs(user)), USER_ATTRIBUTE_DEFINITIONS)
+        client = self.resource.meta.client
+        extra = []
+        if enqueue:
+            # 邀请的条件更新保证同一令牌只有一个进行中的任务，之前失败的任务直接覆盖
+            now = datetime.now().isoformat()
+            task = {
+                'token': token,
+                'user_id': user['user_id'],
+                'status': 'PENDING',
+                'attempts': 0,
+                QUEUE_PARTITION_ATTR: QUEUE_PARTITION_QUEUED,
+                'due_at': int(time.time() * 1000),
+                'created_at': now,
+                'updated_at': now
+            }
+            if idempotency_key:
+                task['idempotency_key'] = idempotency_key
+            extra.append({'Put': {
+                'TableName': f"{self.table_prefix}_provision_queue",
+                'Item': task
+            }})
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': f"{self.table_prefix}_invites",
+                    'Key': {'token': token},
+                    'ConditionExpression': '#status = :pending',
+                    'UpdateExpression': 'SET #status = :claimed, claimed_at = :at, claimed_email = :email, claimed_user_id = :uid',
+                    'ExpressionAttributeNames': {'#status': 'status'},
+                    'ExpressionAttributeValues': {
+                        ':pending': 'PENDING',
+                        ':claimed': 'CLAIMED',
+                        ':at': user.get('created_at'),
+                        ':email': user['email'],
+                        ':uid': user['user_id']
+                    }
+                }}
+            ] + self._user_puts(user) + extra)
+            return ClaimResult.CLAIMED
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            if reasons[:1] == ['ConditionalCheckFailed']:
+                return ClaimResult.INVITE_UNAVAILABLE
+            return self._guard_conflict(reasons, 1)
+        except Exception as e:
+            print(f"认领事务失败: {e}")
+            return ClaimResult.FAILED
+    
+    def insert_user_unique(self, user: Dict) -> ClaimResult:
+        """
+        一次 TransactWriteItems 写入用户和邮箱 / 用户名占位项（不关联邀请，用于批量开通）
+        返回 CLAIMED 表示写入成功，否则为冲突类型
+        """
+        user = self._index_safe(self._with_expiry_partition(self._with_epochs(user)), USER_ATTRIBUTE_DEFINITIONS)
+        client = self.resource.meta.client
+        try:
+            client.transact_write_items(TransactItems=self._user_puts(user))
+            return ClaimResult.CLAIMED
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            return self._guard_conflict(reasons, 0)
+        except Exception as e:
+            print(f"写入用户事务失败: {e}")
+            return ClaimResult.FAILED
+    
+    def release_invite_claim(self, token: str, user: Dict) -> bool:
+        """撤销认领（IDC 开通失败时的补偿）：邀请恢复 PENDING，删除用户和唯一占位"""
+        client = self.resource.meta.client
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': f"{self.table_prefix}_invites",
+                    'Key': {'token': token},
+                    'ConditionExpression': 'claimed_user_id = :uid',
+                    'UpdateExpression': 'SET #status = :pending REMOVE claimed_at, claimed_email, claimed_user_id',
+                    'ExpressionAttributeNames': {'#status': 'status'},
+                    'ExpressionAttributeValues': {':pending': 'PENDING', ':uid': user['user_id']}
+                }}
+            ] + self._user_deletes(user))
+            return True
+        except Exception as e:
+            print(f"撤销认领失败: {e}")
+            return False
+    
     def delete_user(self, user_id: str) -> bool:
         try:
-            self.users_table.delete_item(Key={'user_id': user_id})
+            response = self.users_table.delete_item(Key={'user_id': user_id}, ReturnValues='ALL_OLD')
+            old = response.get('Attributes') or {}
+            store_id = old.get('identity_store_id')
+            # 只删除属于该用户的占位项
+            guards = []
+            if old.get('email'):
+                guards.append(self._email_guard_key(store_id, old['email']))
+            if old.get('username'):
+                guards.append(self._username_guard_key(store_id, old['username']))
+            for key in guards:
+                try:
+                    self.uniques_table.delete_item(
+                        Key=key,
+                        ConditionExpression='user_id = :uid',
+                        ExpressionAttributeValues={':uid': user_id}
+                    )
+                except self.resource.meta.client.exceptions.ConditionalCheckFailedException:
+                    pass
             return True
         except Exception as e:
             print(f"删除用户失败: {e}")
@@ -0,0 +1,182 @@
+"""进程内到期定时器：在账号到期时刻处理，而不是等每天的全量清理"""
+import asyncio
+import heapq
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.services.async_db import run_blocking, run_idc
+from app.services.db_factory import db
+from app.services.scheduler import AccountScheduler, scheduler
+
+
+class ExpiryTimer:
+    """
+    (处理时刻 epoch 秒, user_id) 的最小堆
+    
+    启动时从过期索引加载 horizon 内到期的 ACTIVE 用户，之后每半个 horizon 重新加载一次；
+    认领 / 启用时 schedule()，禁用 / 删除时 cancel()。
+    取消和改期不从堆中删除，以 _deadlines 中的记录为准（惰性删除）。
+    """
+    
+    def __init__(self, horizon: float, retry_delay: float, max_retries: int):
+        self.horizon = horizon
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self._heap: List[Tuple[float, str]] = []
+        self._deadlines: Dict[str, float] = {}
+        self._retries: Dict[str, int] = {}
+        self._horizon_end: Optional[float] = None
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.stats = {"fired": 0, "processed": 0, "failed": 0, "skipped": 0, "gave_up": 0}
+    
+    def __len__(self) -> int:
+        return len(self._deadlines)
+    
+    @property
+    def running(self) -> bool:
+        return self._loop is not None and self._horizon_end is not None
+    
+    def schedule(self, user_id: str, expires_ts: Optional[int]):
+        """登记（或改期）用户的处理时刻；定时器未运行或超出当前窗口时忽略，由下次加载兜底"""
+        if not self.running:
+            return
+        deadline = AccountScheduler.expiry_deadline(expires_ts)
+        if deadline is None:
+            self.cancel(user_id)
+            return
+        with self._lock:
+            if deadline >= self._horizon_end:
+                self._deadlines.pop(user_id, None)
+                return
+            self._retries.pop(user_id, None)
+            earliest = self._push(user_id, deadline)
+        if earliest:
+            self._notify()
+    
+    def cancel(self, user_id: str):
+        """取消用户的处理（禁用 / 删除）"""
+        with self._lock:
+            self._deadlines.pop(user_id, None)
+            self._retries.pop(user_id, None)
+    
+    def _push(self, user_id: str, deadline: float) -> bool:
+        """调用方持有锁；返回是否成为最早的条目"""
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._heap, (deadline, user_id))
+        return self._heap[0] == (deadline, user_id)
+    
+    def _notify(self):
+        # schedule() 可能在线程池中调用，通过 call_soon_threadsafe 唤醒事件循环
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None:
+            loop.call_soon_threadsafe(wakeup.set)
+    
+    def _pop_due(self, now: float) -> List[str]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, user_id = heapq.heappop(self._heap)
+                if self._deadlines.get(user_id) == deadline:
+                    del self._deadlines[user_id]
+                    due.append(user_id)
+        return due
+    
+    def _next_deadline(self) -> Optional[float]:
+        with self._lock:
+            # 顺便丢弃堆顶已失效的条目
+            while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+    
+    @staticmethod
+    def _load(horizon_end: float) -> List[Tuple[float, str]]:
+        """从过期索引读取 horizon 内到期的 ACTIVE 用户"""
+        entries = []
+        for user in db.iter_users_expiring_before(int(horizon_end)):
+            deadline = AccountScheduler.expiry_deadline(user.get("expires_ts"))
+            if deadline is not None:
+                entries.append((deadline, user["user_id"]))
+        return entries
+    
+    async def reload(self):
+        """重建堆（数据库是唯一的事实来源，顺便纠正漏掉的增量更新）"""
+        horizon_end = time.time() + self.horizon
+        entries = await run_blocking(self._load, horizon_end)
+        with self._lock:
+            self._horizon_end = horizon_end
+            self._heap = entries
+            heapq.heapify(self._heap)
+            self._deadlines = {user_id: deadline for deadline, user_id in entries}
+            self._retries = {k: v for k, v in self._retries.items() if k in self._deadlines}
+        print(f"[到期定时器] 已加载 {len(entries)} 个将在 {datetime.fromtimestamp(horizon_end).strftime('%Y-%m-%d %H:%M')} 前到期的用户")
+    
+    async def _fire(self, user_ids: List[str]):
+        self.stats["fired"] += len(user_ids)
+        results = await run_idc(scheduler.expire_users, user_ids)
+        self.stats["processed"] += len(results["processed"])
+        self.stats["skipped"] += len(results["skipped"])
+        self.stats["failed"] += len(results["failed"])
+        if results["processed"]:
+            print(f"[到期定时器] 已处理 {len(results['processed'])} 个到期用户")
+        
+        # 失败的稍后重试，超过次数后交给每天的对账清理；其他实例持有租约的原样延后
+        retry_at = time.time() + self.retry_delay
+        with self._lock:
+            for user_id in results["deferred"]:
+                self._push(user_id, retry_at)
+            for user_id in results["failed"]:
+                attempts = self._retries.get(user_id, 0) + 1
+                if attempts > self.max_retries:
+                    self._retries.pop(user_id, None)
+                    self.stats["gave_up"] += 1
+                    print(f"[到期定时器] 用户 {user_id} 多次处理失败，留给对账清理")
+                    continue
+                self._retries[user_id] = attempts
+                self._push(user_id, retry_at)
+    
+    async def run(self):
+        """定时器主循环（在 lifespan 中作为后台任务启动）"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            await self.reload()
+            next_reload = time.time() + self.horizon / 2
+            
+            while True:
+                # 先清除唤醒标志再取到期条目，避免丢失期间登记的更早条目
+                self._wakeup.clear()
+                now = time.time()
+                if now >= next_reload:
+                    await self.reload()
+                    next_reload = now + self.horizon / 2
+                
+                due = self._pop_due(now)
+                if due:
+                    try:
+                        await self._fire(due)
+                    except Exception as e:
+                        print(f"[到期定时器] 处理失败: {e}")
+                    continue
+                
+                wake_at = min(filter(None, (self._next_deadline(), next_reload)))
+                timeout = max(0.0, wake_at - time.time())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._loop = None
+            self._wakeup = None
+            self._horizon_end = None
+
+
+expiry_timer = ExpiryTimer(
+    horizon=settings.EXPIRY_TIMER_HORIZON_HOURS * 3600,
+    retry_delay=settings.EXPIRY_TIMER_RETRY_SECONDS,
+    max_retries=settings.EXPIRY_TIMER_MAX_RETRIES
+)
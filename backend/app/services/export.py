@@ -0,0 +1,71 @@
+"""流式导出（CSV / NDJSON）
+
+数据从 iter_invites / iter_users 的生成器（SQLite 服务端游标 / DynamoDB 分页扫描）按批取出，
+逐批编码后交给 StreamingResponse，内存占用与数据量无关。
+"""
+import csv
+import io
+import json
+from typing import AsyncIterator, Callable, Dict, Iterator, List
+
+from app.services.async_db import run_blocking
+
+
+# 每次到线程池取的行数（摊薄线程切换开销），也是每个响应分块的行数
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _next_batch(rows: Iterator[Dict], size: int) -> List[Dict]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def _encode_csv(records: List[List]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(records)
+    return buffer.getvalue()
+
+
+async def stream_export(
+    open_rows: Callable[[], Iterator[Dict]],
+    columns: List[str],
+    to_record: Callable[[Dict], Dict],
+    fmt: str
+) -> AsyncIterator[bytes]:
+    """
+    流式产出导出内容
+    
+    Args:
+        open_rows: 返回行生成器的函数（在线程池中调用，阻塞读取不占用事件循环）
+        columns: 导出列（CSV 表头 / NDJSON 字段顺序）
+        to_record: 行 → 导出记录
+        fmt: csv 或 ndjson
+    """
+    if fmt == "csv":
+        # 表头立即发出，客户端不必等第一批数据
+        yield ("\ufeff" + _encode_csv([columns])).encode()
+    
+    rows = await run_blocking(open_rows)
+    try:
+        while True:
+            batch = await run_blocking(_next_batch, rows, EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            records = [to_record(row) for row in batch]
+            if fmt == "csv":
+                chunk = _encode_csv([[record.get(c) for c in columns] for record in records])
+            else:
+                chunk = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+            yield chunk.encode()
+    finally:
+        # 客户端断开时也要关闭生成器，归还 SQLite 连接 / 停止并行扫描
+        await run_blocking(rows.close)
@@ -1,25 +1,47 @@
 """AWS IAM Identity Center 服务"""
-import boto3
-from typing import Optional
+import threading
+import time
+from typing import Dict, Optional
+from botocore.exceptions import ClientError
 from app.config import settings
+from app.services.aws_clients import get_client
+from app.services.rate_limit import TokenBucket, backoff_delay
+
+
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException'}
+
+# 进程内所有 Identity Store 调用共享一个令牌桶，保持在 API 配额以内
+idc_rate_limiter = TokenBucket(rate=settings.IDC_RATE_LIMIT_PER_SECOND, burst=settings.IDC_RATE_LIMIT_BURST)
 
 
 class IDCService:
     """AWS Identity Center 用户管理"""
     
     def __init__(self, identity_store_id: Optional[str] = None):
-        self._client = None
         self.store_id = identity_store_id or settings.IDENTITY_STORE_ID
     
     @property
     def client(self):
-        """延迟初始化 boto3 client"""
-        if self._client is None:
-            self._client = boto3.client(
-                'identitystore',
-                region_name=settings.AWS_REGION
-            )
-        return self._client
+        """进程共享的 identitystore client"""
+        return get_client('identitystore')
+    
+    def _call(self, operation: str, **kwargs):
+        """
+        调用 Identity Store API：先经过进程级令牌桶限流，
+        遇到 ThrottlingException 时指数退避重试，其余异常原样抛出
+        （identitystore client 关闭了 botocore 自身的重试，总尝试次数为 IDC_THROTTLE_RETRIES + 1）
+        """
+        for attempt in range(settings.IDC_THROTTLE_RETRIES + 1):
+            idc_rate_limiter.acquire()
+            try:
+                return getattr(self.client, operation)(**kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in THROTTLING_ERROR_CODES or attempt == settings.IDC_THROTTLE_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"IDC {operation} 被限流，{delay:.2f}s 后重试")
+                time.sleep(delay)
     
     def create_user(
         self,
@@ -34,7 +56,8 @@ class IDCService:
         try:
             # AWS Identity Store 要求 Name 字段
             name = display_name or username
-            response = self.client.create_user(
+            response = self._call(
+                'create_user',
                 IdentityStoreId=self.store_id,
                 UserName=username,
                 DisplayName=name,
@@ -52,7 +75,8 @@ class IDCService:
             
             # 启用用户（API 创建的用户默认是 Disabled）
             try:
-                self.client.update_user(
+                self._call(
+                    'update_user',
                     IdentityStoreId=self.store_id,
                     UserId=user_id,
                     Operations=[{
@@ -74,7 +98,8 @@ class IDCService:
     def get_user_by_username(self, username: str) -> Optional[str]:
         """根据用户名获取 IDC User ID"""
         try:
-            response = self.client.list_users(
+            response = self._call(
+                'list_users',
                 IdentityStoreId=self.store_id,
                 Filters=[{
                     'AttributePath': 'UserName',
@@ -90,7 +115,8 @@ class IDCService:
     def delete_user(self, user_id: str) -> bool:
         """删除 IDC 用户"""
         try:
-            self.client.delete_user(
+            self._call(
+                'delete_user',
                 IdentityStoreId=self.store_id,
                 UserId=user_id
             )
@@ -102,7 +128,8 @@ class IDCService:
     def disable_user(self, user_id: str) -> bool:
         """禁用 IDC 用户"""
         try:
-            self.client.update_user(
+            self._call(
+                'update_user',
                 IdentityStoreId=self.store_id,
                 UserId=user_id,
                 Operations=[{
@@ -118,7 +145,8 @@ class IDCService:
     def enable_user(self, user_id: str) -> bool:
         """启用 IDC 用户"""
         try:
-            self.client.update_user(
+            self._call(
+                'update_user',
                 IdentityStoreId=self.store_id,
                 UserId=user_id,
                 Operations=[{
@@ -133,7 +161,8 @@ class IDCService:
     def add_user_to_group(self, user_id: str, group_id: str) -> bool:
         """将用户添加到组"""
         try:
-            self.client.create_group_membership(
+            self._call(
+                'create_group_membership',
                 IdentityStoreId=self.store_id,
                 GroupId=group_id,
                 MemberId={'UserId': user_id}
@@ -149,5 +178,19 @@ class IDCService:
             return False
 
 
+_services: Dict[str, IDCService] = {}
+_services_lock = threading.Lock()
+
+
+def get_idc_service(identity_store_id: Optional[str] = None) -> IDCService:
+    """按 identity_store_id 缓存 IDCService 实例"""
+    store_id = identity_store_id or settings.IDENTITY_STORE_ID
+    service = _services.get(store_id)
+    if service is None:
+        with _services_lock:
+            service = _services.setdefault(store_id, IDCService(identity_store_id=store_id))
+    return service
+
+
 # 单例
-idc_service = IDCService()
+idc_service = get_idc_service()
@@ -0,0 +1,207 @@
+"""认领请求幂等：重复提交（双击、弱网重试）直接重放第一次的响应，不再查库、不再调用 IDC
+
+两级存储：进程内 LRU（命中时不访问数据库）→ 数据库中的幂等键（多实例共享，带 TTL）。
+同一进程内并发的重复请求等待第一个请求的结果；其他实例正在处理时返回冲突，客户端稍后重试即可拿到结果。
+只保存成功的响应，失败的请求释放幂等键，重试会重新执行（等待中的并发请求拿到同一个失败结果，不标记为重放）。
+"""
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.config import settings
+from app.services.db_factory import async_db, db
+
+
+# 清理过期幂等键的间隔（DynamoDB 由表的 TTL 自动删除）
+PURGE_INTERVAL_SECONDS = 3600.0
+
+
+class IdempotencyError(Exception):
+    """幂等键冲突：status_code 为应返回的 HTTP 状态码"""
+    
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def claim_key(token: str, email: str, idempotency_key: Optional[str] = None) -> str:
+    """认领请求的幂等键：带 Idempotency-Key 时按该值，否则按令牌 + 邮箱（均限定在该令牌下）"""
+    if idempotency_key:
+        return f"claim:{token}:key:{hashlib.sha256(idempotency_key.encode()).hexdigest()}"
+    return f"claim:{token}:email:{email.strip().lower()}"
+
+
+def fingerprint_of(*parts: str) -> str:
+    """请求指纹：同一幂等键用于不同的请求内容时拒绝重放"""
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    幂等响应存储
+    
+    run(key, fingerprint, handler)：有保存的响应时直接返回，否则执行 handler 并保存成功的响应。
+    """
+    
+    def __init__(self, max_size: int, ttl: float, inflight_ttl: float, cache_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.inflight_ttl = inflight_ttl
+        self.cache_ttl = cache_ttl
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Tuple[asyncio.Future, str]] = {}
+        self._last_purge = 0.0
+        self.stats = {"memory_hits": 0, "store_hits": 0, "joined": 0, "executed": 0}
+    
+    def _get_cached(self, key: str) -> Optional[Dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            return None
+    
+    def _put_cached(self, key: str, record: Dict):
+        valid_until = min(record.get("expires_at") or float("inf"), time.time() + self.cache_ttl)
+        with self._lock:
+            self._entries[key] = (valid_until, record)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    @staticmethod
+    def _replay(record: Dict, fingerprint: str) -> Tuple[int, Dict, bool]:
+        if record.get("fingerprint") != fingerprint:
+            raise IdempotencyError(422, "该 Idempotency-Key 已用于不同的请求")
+        return record["status_code"], record["response"], True
+    
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        handler: Callable[[], Awaitable[Tuple[int, Dict, bool]]],
+        aliases: Tuple[str, ...] = ()
+    ) -> Tuple[int, Dict, bool]:
+        """
+        执行或重放请求
+        
+        Args:
+            key: 幂等键
+            fingerprint: 请求指纹
+            handler: 实际处理，返回 (状态码, 响应体, 是否成功)
+            aliases: 执行前也按这些键查找已保存的响应，成功时同时以这些键保存（如带 Idempotency-Key 时的令牌 + 邮箱键）
+        
+        Returns:
+            (状态码, 响应体, 是否为重放)
+        """
+        # 带 Idempotency-Key 时也按别名（令牌 + 邮箱）查找：换了或没带 Idempotency-Key 的重试同样重放
+        keys = (key,) + aliases
+        for k in keys:
+            record = self._get_cached(k)
+            if record is not None:
+                self.stats["memory_hits"] += 1
+                return self._replay(record, fingerprint)
+        
+        # 同一进程内的并发重复请求：等待第一个请求
+        for k in keys:
+            inflight = self._inflight.get(k)
+            if inflight is None:
+                continue
+            future, inflight_fingerprint = inflight
+            if inflight_fingerprint != fingerprint:
+                raise IdempotencyError(422, "该 Idempotency-Key 已用于不同的请求")
+            self.stats["joined"] += 1
+            # 结果的第三项表示响应是否已保存：失败的结果不是重放
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = (future, fingerprint)
+        try:
+            existing, found = None, key
+            for alias in aliases:
+                existing = await async_db.get_idempotency_key(alias)
+                if existing is not None:
+                    found = alias
+                    break
+            if existing is None:
+                existing = await async_db.reserve_idempotency_key(key, fingerprint, self.inflight_ttl)
+            if existing is not None:
+                if existing.get("status") != "DONE":
+                    raise IdempotencyError(409, "该请求正在处理中，请稍后重试")
+                self.stats["store_hits"] += 1
+                self._put_cached(found, existing)
+                result = self._replay(existing, fingerprint)
+                future.set_result(result)
+                return result
+            
+            self.stats["executed"] += 1
+            try:
+                status_code, body, success = await handler()
+            except BaseException:
+                await self._release(key)
+                raise
+            
+            if success:
+                for k in (key,) + aliases:
+                    await async_db.complete_idempotency_key(k, fingerprint, status_code, body, self.ttl)
+                    self._put_cached(k, {
+                        "fingerprint": fingerprint,
+                        "status": "DONE",
+                        "status_code": status_code,
+                        "response": body,
+                        "expires_at": time.time() + self.ttl
+                    })
+            else:
+                await self._release(key)
+            
+            future.set_result((status_code, body, success))
+            await self._maybe_purge()
+            return status_code, body, False
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+                # 没有等待者时避免 "exception was never retrieved"
+                future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+    
+    async def _release(self, key: str):
+        try:
+            await async_db.delete_idempotency_key(key)
+        except Exception as e:
+            # 处理中标记到期后自然释放
+            print(f"[幂等] 释放幂等键失败: {e}")
+    
+    async def _maybe_purge(self):
+        now = time.time()
+        if now - self._last_purge < PURGE_INTERVAL_SECONDS:
+            return
+        self._last_purge = now
+        try:
+            purged = await async_db.purge_expired_idempotency_keys()
+            if purged:
+                print(f"[幂等] 清理过期幂等键 {purged} 个")
+        except Exception as e:
+            print(f"[幂等] 清理过期幂等键失败: {e}")
+    
+    def invalidate(self, key: str):
+        """删除保存的响应（同步调用，用于认领回滚后允许重新认领）"""
+        with self._lock:
+            self._entries.pop(key, None)
+        db.delete_idempotency_key(key)
+
+
+claim_idempotency = IdempotencyStore(
+    max_size=settings.CLAIM_IDEMPOTENCY_CACHE_SIZE,
+    ttl=settings.CLAIM_IDEMPOTENCY_TTL_SECONDS,
+    inflight_ttl=settings.CLAIM_IDEMPOTENCY_INFLIGHT_TTL_SECONDS,
+    cache_ttl=settings.CLAIM_IDEMPOTENCY_CACHE_TTL_SECONDS
+)
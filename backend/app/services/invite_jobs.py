@@ -0,0 +1,169 @@
+"""邀请批量生成任务：大批量邀请在后台分批写入，接口只登记任务和查询进度"""
+import asyncio
+import secrets
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app.models.invite import InviteJobStatus
+from app.services.db_factory import async_db
+from app.services.scheduler import WORKER_ID
+from app.services.token_filter import invite_token_filter
+
+
+def make_invites(params: Dict, count: int, created_at: datetime, job_id: Optional[str] = None) -> List[Dict]:
+    """按参数生成 count 条 PENDING 邀请记录（只构造，不写入）"""
+    invites = []
+    for _ in range(count):
+        invite = {
+            "token": secrets.token_urlsafe(12),
+            "status": "PENDING",
+            "tier": params["tier"],
+            "entitlement_days": params["entitlement_days"],
+            "created_at": created_at.isoformat(),
+            "expires_at": params["expires_at"],
+            "note": params.get("note"),
+            "identity_store_id": params["identity_store_id"],
+            "sso_url": params["sso_url"]
+        }
+        if job_id:
+            invite["job_id"] = job_id
+        invites.append(invite)
+    return invites
+
+
+class InviteJobRunner:
+    """
+    批量任务执行器（在 lifespan 中作为后台任务启动）
+    
+    任务记录持久化在数据库中：提交后进入内存队列立即执行；进程重启或其他实例退出后，
+    由定期扫描重新拾取未完成的任务。执行期间持有按任务命名的租约（每批续期），同一任务只有一个实例在写。
+    每批写入前把这一批的令牌与进度一起记在任务上，续跑时按主键核对实际写入数，不会多生成。
+    """
+    
+    def __init__(self, batch_size: int, lease_ttl: float, rescan_interval: float):
+        self.batch_size = batch_size
+        self.lease_ttl = lease_ttl
+        self.rescan_interval = rescan_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: set = set()
+    
+    @property
+    def running(self) -> bool:
+        return self._queue is not None
+    
+    def submit(self, job_id: str):
+        """放入执行队列；执行器未运行时留给下次扫描"""
+        if self._queue is None or job_id in self._queued:
+            return
+        self._queued.add(job_id)
+        self._queue.put_nowait(job_id)
+    
+    async def _rescan(self):
+        try:
+            jobs = await async_db.get_unfinished_invite_jobs()
+        except Exception as e:
+            print(f"[批量任务] 扫描未完成任务失败: {e}")
+            return
+        for job in jobs:
+            self.submit(job["job_id"])
+    
+    def _next_batch(self, job: Dict, created: int) -> List[Dict]:
+        count = min(self.batch_size, job["total"] - created)
+        return make_invites(job["params"], count, datetime.now(), job["job_id"]) if count > 0 else []
+    
+    async def _execute(self, job_id: str):
+        lease = f"invite_job:{job_id}"
+        holder = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        fencing_token = await async_db.acquire_lease(lease, holder, self.lease_ttl)
+        if fencing_token is None:
+            # 其他实例正在执行
+            return
+        
+        try:
+            job = await async_db.get_invite_job(job_id)
+            if job is None or job["status"] not in (InviteJobStatus.PENDING, InviteJobStatus.RUNNING):
+                return
+            
+            # 上次可能在写入一批之后、更新进度之前中断：按主键核对记录的待写入批次，以实际写入数为准
+            created = job["created"]
+            pending = job.get("pending_tokens")
+            if pending:
+                created += await async_db.count_existing_invites(pending)
+            elif pending is None and job["status"] == InviteJobStatus.RUNNING:
+                # 升级前开始的任务没有记录待写入批次
+                created = max(created, await async_db.count_invites_by_job(job_id))
+            created = min(created, job["total"])
+            
+            invites = self._next_batch(job, created)
+            await async_db.update_invite_job(job_id, {
+                "status": InviteJobStatus.RUNNING.value,
+                "created": created,
+                "pending_tokens": [inv["token"] for inv in invites]
+            })
+            print(f"[批量任务] {job_id} 开始生成: {created}/{job['total']}")
+            
+            while invites:
+                if not await async_db.insert_invites_many(invites):
+                    raise RuntimeError("写入邀请失败")
+                invite_token_filter.add_many(inv["token"] for inv in invites)
+                created += len(invites)
+                # 进度与下一批的令牌一次写入
+                invites = self._next_batch(job, created)
+                await async_db.update_invite_job(job_id, {
+                    "created": created,
+                    "pending_tokens": [inv["token"] for inv in invites]
+                })
+                
+                fencing_token = await async_db.acquire_lease(lease, holder, self.lease_ttl)
+                if fencing_token is None:
+                    print(f"[批量任务] {job_id} 租约已被接管，停止执行")
+                    return
+            
+            await async_db.update_invite_job(job_id, {
+                "status": InviteJobStatus.COMPLETED.value,
+                "completed_at": datetime.now().isoformat()
+            })
+            print(f"[批量任务] {job_id} 已完成: {created} 个邀请")
+        except asyncio.CancelledError:
+            # 保持 RUNNING，由下次扫描续跑
+            raise
+        except Exception as e:
+            print(f"[批量任务] {job_id} 失败: {e}")
+            await async_db.update_invite_job(job_id, {"status": InviteJobStatus.FAILED.value, "error": str(e)})
+        finally:
+            if fencing_token is not None:
+                try:
+                    await async_db.release_lease(lease, holder, fencing_token)
+                except Exception as e:
+                    # 退出时线程池可能已关闭，租约到期后自然释放
+                    print(f"[批量任务] 释放租约失败: {e}")
+    
+    async def run(self):
+        """执行器主循环：串行执行队列中的任务，空闲时定期扫描未完成的任务"""
+        self._queue = asyncio.Queue()
+        try:
+            await self._rescan()
+            while True:
+                try:
+                    job_id = await asyncio.wait_for(self._queue.get(), timeout=self.rescan_interval)
+                except asyncio.TimeoutError:
+                    await self._rescan()
+                    continue
+                
+                self._queued.discard(job_id)
+                try:
+                    await self._execute(job_id)
+                except Exception as e:
+                    print(f"[批量任务] {job_id} 执行异常: {e}")
+        finally:
+            self._queue = None
+            self._queued.clear()
+
+
+invite_job_runner = InviteJobRunner(
+    batch_size=settings.INVITE_JOB_BATCH_SIZE,
+    lease_ttl=settings.INVITE_JOB_LEASE_TTL_SECONDS,
+    rescan_interval=settings.INVITE_JOB_RESCAN_SECONDS
+)
@@ -0,0 +1,30 @@
+"""分页游标编解码（对客户端不透明）"""
+import base64
+import json
+from typing import Dict, Optional
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(position: Optional[Dict]) -> Optional[str]:
+    """把分页位置编码成 URL 安全的字符串，没有下一页时返回 None"""
+    if not position:
+        return None
+    raw = json.dumps(position, separators=(',', ':'), ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict]:
+    """解码游标，格式不对时抛 ValueError"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(raw)
+    except Exception:
+        raise ValueError("无效的分页游标")
+    if not isinstance(position, dict):
+        raise ValueError("无效的分页游标")
+    return position
@@ -0,0 +1,204 @@
+"""按名单批量开通账号（管理员导入 CSV / NDJSON 名单，不经过邀请认领）"""
+import asyncio
+import csv
+import io
+import json
+import re
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from app.config import settings
+from app.models.invite import ClaimResult
+from app.services.async_db import run_idc
+from app.services.db_factory import async_db, db
+from app.services.expiry_timer import expiry_timer
+from app.services.idc import get_idc_service
+from app.services.timeutil import to_epoch
+
+
+TIERS = {"Pro", "Pro+", "Power"}
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+def parse_roster(body: bytes, fmt: str) -> List[Dict]:
+    """
+    解析名单，返回 [{row, email, display_name, tier}]（row 从 1 开始，不含表头）
+    CSV 需要表头，列名不区分大小写；格式不对时抛 ValueError
+    """
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("名单需要 UTF-8 编码")
+    
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(text))
+        if "email" not in [(f or "").strip().lower() for f in reader.fieldnames or []]:
+            raise ValueError("CSV 缺少 email 列")
+        records = (
+            {k.strip().lower(): v for k, v in record.items() if k}
+            for record in reader
+        )
+    else:
+        records = []
+        for n, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"第 {n} 行不是合法的 JSON")
+            if not isinstance(record, dict):
+                raise ValueError(f"第 {n} 行不是 JSON 对象")
+            records.append(record)
+    
+    rows = []
+    for record in records:
+        rows.append({
+            "row": len(rows) + 1,
+            "email": str(record.get("email") or "").strip(),
+            "display_name": str(record.get("display_name") or "").strip() or None,
+            "tier": str(record.get("tier") or "").strip() or None
+        })
+        if len(rows) > settings.PROVISION_MAX_ROWS:
+            raise ValueError(f"名单最多 {settings.PROVISION_MAX_ROWS} 行")
+    return rows
+
+
+def _result(row: Dict, status: str, **fields) -> Dict:
+    return {"row": row["row"], "email": row["email"], "status": status, **fields}
+
+
+def _provision_one(row: Dict, identity_store_id: str, sso_url: str, expires_at: datetime) -> Dict:
+    """开通单个账号：写入用户（同租户邮箱唯一）→ 创建 IDC 用户 → 加入组；IDC 失败时删除已写入的用户"""
+    email_prefix = row["email"].split("@")[0]
+    username = row["username"]
+    if db.get_user_by_username(username, identity_store_id):
+        username = f"kiro_{email_prefix[:12]}_{uuid.uuid4().hex[:4]}"
+    
+    user = {
+        "user_id": f"user_{uuid.uuid4().hex[:12]}",
+        "username": username,
+        "email": row["email"],
+        "display_name": row["display_name"] or email_prefix,
+        "status": "ACTIVE",
+        "tier": row["tier"],
+        "idc_user_id": None,
+        "created_at": datetime.now().isoformat(),
+        "expires_at": expires_at.isoformat(),
+        "invite_token": None,
+        "identity_store_id": identity_store_id,
+        "sso_url": sso_url
+    }
+    
+    result = db.insert_user_unique(user)
+    if result == ClaimResult.USERNAME_TAKEN:
+        user["username"] = f"kiro_{email_prefix[:12]}_{uuid.uuid4().hex[:4]}"
+        result = db.insert_user_unique(user)
+    if result == ClaimResult.EMAIL_TAKEN:
+        return _result(row, "exists", error="该邮箱已注册")
+    if result != ClaimResult.CLAIMED:
+        return _result(row, "failed", error="写入用户失败")
+    
+    idc_service = get_idc_service(identity_store_id)
+    idc_user_id = idc_service.create_user(
+        username=user["username"],
+        email=user["email"],
+        display_name=user["display_name"]
+    )
+    if not idc_user_id:
+        db.delete_user(user["user_id"])
+        return _result(row, "failed", error="创建 AWS 账号失败")
+    
+    group_id = settings.get_group_id(user["tier"])
+    if group_id:
+        idc_service.add_user_to_group(idc_user_id, group_id)
+    
+    db.update_user(user["user_id"], {"idc_user_id": idc_user_id})
+    return _result(
+        row, "created",
+        user_id=user["user_id"],
+        username=user["username"],
+        tier=user["tier"],
+        expires_at=user["expires_at"]
+    )
+
+
+async def provision_roster(
+    rows: List[Dict],
+    identity_store_id: str,
+    sso_url: str,
+    default_tier: str,
+    expires_at: datetime,
+    concurrency: Optional[int] = None
+) -> AsyncIterator[Dict]:
+    """
+    批量开通，逐行产出结果（开通的行按完成顺序），最后产出 {"summary": {...}}
+    
+    先校验并去重（名单内重复、一次索引查询查出已注册的邮箱，均不区分大小写），
+    其余行以有界并发开通；IDC 调用经过进程级令牌桶，不会超出 API 配额。
+    """
+    concurrency = concurrency or settings.PROVISION_CONCURRENCY
+    summary: Counter = Counter()
+    
+    valid = []
+    seen_emails = set()
+    for row in rows:
+        row["tier"] = row["tier"] or default_tier
+        if not EMAIL_PATTERN.match(row["email"]):
+            result = _result(row, "invalid", error="邮箱格式不正确")
+        elif row["tier"] not in TIERS:
+            result = _result(row, "invalid", error=f"未知的等级: {row['tier']}")
+        elif row["email"].lower() in seen_emails:
+            result = _result(row, "duplicate", error="名单内重复")
+        else:
+            seen_emails.add(row["email"].lower())
+            valid.append(row)
+            continue
+        summary[result["status"]] += 1
+        yield result
+    
+    existing = await async_db.find_existing_emails(identity_store_id, [row["email"] for row in valid])
+    
+    # 名单内用户名前缀相同时预先加后缀，避免并发开通时互相冲突
+    todo = []
+    usernames = set()
+    for row in valid:
+        if row["email"].lower() in existing:
+            summary["exists"] += 1
+            yield _result(row, "exists", error="该邮箱已注册")
+            continue
+        email_prefix = row["email"].split("@")[0]
+        username = f"kiro_{email_prefix[:20]}"
+        if username in usernames:
+            username = f"kiro_{email_prefix[:12]}_{uuid.uuid4().hex[:4]}"
+        usernames.add(username)
+        row["username"] = username
+        todo.append(row)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def provision(row: Dict) -> Dict:
+        async with semaphore:
+            try:
+                return await run_idc(_provision_one, row, identity_store_id, sso_url, expires_at)
+            except Exception as e:
+                print(f"开通 {row['email']} 失败: {e}")
+                return _result(row, "failed", error="开通失败")
+    
+    tasks = [asyncio.create_task(provision(row)) for row in todo]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result["status"] == "created":
+                expiry_timer.schedule(result["user_id"], to_epoch(result["expires_at"]))
+            summary[result["status"]] += 1
+            yield result
+    finally:
+        # 客户端断开时不再启动新的开通（已在执行的会完成）
+        for task in tasks:
+            task.cancel()
+    
+    summary["total"] = len(rows)
+    yield {"summary": dict(summary)}
@@ -0,0 +1,167 @@
+"""异步开通队列 worker：认领只占用邀请并入队，IDC 调用在后台完成，IDC 延迟不再拖住认领请求"""
+import asyncio
+import time
+import uuid
+from typing import Dict, Optional, Set
+
+from app.config import settings
+from app.models.invite import ProvisionStatus
+from app.services.async_db import run_idc
+from app.services.db_factory import async_db, db
+from app.services.expiry_timer import expiry_timer
+from app.services.idc import get_idc_service
+from app.services.idempotency import claim_idempotency, claim_key
+from app.services.scheduler import WORKER_ID
+from app.services.timeutil import epoch_of
+
+
+class ProvisionError(Exception):
+    """开通失败；retryable 为 False 时不再重试"""
+    
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def provision_user(user_id: str):
+    """
+    为已写入的用户开通 IDC 账号（可重复执行）
+    
+    已有 idc_user_id 时跳过创建；create_user 遇到同名用户会返回已有的 ID，加组遇到已是成员视为成功。
+    """
+    user = db.get_user(user_id)
+    if user is None:
+        raise ProvisionError("用户不存在", retryable=False)
+    
+    store_id = user.get("identity_store_id") or settings.IDENTITY_STORE_ID
+    idc_service = get_idc_service(store_id)
+    
+    idc_user_id = user.get("idc_user_id")
+    if not idc_user_id:
+        idc_user_id = idc_service.create_user(
+            username=user["username"],
+            email=user["email"],
+            display_name=user.get("display_name")
+        )
+        if not idc_user_id:
+            raise ProvisionError("创建 AWS 账号失败")
+        db.update_user(user_id, {"idc_user_id": idc_user_id})
+    
+    group_id = settings.get_group_id(user["tier"])
+    if group_id and not idc_service.add_user_to_group(idc_user_id, group_id):
+        raise ProvisionError("添加用户到组失败")
+    
+    expiry_timer.schedule(user_id, epoch_of(user, "expires_at"))
+
+
+def rollback_claim(token: str, user_id: str, idempotency_key: Optional[str] = None):
+    """
+    多次重试仍失败：删除已创建的 IDC 用户，释放邀请让学生可以重新认领
+    idempotency_key 为认领时按 Idempotency-Key 保存响应的键（任务入队时记录）
+    """
+    user = db.get_user(user_id)
+    if user is None:
+        return
+    if user.get("idc_user_id"):
+        store_id = user.get("identity_store_id") or settings.IDENTITY_STORE_ID
+        get_idc_service(store_id).delete_user(user["idc_user_id"])
+    db.release_invite_claim(token, user)
+    # 保存的认领响应已失效，学生重新认领时要真正执行
+    claim_idempotency.invalidate(claim_key(token, user["email"]))
+    if idempotency_key:
+        claim_idempotency.invalidate(idempotency_key)
+
+
+class ProvisioningWorker:
+    """
+    开通队列 worker（在 lifespan 中作为后台任务启动）
+    
+    以租约方式取出到期任务（多实例不会重复执行，崩溃后租约过期自动重新入队），
+    最多 concurrency 个任务同时执行；失败按指数退避重试，超过次数后回滚认领。
+    """
+    
+    def __init__(self, concurrency: int, lease_seconds: float, poll_interval: float,
+                 max_attempts: int, retry_delay: float):
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.holder = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        self._wakeup: Optional[asyncio.Event] = None
+        self.stats = {"completed": 0, "retried": 0, "failed": 0}
+    
+    @property
+    def running(self) -> bool:
+        return self._wakeup is not None
+    
+    def notify(self):
+        """有新任务入队（认领接口在事件循环中调用）"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def _process(self, task: Dict):
+        token = task["token"]
+        try:
+            await run_idc(provision_user, task["user_id"])
+        except Exception as e:
+            retryable = getattr(e, "retryable", True)
+            if retryable and task["attempts"] < self.max_attempts:
+                delay = min(self.retry_delay * (2 ** (task["attempts"] - 1)), 900)
+                print(f"[开通队列] {token} 第 {task['attempts']} 次失败，{delay:.0f}s 后重试: {e}")
+                self.stats["retried"] += 1
+                await async_db.release_provision_task(
+                    token, self.holder, ProvisionStatus.PENDING.value, due_at=time.time() + delay, error=str(e)
+                )
+                return
+            
+            print(f"[开通队列] {token} 开通失败，释放邀请: {e}")
+            self.stats["failed"] += 1
+            await run_idc(rollback_claim, token, task["user_id"], task.get("idempotency_key"))
+            await async_db.release_provision_task(token, self.holder, ProvisionStatus.FAILED.value, error=str(e))
+            return
+        
+        self.stats["completed"] += 1
+        await async_db.release_provision_task(token, self.holder, ProvisionStatus.COMPLETED.value)
+    
+    async def run(self):
+        """worker 主循环"""
+        self._wakeup = asyncio.Event()
+        inflight: Set[asyncio.Task] = set()
+        try:
+            while True:
+                self._wakeup.clear()
+                free = self.concurrency - len(inflight)
+                if free > 0:
+                    # 取到的少于空位数说明暂时没有更多到期任务
+                    try:
+                        tasks = await async_db.lease_provision_tasks(self.holder, free, self.lease_seconds)
+                    except Exception as e:
+                        print(f"[开通队列] 取任务失败: {e}")
+                        tasks = []
+                    for task in tasks:
+                        inflight.add(asyncio.create_task(self._process(task)))
+                
+                # 等待有任务完成、有新任务入队或到达轮询间隔
+                waiter = asyncio.create_task(self._wakeup.wait())
+                done, _ = await asyncio.wait(
+                    inflight | {waiter}, timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED
+                )
+                waiter.cancel()
+                for task in done - {waiter}:
+                    inflight.discard(task)
+                    if task.exception():
+                        print(f"[开通队列] 任务处理异常: {task.exception()}")
+        finally:
+            for task in inflight:
+                task.cancel()
+            self._wakeup = None
+
+
+provisioning_worker = ProvisioningWorker(
+    concurrency=settings.PROVISION_QUEUE_CONCURRENCY,
+    lease_seconds=settings.PROVISION_QUEUE_LEASE_SECONDS,
+    poll_interval=settings.PROVISION_QUEUE_POLL_SECONDS,
+    max_attempts=settings.PROVISION_QUEUE_MAX_ATTEMPTS,
+    retry_delay=settings.PROVISION_QUEUE_RETRY_SECONDS
+)
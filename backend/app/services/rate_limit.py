@@ -0,0 +1,43 @@
+"""限流与退避工具"""
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶
+    
+    rate: 每秒补充的令牌数（稳定速率）
+    burst: 桶容量（允许的瞬时突发）
+    """
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    def acquire(self, tokens: float = 1.0) -> float:
+        """阻塞直到拿到令牌，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def backoff_delay(attempt: int, base: float = 0.2, cap: float = 10.0) -> float:
+    """指数退避 + 全抖动"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
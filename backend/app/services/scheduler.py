@@ -1,11 +1,26 @@
 """定时任务：检查并处理过期账号"""
-from datetime import datetime
-from typing import Literal
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, time, timedelta
+from time import perf_counter
+from typing import Dict, List, Literal, Optional
+import os
+import socket
+import uuid
 from app.services.db_factory import db
-from app.services.idc import IDCService
+from app.services.idc import get_idc_service
+from app.services.timeutil import now_epoch
 from app.config import settings
 
 
+# 过期清理断点名、租约名
+SWEEP_CHECKPOINT = "expiry_sweep"
+SWEEP_LEASE = "expiry_sweep"
+
+# 本进程的租约持有者标识
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
 class AccountScheduler:
     """账号过期管理"""
     
@@ -17,60 +32,210 @@ class AccountScheduler:
         """
         self.action = action
     
-    def check_expired_accounts(self) -> dict:
+    def check_expired_accounts(
+        self,
+        concurrency: Optional[int] = None,
+        time_budget: Optional[float] = None
+    ) -> dict:
         """
         检查并处理过期账号
         返回处理结果统计
+        
+        concurrency: 并发处理数（默认 settings.IDC_SWEEP_CONCURRENCY，1 为串行）
+        IDC 调用统一经过令牌桶限流，被限流时自动退避重试
+        
+        time_budget: 本次可用的秒数。时间用完后不再提交新用户，等在途任务完成后
+        把进度写入断点并返回 more_work=True；下次调用从断点继续（同一个 run_id）
         """
+        # 多进程 / 多实例部署时只有拿到租约的一个实例执行清理
+        ttl = (time_budget or 0) + settings.SWEEP_LEASE_TTL_SECONDS
+        with self._lease(ttl) as fencing_token:
+            if fencing_token is None:
+                print("过期清理租约由其他实例持有，跳过本次清理")
+                return {
+                    "checked": 0,
+                    "expired": 0,
+                    "processed": 0,
+                    "failed": 0,
+                    "details": [],
+                    "more_work": False,
+                    "skipped": True
+                }
+            return self._sweep(concurrency, time_budget, fencing_token)
+    
+    @contextmanager
+    def _lease(self, ttl: float):
+        """获取清理租约，返回 fencing token（被占用时为 None），退出时释放"""
+        holder = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        fencing_token = db.acquire_lease(SWEEP_LEASE, holder, ttl)
+        try:
+            yield fencing_token
+        finally:
+            if fencing_token is not None:
+                db.release_lease(SWEEP_LEASE, holder, fencing_token)
+    
+    def _sweep(self, concurrency: Optional[int], time_budget: Optional[float], fencing_token: int) -> dict:
+        concurrency = max(1, concurrency or settings.IDC_SWEEP_CONCURRENCY)
+        started = perf_counter()
+        stop_at = started + time_budget if time_budget is not None else None
         now = datetime.now()
-        users = db.get_users(status="ACTIVE")
         
+        checkpoint = db.get_checkpoint(SWEEP_CHECKPOINT) or {}
+        run_id = checkpoint.get("run_id") or uuid.uuid4().hex
         results = {
-            "checked": len(users),
+            "checked": 0,
             "expired": 0,
             "processed": 0,
             "failed": 0,
-            "details": []
+            "details": [],
+            "run_id": run_id,
+            "resumed": bool(checkpoint),
+            "more_work": False,
+            "started_at": now.isoformat(),
+            "concurrency": concurrency,
+            "fencing_token": fencing_token
         }
         
-        for user in users:
-            if user.get("status") != "ACTIVE":
+        # 进度：最后提交的 expires_ts，以及该时间点上已尝试但失败的用户（成功的会离开 ACTIVE 集合）
+        last_expires_ts = checkpoint.get("after_ts")
+        attempted_ids = set(checkpoint.get("attempted_ids", []))
+        failed = []
+        
+        def record(user: dict, success: bool):
+            results["processed" if success else "failed"] += 1
+            results["details"].append({
+                "username": user["username"],
+                "action": self.action,
+                "status": "success" if success else "failed"
+            })
+            if not success:
+                failed.append((user["expires_ts"], user["user_id"]))
+        
+        def out_of_time() -> bool:
+            return stop_at is not None and perf_counter() >= stop_at
+        
+        due_users = self._iter_due_users(now, results, after=last_expires_ts, skip_ids=attempted_ids)
+        try:
+            if concurrency == 1:
+                for user in due_users:
+                    if out_of_time():
+                        results["more_work"] = True
+                        break
+                    last_expires_ts = user["expires_ts"]
+                    record(user, self._process_expired_user(user))
+            else:
+                # 有界的在途任务数，避免一次性把所有到期用户提交到线程池
+                with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sweep") as executor:
+                    pending = {}
+                    for user in due_users:
+                        if out_of_time():
+                            results["more_work"] = True
+                            break
+                        last_expires_ts = user["expires_ts"]
+                        pending[executor.submit(self._process_expired_user, user)] = user
+                        if len(pending) >= concurrency * 2:
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                record(pending.pop(future), self._future_result(future))
+                    for future in as_completed(pending):
+                        record(pending[future], self._future_result(future))
+        finally:
+            due_users.close()
+        
+        if results["more_work"]:
+            # 只需记住断点时间点上的失败用户，更早的失败用户已被 after 边界排除
+            if checkpoint.get("after_ts") == last_expires_ts:
+                boundary_ids = set(attempted_ids)
+            else:
+                boundary_ids = set()
+            boundary_ids.update(uid for exp, uid in failed if exp == last_expires_ts)
+            saved = db.save_checkpoint(SWEEP_CHECKPOINT, {
+                "run_id": run_id,
+                "after_ts": last_expires_ts,
+                "attempted_ids": sorted(boundary_ids),
+                "saved_at": datetime.now().isoformat()
+            }, fencing_token=fencing_token)
+            if not saved:
+                print("清理租约已被其他实例接管，放弃保存断点")
+        elif checkpoint:
+            db.delete_checkpoint(SWEEP_CHECKPOINT)
+        
+        results["finished_at"] = datetime.now().isoformat()
+        results["duration_ms"] = round((perf_counter() - started) * 1000, 1)
+        return results
+    
+    def _iter_due_users(self, now: datetime, results: dict, after: Optional[int] = None,
+                        skip_ids: Optional[set] = None):
+        """遍历已到期的 ACTIVE 用户（从断点 after 开始），同时累计 checked / expired"""
+        # 到期当天 23:50 处理：过期日期 <= due_date 的用户都已到期，范围条件在索引上完成
+        for user in db.iter_users_expiring_before(self._due_before(now), after=after):
+            if skip_ids and user["user_id"] in skip_ids:
                 continue
-                
-            expires_at = user.get("expires_at")
-            if not expires_at:
+            results["checked"] += 1
+            if user.get("status") != "ACTIVE" or user.get("expires_ts") is None:
                 continue
-            
-            # 解析过期时间
+            user["expires_ts"] = int(user["expires_ts"])
+            results["expired"] += 1
+            yield user
+    
+    @staticmethod
+    def expiry_deadline(expires_ts: Optional[int]) -> Optional[int]:
+        """账号的处理时刻（epoch 秒）：到期当天 23:50；expires_ts 缺失时返回 None"""
+        if expires_ts is None:
+            return None
+        expires = datetime.fromtimestamp(int(expires_ts))
+        return int(expires.replace(hour=23, minute=50, second=0, microsecond=0).timestamp())
+    
+    def expire_users(self, user_ids: List[str], concurrency: Optional[int] = None) -> Dict[str, List[str]]:
+        """
+        处理指定的用户（到期定时器触发时调用）
+        重新读取每个用户，只处理仍为 ACTIVE 且已到处理时刻的；返回 processed / failed / skipped 的 user_id
+        与全量清理共用租约，拿不到租约时全部放入 deferred
+        """
+        now = now_epoch()
+        results = {"processed": [], "failed": [], "skipped": [], "deferred": []}
+        
+        def handle(user_id: str) -> str:
             try:
-                expire_time = datetime.fromisoformat(expires_at)
-                # 到期当天 23:50 删除，所以判断时间设为当天 23:50
-                expire_time = expire_time.replace(hour=23, minute=50, second=0)
-            except:
-                continue
-            
-            # 检查是否过期
-            if now >= expire_time:
-                results["expired"] += 1
-                success = self._process_expired_user(user)
-                
-                if success:
-                    results["processed"] += 1
-                    results["details"].append({
-                        "username": user["username"],
-                        "action": self.action,
-                        "status": "success"
-                    })
-                else:
-                    results["failed"] += 1
-                    results["details"].append({
-                        "username": user["username"],
-                        "action": self.action,
-                        "status": "failed"
-                    })
+                user = db.get_user(user_id)
+                if not user or user.get("status") != "ACTIVE":
+                    return "skipped"
+                deadline = self.expiry_deadline(user.get("expires_ts"))
+                if deadline is None or now < deadline:
+                    return "skipped"
+                return "processed" if self._process_expired_user(user) else "failed"
+            except Exception as e:
+                print(f"处理过期用户异常 {user_id}: {e}")
+                return "failed"
         
+        concurrency = max(1, min(len(user_ids), concurrency or settings.IDC_SWEEP_CONCURRENCY))
+        with self._lease(settings.SWEEP_LEASE_TTL_SECONDS) as fencing_token:
+            # 其他实例正在处理，交回调用方稍后再试
+            if fencing_token is None:
+                results["deferred"] = list(user_ids)
+                return results
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="expiry") as executor:
+                for user_id, outcome in zip(user_ids, executor.map(handle, user_ids)):
+                    results[outcome].append(user_id)
         return results
     
+    @staticmethod
+    def _future_result(future) -> bool:
+        try:
+            return future.result()
+        except Exception as e:
+            print(f"处理过期用户异常: {e}")
+            return False
+    
+    @staticmethod
+    def _due_before(now: datetime) -> int:
+        """
+        到期扫描的上界（不含，epoch 秒）：过期日期 <= 最近一个已过的 23:50 所在日期的用户都已到期
+        即该日期次日 00:00
+        """
+        due_date = now.date() if now.time() >= time(23, 50) else now.date() - timedelta(days=1)
+        return int(datetime.combine(due_date + timedelta(days=1), time.min).timestamp())
+    
     def _process_expired_user(self, user: dict) -> bool:
         """处理单个过期用户"""
         idc_user_id = user.get("idc_user_id")
@@ -80,7 +245,7 @@ class AccountScheduler:
         if not idc_user_id:
             return False
         
-        idc_service = IDCService(identity_store_id=identity_store_id)
+        idc_service = get_idc_service(identity_store_id)
         
         try:
             if self.action == "delete":
@@ -108,28 +273,16 @@ class AccountScheduler:
             return False
     
     def get_expiring_soon(self, days: int = 7) -> list:
-        """获取即将过期的账号（提前提醒用）"""
-        from datetime import timedelta
-        now = datetime.now()
-        threshold = now + timedelta(days=days)
+        """获取即将过期的账号（提前提醒用），按过期时间升序"""
+        now = now_epoch()
+        threshold = now + days * 86400
         
-        users = db.get_users(status="ACTIVE")
         expiring = []
+        for user in db.iter_users_expiring_before(threshold + 1, after=now + 1):
+            user["days_left"] = (int(user["expires_ts"]) - now) // 86400
+            expiring.append(user)
         
-        for user in users:
-            expires_at = user.get("expires_at")
-            if not expires_at:
-                continue
-            
-            try:
-                expire_time = datetime.fromisoformat(expires_at)
-                if now < expire_time <= threshold:
-                    user["days_left"] = (expire_time - now).days
-                    expiring.append(user)
-            except:
-                continue
-        
-        return sorted(expiring, key=lambda x: x.get("days_left", 0))
+        return expiring
 
 
 # 使用删除模式 - 过期后自动删除 IDC 账号
@@ -0,0 +1,56 @@
+"""时间工具：ISO 字符串与 epoch 秒互转
+
+created_at / expires_at 以不带时区的 ISO 字符串存储，按服务器本地时间（与 datetime.now() 一致）解释；
+带时区的字符串按其时区换算。存储层另存 epoch 秒（created_ts / expires_ts），与时区无关，
+用于数据库内的范围过滤和排序。
+"""
+import time
+from datetime import datetime
+from typing import Dict, Optional, Union
+
+
+# ISO 字段 → epoch 字段
+EPOCH_FIELDS = {
+    'created_at': 'created_ts',
+    'expires_at': 'expires_ts',
+}
+
+
+def now_epoch() -> int:
+    return int(time.time())
+
+
+def to_epoch(value: Union[str, datetime, None]) -> Optional[int]:
+    """ISO 字符串 / datetime 转 epoch 秒；空值或格式不对时返回 None"""
+    if not value:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    return int(value.timestamp())
+
+
+def from_epoch(ts: Optional[int]) -> Optional[datetime]:
+    """epoch 秒转本地时间（不带时区，与存量 ISO 字段一致）"""
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(int(ts))
+
+
+def epoch_of(record: Dict, field: str) -> Optional[int]:
+    """读取记录的 epoch 字段，尚未回填时从 ISO 字段换算"""
+    ts = record.get(EPOCH_FIELDS[field])
+    if ts is not None:
+        return int(ts)
+    return to_epoch(record.get(field))
+
+
+def with_epochs(record: Dict) -> Dict:
+    """返回补上 epoch 字段的副本（只处理记录中出现的 ISO 字段）"""
+    record = dict(record)
+    for field, ts_field in EPOCH_FIELDS.items():
+        if field in record:
+            record[ts_field] = to_epoch(record[field])
+    return record
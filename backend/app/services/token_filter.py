@@ -0,0 +1,158 @@
+"""公开邀请接口的令牌预过滤：扫描器 / 机器人的无效令牌在查库之前拒绝
+
+依次检查：令牌格式（secrets.token_urlsafe(12) 固定为 16 位 URL 安全字符）→ 负缓存（近期查过不存在的令牌）
+→ 布隆过滤器（可选，已发放的令牌；启动时重建，创建邀请时加入）。
+"""
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from app.config import settings
+from app.services.async_db import run_blocking
+from app.services.db_factory import db
+
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]{16}")
+
+
+class BloomFilter:
+    """布隆过滤器（双重哈希），只会误判存在，不会误判不存在"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+    
+    def _positions(self, item: str) -> List[int]:
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+    
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+    
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class InviteTokenFilter:
+    """
+    邀请令牌预过滤
+    
+    check() 返回拒绝原因（shape / negative / bloom），可以查库时返回 None；
+    查库发现不存在的令牌用 remember_missing() 放入负缓存，新建的邀请用 add_many() 加入。
+    布隆过滤器重建完成前不参与判断。
+    """
+    
+    def __init__(self, negative_ttl: float, negative_size: int, bloom_enabled: bool,
+                 bloom_capacity: int, bloom_error_rate: float):
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self.bloom_enabled = bloom_enabled
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self._negative: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bloom: Optional[BloomFilter] = None
+        # 重建期间新建的令牌，重建完成后补进新的过滤器
+        self._pending: Optional[List[str]] = None
+        self.counters = {"shape": 0, "negative": 0, "bloom": 0, "passed": 0, "missing": 0}
+    
+    def check(self, token: str) -> Optional[str]:
+        if not TOKEN_PATTERN.fullmatch(token):
+            reason = "shape"
+        elif self._is_known_missing(token):
+            reason = "negative"
+        elif self._bloom is not None and token not in self._bloom:
+            reason = "bloom"
+        else:
+            self.counters["passed"] += 1
+            return None
+        self.counters[reason] += 1
+        return reason
+    
+    def _is_known_missing(self, token: str) -> bool:
+        now = time.time()
+        with self._lock:
+            expires_at = self._negative.get(token)
+            if expires_at is None:
+                return False
+            if expires_at <= now:
+                del self._negative[token]
+                return False
+            return True
+    
+    def remember_missing(self, token: str):
+        """查库确认不存在的令牌，在 negative_ttl 内直接拒绝"""
+        self.counters["missing"] += 1
+        with self._lock:
+            self._negative[token] = time.time() + self.negative_ttl
+            self._negative.move_to_end(token)
+            while len(self._negative) > self.negative_size:
+                self._negative.popitem(last=False)
+    
+    def add_many(self, tokens: Iterable[str]):
+        """登记新建的邀请令牌（在事件循环中调用）"""
+        tokens = list(tokens)
+        with self._lock:
+            for token in tokens:
+                self._negative.pop(token, None)
+        if self._pending is not None:
+            self._pending.extend(tokens)
+        if self._bloom is not None:
+            for token in tokens:
+                self._bloom.add(token)
+    
+    def _load(self, bloom: BloomFilter) -> int:
+        rows = db.iter_invites(attributes=["token"], segments=settings.DYNAMODB_SCAN_SEGMENTS)
+        try:
+            for row in rows:
+                bloom.add(row["token"])
+        finally:
+            rows.close()
+        return bloom.count
+    
+    async def rebuild(self):
+        """从库中全部邀请重建布隆过滤器（在线程池中遍历，不阻塞事件循环）"""
+        if not self.bloom_enabled:
+            return
+        bloom = BloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        self._pending = []
+        try:
+            count = await run_blocking(self._load, bloom)
+            for token in self._pending:
+                bloom.add(token)
+            self._bloom = bloom
+            print(f"[令牌过滤] 布隆过滤器已重建: {count} 个令牌")
+        except Exception as e:
+            print(f"[令牌过滤] 重建布隆过滤器失败: {e}")
+        finally:
+            self._pending = None
+    
+    @property
+    def stats(self) -> Dict:
+        return {
+            "rejected": {k: self.counters[k] for k in ("shape", "negative", "bloom")},
+            "passed": self.counters["passed"],
+            "missing": self.counters["missing"],
+            "negative_cache_size": len(self._negative),
+            "bloom": {"tokens": self._bloom.count, "bits": self._bloom.size, "hashes": self._bloom.hashes}
+            if self._bloom is not None else None
+        }
+
+
+invite_token_filter = InviteTokenFilter(
+    negative_ttl=settings.INVITE_NEGATIVE_CACHE_TTL_SECONDS,
+    negative_size=settings.INVITE_NEGATIVE_CACHE_SIZE,
+    bloom_enabled=settings.INVITE_TOKEN_BLOOM_ENABLED,
+    bloom_capacity=settings.INVITE_TOKEN_BLOOM_CAPACITY,
+    bloom_error_rate=settings.INVITE_TOKEN_BLOOM_ERROR_RATE
+)
@@ -0,0 +1,61 @@
+"""基准测试：每个请求的 AWS client 准备耗时（改造前 vs 共享注册表）
+
+不发起任何网络请求，只测量 client / Table 对象的构建开销。
+    
+    cd backend
+    python -m benchmarks.bench_aws_clients
+"""
+import time
+import statistics
+
+import boto3
+
+from app.config import settings
+from app.services.dynamodb import DynamoDB
+from app.services.idc import get_idc_service
+
+
+ROUNDS = 50
+STORE_ID = "d-0000000000"
+
+
+def setup_before(resource):
+    """改造前：每个请求新建 identitystore client；DynamoDB resource 已缓存，但每次属性访问重建 Table"""
+    boto3.client('identitystore', region_name=settings.AWS_REGION)
+    resource.Table(f"{settings.DYNAMODB_TABLE_PREFIX}_invites")
+    resource.Table(f"{settings.DYNAMODB_TABLE_PREFIX}_users")
+
+
+def setup_after(dynamodb: DynamoDB):
+    """改造后：注册表中的共享 client + 缓存的 Table"""
+    get_idc_service(STORE_ID).client
+    dynamodb.invites_table
+    dynamodb.users_table
+
+
+def measure(fn, *args) -> list:
+    samples = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    dynamodb = DynamoDB()
+    # 改造前的 DynamoDB 类在实例上缓存 resource，只创建一次
+    resource = boto3.resource('dynamodb', region_name=settings.AWS_REGION)
+    # 预热：首次加载服务模型的开销两种方式都要付一次
+    setup_before(resource)
+    setup_after(dynamodb)
+    
+    for name, samples in (
+        ("before (per-request clients)", measure(setup_before, resource)),
+        ("after  (shared registry)", measure(setup_after, dynamodb)),
+    ):
+        print(f"{name:32s} mean {statistics.mean(samples):8.3f} ms   p95 {sorted(samples)[int(ROUNDS * 0.95) - 1]:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ import { useRouter } from 'next/navigation'
 import { Plus, Copy, Trash2, Users, Link, Check, LogOut, Loader2, Settings, Download } from 'lucide-react'
 
 const API_URL = process.env.NEXT_PUBLIC_API_URL || ''
+const PAGE_SIZE = 100
+const EXPORT_PAGE_SIZE = 500
 
 interface Invite {
   token: string
@@ -38,6 +40,8 @@ export default function AdminPage() {
   const [tab, setTab] = useState<'invites' | 'users'>('invites')
   const [invites, setInvites] = useState<Invite[]>([])
   const [users, setUsers] = useState<User[]>([])
+  const [invitesCursor, setInvitesCursor] = useState<string | null>(null)
+  const [usersCursor, setUsersCursor] = useState<string | null>(null)
   const [copiedToken, setCopiedToken] = useState<string | null>(null)
   const [creating, setCreating] = useState(false)
   const [selectedTokens, setSelectedTokens] = useState<Set<string>>(new Set())
@@ -112,22 +116,29 @@ export default function AdminPage() {
     return headers
   }
 
-  const loadInvites = async () => {
+  // 分页加载：不传 cursor 时重新加载第一页，传 cursor 时追加下一页
+  const loadInvites = async (cursor?: string) => {
     if (!config) return
-    const res = await fetch(`${API_URL}/api/invites/list?store_id=${config.identityStoreId}`, {
+    const params = new URLSearchParams({ store_id: config.identityStoreId, limit: String(PAGE_SIZE) })
+    if (cursor) params.set('cursor', cursor)
+    const res = await fetch(`${API_URL}/api/invites/list?${params}`, {
       headers: getHeaders()
     })
     const data = await res.json()
-    setInvites(data)
+    setInvites(prev => cursor ? [...prev, ...data.items] : data.items)
+    setInvitesCursor(data.next_cursor)
   }
 
-  const loadUsers = async () => {
+  const loadUsers = async (cursor?: string) => {
     if (!config) return
-    const res = await fetch(`${API_URL}/api/users/list?store_id=${config.identityStoreId}`, {
+    const params = new URLSearchParams({ store_id: config.identityStoreId, limit: String(PAGE_SIZE) })
+    if (cursor) params.set('cursor', cursor)
+    const res = await fetch(`${API_URL}/api/users/list?${params}`, {
       headers: getHeaders()
     })
     const data = await res.json()
-    setUsers(data)
+    setUsers(prev => cursor ? [...prev, ...data.items] : data.items)
+    setUsersCursor(data.next_cursor)
   }
 
   useEffect(() => {
@@ -201,12 +212,46 @@ export default function AdminPage() {
     setTimeout(() => setCopiedToken(null), 2000)
   }
 
+  // 逐页读取全部待认领邀请（列表只加载了部分页，DynamoDB 的分页也不按创建时间排序）
+  const fetchAllPendingInvites = async (): Promise<Invite[]> => {
+    if (!config) return []
+    const all: Invite[] = []
+    let cursor: string | null = null
+    do {
+      const params = new URLSearchParams({
+        store_id: config.identityStoreId,
+        status: 'PENDING',
+        limit: String(EXPORT_PAGE_SIZE)
+      })
+      if (cursor) params.set('cursor', cursor)
+      const res = await fetch(`${API_URL}/api/invites/list?${params}`, {
+        headers: getHeaders()
+      })
+      if (!res.ok) throw new Error(`加载邀请失败: ${res.status}`)
+      const data = await res.json()
+      all.push(...data.items)
+      cursor = data.next_cursor
+    } while (cursor)
+    return all.filter(inv => !isExpired(inv.expires_at))
+  }
+
+  // 要导出 / 复制的邀请：有选中的用选中的，否则为全部待认领的
+  const getTargetInvites = async (): Promise<Invite[] | null> => {
+    if (selectedTokens.size > 0) {
+      return invites.filter(inv => selectedTokens.has(inv.token))
+    }
+    try {
+      return await fetchAllPendingInvites()
+    } catch (e) {
+      alert(e instanceof Error ? e.message : '加载邀请失败')
+      return null
+    }
+  }
+
   // 批量导出邀请链接
-  const exportInvites = (format: 'txt' | 'csv' | 'json') => {
-    // 如果有选中的，导出选中的；否则导出所有待认领的
-    const toExport = selectedTokens.size > 0
-      ? invites.filter(inv => selectedTokens.has(inv.token))
-      : invites.filter(inv => inv.status === 'PENDING' && !isExpired(inv.expires_at))
+  const exportInvites = async (format: 'txt' | 'csv' | 'json') => {
+    const toExport = await getTargetInvites()
+    if (toExport === null) return
     
     if (toExport.length === 0) {
       alert('没有可导出的邀请链接')
@@ -264,18 +309,16 @@ export default function AdminPage() {
   }
 
   // 复制所有待认领链接
-  const copyAllPendingUrls = () => {
-    // 如果有选中的，复制选中的；否则复制所有待认领的
-    const toCopy = selectedTokens.size > 0
-      ? invites.filter(inv => selectedTokens.has(inv.token))
-      : invites.filter(inv => inv.status === 'PENDING' && !isExpired(inv.expires_at))
+  const copyAllPendingUrls = async () => {
+    const toCopy = await getTargetInvites()
+    if (toCopy === null) return
     
     if (toCopy.length === 0) {
       alert('没有可复制的邀请链接')
       return
     }
     const urls = toCopy.map(inv => inv.claim_url).join('\n')
-    navigator.clipboard.writeText(urls)
+    await navigator.clipboard.writeText(urls)
     alert(`已复制 ${toCopy.length} 个链接到剪贴板`)
     
     // 复制后清除选择
@@ -464,7 +507,7 @@ export default function AdminPage() {
                   <span className="text-sm text-gray-600">
                     {selectedTokens.size > 0 
                       ? `已选择: ${selectedTokens.size} 个`
-                      : `待认领: ${invites.filter(inv => inv.status === 'PENDING' && !isExpired(inv.expires_at)).length} 个`
+                      : `待认领: ${invites.filter(inv => inv.status === 'PENDING' && !isExpired(inv.expires_at)).length}${invitesCursor ? '+' : ''} 个`
                     }
                   </span>
                   <div className="flex items-center gap-2">
@@ -595,6 +638,14 @@ export default function AdminPage() {
               {invites.length === 0 && (
                 <p className="text-center py-8 text-gray-500">暂无邀请链接</p>
               )}
+              {invitesCursor && (
+                <button
+                  onClick={() => loadInvites(invitesCursor)}
+                  className="w-full py-3 text-sm text-primary-600 hover:bg-gray-50 border-t"
+                >
+                  加载更多
+                </button>
+              )}
             </div>
           </div>
         )}
@@ -643,6 +694,14 @@ export default function AdminPage() {
             {users.length === 0 && (
               <p className="text-center py-8 text-gray-500">暂无用户</p>
             )}
+            {usersCursor && (
+              <button
+                onClick={() => loadUsers(usersCursor)}
+                className="w-full py-3 text-sm text-primary-600 hover:bg-gray-50 border-t"
+              >
+                加载更多
+              </button>
+            )}
           </div>
         )}
       </main>